@@ -0,0 +1,214 @@
+"""Admission control for the chat endpoints: per-user token buckets and a cap on upstream-bound work.
+
+Every chat request is classed before it runs: "upstream" if answering it may
+call the weather or news APIs or OpenAI, "local" otherwise (greetings, time,
+the knowledge base, scheduling). Each user gets one token bucket per class,
+refilled at RATE_LIMIT_<CLASS>_RATE tokens per second up to
+RATE_LIMIT_<CLASS>_BURST, so a burst of cheap messages is fine while a stream
+of uncached lookups is throttled early. Batches have a bucket of their own,
+sized for QA scripts (RATE_LIMIT_BATCH_BURST defaults to the 1000-message
+batch limit): a batch takes one batch token per distinct message that may go
+upstream, all or nothing. Upstream-bound requests also need one of
+UPSTREAM_CONCURRENCY in-flight slots, so upstream waits can never hold every
+worker; when none is free the request is turned away at once as busy. A batch
+holds no slot itself; each of its concurrent upstream calls holds one through
+upstream_slot(), waiting up to UPSTREAM_SLOT_WAIT seconds for it instead.
+
+Upstream and batch buckets and the slots live in SQLite tables, so those
+limits hold across gunicorn workers. Taking the token and the slot is one
+IMMEDIATE transaction, rolled back if the slot is refused so a busy reply costs
+the user nothing. A slot whose request died without releasing it expires
+after UPSTREAM_SLOT_LEASE seconds. If the database cannot be reached the
+request is let through. Local buckets are kept in each worker's memory
+instead: a local request then never takes the database write lock, at the
+price of the local limit applying per worker. RATE_LIMIT=0 turns all of this off.
+"""
+import os
+import math
+import time
+import threading
+from contextlib import contextmanager
+import sqlite3
+import logging
+
+import db
+import metrics
+
+logger = logging.getLogger(__name__)
+
+ENABLED = os.getenv("RATE_LIMIT", "1") == "1"
+LIMITS = {
+    "local": (float(os.getenv("RATE_LIMIT_LOCAL_RATE", "2")), float(os.getenv("RATE_LIMIT_LOCAL_BURST", "20"))),
+    "upstream": (float(os.getenv("RATE_LIMIT_UPSTREAM_RATE", "0.5")), float(os.getenv("RATE_LIMIT_UPSTREAM_BURST", "10"))),
+    "batch": (float(os.getenv("RATE_LIMIT_BATCH_RATE", "2")), float(os.getenv("RATE_LIMIT_BATCH_BURST", "1000"))),
+}
+UPSTREAM_CONCURRENCY = int(os.getenv("UPSTREAM_CONCURRENCY", "16"))
+SLOT_LEASE = float(os.getenv("UPSTREAM_SLOT_LEASE", "60"))
+SLOT_WAIT = float(os.getenv("UPSTREAM_SLOT_WAIT", "30"))
+BUSY = "I'm busy with other requests right now. Please try again in a moment."
+# How often each process deletes buckets idle long enough to be full again
+PRUNE_INTERVAL = 300
+
+
+class Rejected(Exception):
+    """The request was not admitted; str(e) is the reply, status 429 (throttled) or 503 (busy)."""
+
+    def __init__(self, message, status, retry_after):
+        super().__init__(message)
+        self.status = status
+        self.retry_after = retry_after
+
+
+class MemoryBuckets:
+    """Token buckets in this process's memory, for the local class."""
+
+    def __init__(self):
+        self._buckets = {}
+        self._lock = threading.Lock()
+
+    def take(self, key, rate, burst, now, count=1):
+        """(True, tokens left) after taking count tokens, or (False, tokens available) if there are fewer."""
+        with self._lock:
+            tokens, updated_at = self._buckets.get(key, (burst, now))
+            tokens = min(burst, tokens + (now - updated_at) * rate)
+            if tokens < count:
+                return False, tokens
+            self._buckets[key] = (tokens - count, now)
+            return True, tokens - count
+
+    def prune(self, cutoff):
+        with self._lock:
+            idle = [key for key, (_, updated_at) in self._buckets.items() if updated_at < cutoff]
+            for key in idle:
+                del self._buckets[key]
+        return len(idle)
+
+
+class Ticket:
+    """An admitted request; release() frees its upstream slot (safe to call more than once)."""
+
+    def __init__(self, cost_class, slot=None):
+        self.cost_class = cost_class
+        self._slot = slot
+
+    def release(self):
+        slot, self._slot = self._slot, None
+        if slot is not None:
+            try:
+                db.release_upstream_slot(slot)
+            except Exception as e:
+                # The lease expires it anyway
+                logger.error(f"Could not release upstream slot {slot}: {e}")
+
+
+class Admission:
+    def __init__(self, limits=LIMITS, concurrency=UPSTREAM_CONCURRENCY, lease=SLOT_LEASE, slot_wait=SLOT_WAIT):
+        self.limits = limits
+        self.concurrency = concurrency
+        self.lease = lease
+        self.slot_wait = slot_wait
+        self._stats = {"admitted": 0, "throttled": 0, "busy": 0}
+        self._lock = threading.Lock()
+        self._local = MemoryBuckets()
+        self._pruned_at = time.time()
+
+    def admit(self, user_id, cost_class, tokens=1):
+        """A Ticket for the request, or Rejected if the user's bucket holds fewer than tokens or no upstream slot is free."""
+        rate, burst = self.limits[cost_class]
+        key = f"{cost_class}:{user_id}"
+        now = time.time()
+        if tokens > burst:
+            self._count("throttled", cost_class, now)
+            raise Rejected(f"That needs {tokens} lookups, but at most {burst:g} can be made at once. "
+                           f"Please send fewer messages.", 429, max(1, math.ceil(burst / rate)))
+        if now - self._pruned_at > PRUNE_INTERVAL:
+            self._prune(now)
+        slot = None
+        try:
+            if cost_class == "local":
+                taken, available = self._local.take(key, rate, burst, now, tokens)
+                if not taken:
+                    raise self._throttled(tokens - available, rate)
+            else:
+                slot = self._take_upstream(key, rate, burst, now, tokens, with_slot=cost_class == "upstream")
+        except Rejected as e:
+            self._count("throttled" if e.status == 429 else "busy", cost_class, now)
+            raise
+        except sqlite3.Error as e:
+            # Fail open: a locked or broken database should not take the chat down with it
+            logger.error(f"Admission check failed, letting the request through: {e}")
+            return Ticket(cost_class)
+        self._count("admitted", cost_class, now)
+        return Ticket(cost_class, slot)
+
+    @db.offloaded
+    def _take_upstream(self, key, rate, burst, now, tokens, with_slot=True):
+        """Take the tokens and, with_slot, an upstream slot in one transaction; the id of the slot."""
+        with db.transaction() as conn:
+            if not db.take_token(key, rate, burst, now, tokens, conn):
+                raise self._throttled(tokens - db.bucket_tokens(key, rate, burst, now, conn), rate)
+            if not with_slot:
+                return None
+            slot = db.acquire_upstream_slot(self.concurrency, now, self.lease, conn)
+            if slot is None:
+                raise Rejected(BUSY, 503, 1)
+            return slot
+
+    @contextmanager
+    def upstream_slot(self):
+        """Hold one upstream slot for the block, waiting up to slot_wait seconds for one; Rejected (busy) if none frees up."""
+        started = time.time()
+        slot, delay = None, 0.05
+        while True:
+            try:
+                slot = self._acquire_slot(time.time())
+            except sqlite3.Error as e:
+                logger.error(f"Upstream slot check failed, letting the call through: {e}")
+                break
+            if slot is not None:
+                break
+            if time.time() - started >= self.slot_wait:
+                self._count("busy", "batch", started)
+                raise Rejected(BUSY, 503, 1)
+            time.sleep(delay)
+            delay = min(delay * 2, 1.0)
+        ticket = Ticket("upstream", slot)
+        try:
+            yield
+        finally:
+            ticket.release()
+
+    @db.offloaded
+    def _acquire_slot(self, now):
+        with db.transaction() as conn:
+            return db.acquire_upstream_slot(self.concurrency, now, self.lease, conn)
+
+    @staticmethod
+    def _throttled(missing, rate):
+        return Rejected("You're sending messages too quickly. Please wait a moment and try again.",
+                        429, max(1, math.ceil(missing / rate)))
+
+    def _count(self, outcome, cost_class, started):
+        with self._lock:
+            self._stats[outcome] += 1
+        metrics.observe("chatbot_admission_seconds", time.time() - started, cost_class=cost_class, outcome=outcome)
+
+    def _prune(self, now):
+        self._pruned_at = now
+        # A bucket untouched for burst / rate seconds is full, the same as having no row
+        idle = max(burst / rate for rate, burst in self.limits.values())
+        removed = self._local.prune(now - idle)
+        try:
+            removed += db.prune_rate_buckets(now - idle)
+            db.prune_upstream_slots(now - self.lease)
+        except sqlite3.Error as e:
+            # Only housekeeping; the next interval tries again
+            logger.warning(f"Could not prune admission tables: {e}")
+        logger.debug("Pruned %d idle rate buckets", removed)
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self._stats)
+        stats["upstream_in_flight"] = db.count_upstream_slots(time.time(), self.lease)
+        stats["upstream_limit"] = self.concurrency
+        return stats
@@ -0,0 +1,192 @@
+"""Cache of OpenAI answers, checked before process_query calls the model.
+
+Keys are normalized message text. A lookup first tries an exact match, then,
+if ANSWER_CACHE_SIMILARITY is set (off by default), the closest cached
+question from a SemanticIndex, so "what's a black hole" can reuse the answer
+to "what is a black hole?". A near hit must have the same content words in the
+same order, so "world war one" never gets the answer to "world war two". Entries
+expire after TTL seconds and the least recently used ones are evicted past
+MAX_ENTRIES. Each entry counts its hits, and stats() reports the totals.
+get_or_complete also coalesces misses: concurrent callers asking the same
+question wait for one model call instead of each making their own.
+
+With RESPONSE_CACHE_SHARED=1, exact matches are also stored in the
+response_cache table so every gunicorn worker can reuse them. Only successful
+model answers are cached; callers skip the cache entirely with bypass=True.
+"""
+import os
+import threading
+import time
+import logging
+from collections import OrderedDict
+
+import db
+import metrics
+from response_cache import SHARED
+from semantic_index import SemanticIndex, content_words
+
+logger = logging.getLogger(__name__)
+
+ENABLED = os.getenv("ANSWER_CACHE", "1") == "1"
+TTL = int(os.getenv("ANSWER_CACHE_TTL", "3600"))
+MAX_ENTRIES = int(os.getenv("ANSWER_CACHE_SIZE", "2048"))
+SIMILARITY = float(os.getenv("ANSWER_CACHE_SIMILARITY", "0"))
+NAMESPACE = "llm"
+
+
+class _Entry:
+    __slots__ = ("answer", "created_at", "hits")
+
+    def __init__(self, answer, created_at):
+        self.answer = answer
+        self.created_at = created_at
+        self.hits = 0
+
+
+class _Call:
+    def __init__(self):
+        self.event = threading.Event()
+        self.value = None
+        self.error = None
+
+
+class AnswerCache:
+    def __init__(self, ttl=TTL, max_entries=MAX_ENTRIES, similarity=SIMILARITY, shared=SHARED, enabled=ENABLED):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.similarity = similarity
+        self.shared = shared
+        self.enabled = enabled
+        self._entries = OrderedDict()
+        self._index = SemanticIndex(min_score=similarity)
+        self._inflight = {}
+        self._lock = threading.Lock()
+        self._stats = {"hits": 0, "near_hits": 0, "misses": 0, "coalesced": 0, "bypassed": 0, "stores": 0,
+                       "evictions": 0}
+
+    @staticmethod
+    def normalize(message):
+        return " ".join(message.lower().strip(" ?!.").split())
+
+    def get(self, message, bypass=False):
+        """Cached answer for message (exact, then near-duplicate), or None."""
+        if not self.enabled or bypass:
+            self._count("bypassed")
+            return None
+        key = self.normalize(message)
+        answer = self._lookup(key)
+        if answer is not None:
+            self._count("hits")
+            return answer
+        if self.similarity:
+            wanted = content_words(key)
+            for near_key, score in self._index.search(key, k=3):
+                # Same spelling is not the same question; only stopwords and punctuation may differ
+                if content_words(near_key) != wanted:
+                    continue
+                answer = self._lookup(near_key, shared=False)
+                if answer is not None:
+                    logger.debug("Answer cache near hit: %r ~ %r (%.2f)", key, near_key, score)
+                    self._count("near_hits")
+                    return answer
+        self._count("misses")
+        return None
+
+    def get_or_complete(self, message, complete, bypass=False):
+        """Cached answer for message, else complete(message), called once for every concurrent caller of the same key.
+
+        complete raises to signal an answer that must not be cached; the exception
+        is re-raised to every coalesced caller.
+        """
+        answer = self.get(message, bypass=bypass)
+        if answer is not None:
+            return answer
+        if not self.enabled or bypass:
+            return complete(message)
+        key = self.normalize(message)
+        with self._lock:
+            call = self._inflight.get(key)
+            leader = call is None
+            if leader:
+                call = self._inflight[key] = _Call()
+        if not leader:
+            self._count("coalesced")
+            call.event.wait()
+            if call.error is not None:
+                raise call.error
+            return call.value
+        try:
+            call.value = complete(message)
+            self.put(message, call.value)
+            return call.value
+        except BaseException as e:
+            call.error = e
+            raise
+        finally:
+            with self._lock:
+                del self._inflight[key]
+            call.event.set()
+
+    def _lookup(self, key, shared=True):
+        now = time.time()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry and now - entry.created_at < self.ttl:
+                entry.hits += 1
+                self._entries.move_to_end(key)
+                return entry.answer
+            if entry:
+                del self._entries[key]
+        if shared and self.shared:
+            cached = db.cache_get(NAMESPACE, key)
+            if cached and now - cached[1] < self.ttl:
+                self._store_local(key, *cached, hits=1)
+                return cached[0]
+        return None
+
+    def put(self, message, answer, bypass=False):
+        if not self.enabled or bypass or not answer:
+            return
+        key = self.normalize(message)
+        created_at = time.time()
+        self._store_local(key, answer, created_at)
+        self._count("stores")
+        if self.shared:
+            db.cache_put(NAMESPACE, key, answer, created_at)
+
+    def _store_local(self, key, answer, created_at, hits=0):
+        with self._lock:
+            is_new = key not in self._entries
+            entry = self._entries[key] = _Entry(answer, created_at)
+            entry.hits = hits
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+                self._stats["evictions"] += 1
+            # The index is append-only; rebuild it from live keys once evicted ones dominate
+            rebuild = len(self._index) > 2 * self.max_entries
+            keys = list(self._entries) if rebuild else None
+        if not self.similarity:
+            return
+        if rebuild:
+            index = SemanticIndex(min_score=self.similarity)
+            index.add(keys, keys)
+            self._index = index
+        elif is_new:
+            self._index.add([key], [key])
+
+    def _count(self, name):
+        with self._lock:
+            self._stats[name] += 1
+        metrics.mark("cache", namespace=NAMESPACE, outcome=name)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._index = SemanticIndex(min_score=self.similarity)
+
+    def stats(self, top=10):
+        with self._lock:
+            popular = sorted(self._entries.items(), key=lambda item: item[1].hits, reverse=True)[:top]
+            return {**self._stats, "enabled": self.enabled, "entries": len(self._entries),
+                    "top": [{"question": key, "hits": entry.hits} for key, entry in popular if entry.hits]}
@@ -1,31 +1,59 @@
-from flask import Flask, render_template, request, jsonify, session, redirect, url_for
-from werkzeug.security import generate_password_hash, check_password_hash
-from werkzeug.utils import secure_filename, safe_join
-import nltk
+from flask import Flask, render_template, request, jsonify, session, redirect, url_for, has_request_context, Response, stream_with_context, g, send_from_directory, abort
 import os
 import sqlite3
 from datetime import datetime
-import json
+import hashlib
+import html
 import re
 import logging
-from cryptography.fernet import Fernet
-from bs4 import BeautifulSoup
+import atexit
+import mimetypes
+import time
+from functools import wraps
+from concurrent.futures import ThreadPoolExecutor
+import click
 import requests
 from dotenv import load_dotenv
 
-# Initialize logging with detailed output
-logging.basicConfig(level=logging.DEBUG, filename='app.log', filemode='w')
+# Load environment variables before the local modules below read their settings at import time
+load_dotenv('.env', override=True)
+
+import admission
+import assets
+import auth
+import avatars
+import chat_archive
+import db
+import log_config
+import maintenance
+import metrics
+import outbound
+import request_log
+import write_behind
+import task_outbox
+import nlp
+import llm
+import knowledge_store
+import credential_store
+from knowledge_store import KnowledgeBase
+from answer_cache import AnswerCache
+from intent_router import IntentRouter
+from response_cache import TTLCache
+
+# Structured records written by a background thread; level, file and sampling come from the environment
+log_config.configure()
 logger = logging.getLogger(__name__)
 
-# Load environment variables
-load_dotenv('.env', override=True)
 API_KEY = os.getenv("WEATHER_API_KEY")
 OPENAI_API_KEY = os.getenv("OPENAI_API_KEY")
 NEWSAPI_KEY = os.getenv("NEWSAPI_KEY")
 ZAPIER_WEBHOOK_URL = os.getenv("ZAPIER_WEBHOOK_URL")
+# Overridable so benchmarks can point the integrations at a local stub server
+WEATHER_API_URL = os.getenv("WEATHER_API_URL", "http://api.weatherapi.com/v1/current.json")
+NEWS_API_URL = os.getenv("NEWS_API_URL", "https://newsapi.org/v2/everything")
 
-logger.debug(f"API_KEY: {API_KEY is not None}, OPENAI_API_KEY: {OPENAI_API_KEY is not None}, "
-             f"NEWSAPI_KEY: {NEWSAPI_KEY is not None}, ZAPIER_WEBHOOK_URL: {ZAPIER_WEBHOOK_URL is not None}")
+logger.debug("API_KEY: %s, OPENAI_API_KEY: %s, NEWSAPI_KEY: %s, ZAPIER_WEBHOOK_URL: %s", API_KEY is not None,
+             OPENAI_API_KEY is not None, NEWSAPI_KEY is not None, ZAPIER_WEBHOOK_URL is not None)
 if not API_KEY:
     logger.error("WEATHER_API_KEY is not set.")
 if not OPENAI_API_KEY:
@@ -35,44 +63,62 @@ if not NEWSAPI_KEY:
 if not ZAPIER_WEBHOOK_URL:
     logger.error("ZAPIER_WEBHOOK_URL is not set.")
 
-# Set up NLTK
-nltk_data_path = os.path.join(os.getcwd(), 'nltk_data')
-if not os.path.exists(nltk_data_path):
-    os.makedirs(nltk_data_path)
-nltk.data.path.append(nltk_data_path)
-try:
-    nltk.download('punkt', download_dir=nltk_data_path, quiet=True)
-    nltk.download('wordnet', download_dir=nltk_data_path, quiet=True)
-    nltk.download('averaged_perceptron_tagger', download_dir=nltk_data_path, quiet=True)
-except Exception as e:
-    logger.error(f"NLTK download failed: {e}")
-
-# Optional OpenAI import
-try:
-    import openai
-    openai.api_key = OPENAI_API_KEY
-    openai_available = bool(openai and OPENAI_API_KEY)
-except ImportError:
-    openai = None
-    openai_available = False
-    logger.warning("OpenAI module not found. AI features will use fallback responses.")
+# NLTK corpora are fetched by `flask --app app prepare` (see build.sh), not on every worker boot
+
+# OpenAI fallback goes through llm.py (plain HTTP on the shared outbound session, streamable)
+openai_available = llm.available()
 
 app = Flask(__name__, static_url_path='/static', static_folder='static')
-app.secret_key = os.urandom(24)
+# Must be the same in every worker or sessions only work on the worker that issued them
+app.secret_key = os.getenv('SECRET_KEY') or os.urandom(24)
 UPLOAD_FOLDER = os.path.join(app.static_folder, 'uploads')
 if not os.path.exists(UPLOAD_FOLDER):
     os.makedirs(UPLOAD_FOLDER)
 app.config['UPLOAD_FOLDER'] = UPLOAD_FOLDER
+# Fingerprinted css/js from `flask --app app build-assets`; templates fall back to /static/ without a build
+asset_manifest = assets.Manifest(app.static_folder)
+
+@app.template_global()
+def asset_url(path):
+    built = asset_manifest.built(path)
+    return url_for('asset', filename=built) if built else url_for('static', filename=path)
+
+@app.template_global()
+def avatar_url(profile_picture):
+    if not profile_picture:
+        return None
+    if profile_picture.startswith(avatars.SUBDIR + "/"):
+        return url_for('avatar', filename=profile_picture.split("/", 1)[1])
+    # Uploaded before thumbnails existed, stored as sent
+    return url_for('static', filename=f"uploads/{profile_picture}")
+
+class UpstreamError(Exception):
+    """An upstream lookup failed; str(e) is the reply for the user and the result is not cached."""
+
+# Weather and news answers keyed by normalized city/topic, with single-flight misses
+weather_cache = TTLCache("weather", ttl=int(os.getenv("WEATHER_CACHE_TTL", "600")))
+news_cache = TTLCache("news", ttl=int(os.getenv("NEWS_CACHE_TTL", "900")))
 
-# Knowledge base
-KNOWLEDGE_BASE_FILE = 'knowledge_base.json'
-if os.path.exists(KNOWLEDGE_BASE_FILE):
-    with open(KNOWLEDGE_BASE_FILE, 'r') as f:
-        knowledge_base = json.load(f)
-else:
-    knowledge_base = {}
-    with open(KNOWLEDGE_BASE_FILE, 'w') as f:
-        json.dump(knowledge_base, f)
+def fetch_weather(city):
+    url = f"{WEATHER_API_URL}?key={API_KEY}&q={city}&aqi=no"
+    response = outbound.get("weather", url)
+    if response.status_code == 200:
+        data = response.json()
+        return f"Current weather in {city}: {data['current']['temp_c']}°C, {data['current']['condition']['text']}."
+    logger.error(f"Weather API failed for {city}: {response.status_code}")
+    raise UpstreamError(f"Could not fetch weather for {city}. Try again later.")
+
+def fetch_news(topic):
+    url = f"{NEWS_API_URL}?q={topic}&apiKey={NEWSAPI_KEY}"
+    response = outbound.get("news", url)
+    if response.status_code == 200:
+        data = response.json()
+        if data.get("status") == "ok" and data.get("articles"):
+            article = data["articles"][0]
+            return f"Headline: {article['title']}\nSource: {article['source']['name']}\nURL: {article['url']}"
+        logger.error(f"NewsAPI failed for {topic}: {response.status_code}")
+        raise UpstreamError("Couldn’t fetch news.")
+    raise UpstreamError("Error fetching news. Check your connection.")
 
 def web_search(query):
     try:
@@ -82,17 +128,15 @@ def web_search(query):
             location = re.search(r"where (.*)\?", query) or re.search(r"in (.*)", query)
             if location:
                 city = location.group(1).strip()
-                url = f"http://api.weatherapi.com/v1/current.json?key={API_KEY}&q={city}&aqi=no"
-                response = requests.get(url, timeout=5)
-                if response.status_code == 200:
-                    data = response.json()
-                    return f"Current weather in {city}: {data['current']['temp_c']}°C, {data['current']['condition']['text']}."
-                logger.error(f"Weather API failed for {city}: {response.status_code}")
-                return f"Could not fetch weather for {city}. Try again later."
+                try:
+                    return weather_cache.get_or_fetch(city, lambda: fetch_weather(city))
+                except UpstreamError as e:
+                    return str(e)
             return "Please specify a city (e.g., 'weather in London')."
         elif "great wall of china" in query.lower():
             url = "https://en.wikipedia.org/wiki/Great_Wall_of_China"
-            response = requests.get(url, timeout=5)
+            response = outbound.get("wikipedia", url)
+            from bs4 import BeautifulSoup
             soup = BeautifulSoup(response.text, 'html.parser')
             paragraph = soup.find('p')
             return paragraph.text[:200] + "..." if paragraph else "The Great Wall of China is a historic fortification built to protect against invasions, stretching over 21,000 km."
@@ -105,235 +149,567 @@ def web_search(query):
         logger.error(f"Unexpected error in web_search: {e}")
         return "Error processing your request. Try again."
 
-def process_query(message):
-    logger.debug(f"Processing query: {message}")
+# Intents are tried in the order they are registered below; each handler gets the
+# lowercased message and the router's Match (intent names and KB categories found)
+router = IntentRouter()
+
+@router.intent("web_search", triggers=["weather", "great wall of china"])
+def handle_web_search(message, match):
+    return web_search(message)
+
+@router.intent("time", triggers=["time"])
+def handle_time(message, match):
+    return f"The current time is {datetime.now().strftime('%H:%M:%S')} on {datetime.now().strftime('%Y-%m-%d')}."
+
+@router.intent("knowledge", triggers=["?"])
+def handle_knowledge(message, match):
+    # Exact category substring first, then the closest paraphrase from the similarity index
+    category = match.categories[0] if match.categories else knowledge.search(message)
+    if category:
+        responses = knowledge.get(category)
+        return responses[0] if responses else "I’m learning about this. Provide more info!"
+    return "I don’t know yet. Tell me the answer, and I’ll learn it!"
+
+@router.intent("news", triggers=["news"])
+def handle_news(message, match):
+    topic = message.split("news")[1].strip()
+    if not NEWSAPI_KEY:
+        return "NewsAPI key not configured."
+    try:
+        return news_cache.get_or_fetch(topic, lambda: fetch_news(topic))
+    except UpstreamError as e:
+        return str(e)
+
+@router.intent("schedule", triggers=["schedule", "task"])
+def handle_schedule(message, match):
+    if not ZAPIER_WEBHOOK_URL:
+        return "Zapier webhook URL not configured."
+    task = message.replace("schedule", "").replace("task", "").strip() or "New task from chatbot"
+    payload = {"task": task, "date": "tomorrow"}
+    # Delivered to Zapier in the background by task_dispatcher; the reply does not wait for the webhook
+    user_id = session.get('user_id') if has_request_context() else None
+    job_id = task_outbox.enqueue(user_id, payload)
+    if task_dispatcher:
+        task_dispatcher.notify()
+    return f"Task '{task}' queued for Zapier (#{job_id}). Check /tasks for delivery status."
+
+@router.intent("greeting", triggers=["hi", "hello", "hey"])
+def handle_greeting(message, match):
+    return "Hello! How can I assist you today?"
+
+@router.intent("identity", triggers=["who are you", "what are you"])
+def handle_identity(message, match):
+    return "I’m a chatbot, built by harsha, designed to provide helpful answers."
+
+# Loaded from the knowledge table on first use and kept current by tailing it
+knowledge = KnowledgeBase(on_new_categories=router.add_categories)
+
+NO_LLM_RESPONSE = "I’m not sure how to respond. Try 'hi', 'weather in [city]', 'news about tech', or teach me something."
+
+def answer_locally(message):
+    """Everything process_query does short of the OpenAI call; None means only the LLM can answer."""
+    knowledge.refresh()
+    response = router.dispatch(message)
+    if response is not None:
+        return response
+    # Only the fallback branches need NLTK; tokens/tags are memoized per message
+    return answer_from_tags(message, nlp.pos_tag(message))
+
+def answer_from_tags(message, tagged):
+    """The NLTK fallback rules for a message no intent answered, given its POS tags."""
+    tokens = nlp.tokenize(message)
+    if any(word in ["help", "assist"] for word, pos in tagged if pos.startswith('VB')):
+        return "I can assist with weather, time, news, scheduling, or learn new things. Ask me anything!"
+    elif any(word in ["bye", "goodbye"] for word in tokens):
+        return "Goodbye! Return anytime."
+    elif any(pos in ['NN', 'NNS'] for _, pos in tagged):
+        return f"I see you mentioned {tokens[0]}. Provide more context or ask a question."
+    return None
+
+# OpenAI answers reused across users for identical or near-identical questions
+answer_cache = AnswerCache()
+
+def process_query(message, bypass_cache=False):
     if not message or not isinstance(message, str):
         return "Please provide a valid question!"
+    logger.debug("Processing query (%d chars)", len(message))
 
     try:
-        message = message.lower().strip()
-        tokens = nltk.word_tokenize(message)
-        tagged = nltk.pos_tag(tokens)
-
-        if "weather" in message:
-            return web_search(message)
-        elif "great wall of china" in message:
-            return web_search(message)
-        elif "time" in message:
-            return f"The current time is {datetime.now().strftime('%H:%M:%S')} on {datetime.now().strftime('%Y-%m-%d')}."
-        elif "?" in message:
-            for category, responses in knowledge_base.items():
-                if category in message:
-                    return responses[0] if responses else "I’m learning about this. Provide more info!"
-            if not any(cat in message for cat in knowledge_base.keys()):
-                return "I don’t know yet. Tell me the answer, and I’ll learn it!"
-
-        if "news" in message:
-            topic = message.split("news")[1].strip() if "news" in message else "general"
-            if not NEWSAPI_KEY:
-                return "NewsAPI key not configured."
-            url = f"https://newsapi.org/v2/everything?q={topic}&apiKey={NEWSAPI_KEY}"
-            response = requests.get(url, timeout=5)
-            if response.status_code == 200:
-                data = response.json()
-                if data.get("status") == "ok" and data.get("articles"):
-                    article = data["articles"][0]
-                    return f"Headline: {article['title']}\nSource: {article['source']['name']}\nURL: {article['url']}"
-                logger.error(f"NewsAPI failed for {topic}: {response.status_code}")
-                return "Couldn’t fetch news."
-            return "Error fetching news. Check your connection."
-
-        if "schedule" in message or "task" in message:
-            if not ZAPIER_WEBHOOK_URL:
-                return "Zapier webhook URL not configured."
-            task = message.replace("schedule", "").replace("task", "").strip() or "New task from chatbot"
-            payload = {"task": task, "date": "tomorrow"}
-            response = requests.post(ZAPIER_WEBHOOK_URL, json=payload, timeout=5)
-            if response.status_code == 200:
-                return f"Task '{task}' scheduled via Zapier!"
-            logger.error(f"Zapier API failed: {response.status_code}")
-            return "Failed to schedule task."
-
-        if any(word in message for word in ["hi", "hello", "hey"]):
-            return "Hello! How can I assist you today?"
-        elif any(word in message for word in ["who are you", "what are you"]):
-            return "I’m a chatbot, built by harsha, designed to provide helpful answers."
-        elif any(word in ["help", "assist"] for word, pos in tagged if pos.startswith('VB')):
-            return "I can assist with weather, time, news, scheduling, or learn new things. Ask me anything!"
-        elif any(word in ["bye", "goodbye"] for word in tokens):
-            return "Goodbye! Return anytime."
-        elif any(pos in ['NN', 'NNS'] for _, pos in tagged):
-            return f"I see you mentioned {tokens[0]}. Provide more context or ask a question."
-        else:
-            if openai and OPENAI_API_KEY:
-                try:
-                    response = openai.ChatCompletion.create(
-                        model="gpt-3.5-turbo",
-                        messages=[{"role": "user", "content": message}],
-                        max_tokens=150,
-                        temperature=0.7
-                    )
-                    return response.choices[0].message.content.strip()
-                except openai.error.OpenAIError as e:
-                    logger.error(f"OpenAI API error: {e}")
-                    return "OpenAI API error. Using fallback response."
-                except Exception as e:
-                    logger.error(f"Unexpected OpenAI error: {e}")
-                    return "OpenAI error. Using fallback response."
-            return "I’m not sure how to respond. Try 'hi', 'weather in [city]', 'news about tech', or teach me something."
-
+        message = nlp.normalize(message)
+        response = answer_locally(message)
+        if response is not None:
+            return response
+        return answer_with_llm(message, bypass_cache)
     except Exception as e:
         logger.error(f"Error in process_query: {e}")
         return "Error processing your request. Try again."
 
+def answer_with_llm(message, bypass_cache=False):
+    """The OpenAI fallback for a normalized message, through the answer cache."""
+    if not openai_available:
+        return NO_LLM_RESPONSE
+
+    def complete(message):
+        with metrics.timer("chatbot_stage_seconds", stage="openai"):
+            return llm.complete(message)
+
+    try:
+        # Users asking the same question at once share one completion
+        return answer_cache.get_or_complete(message, complete, bypass=bypass_cache)
+    except (llm.LLMError, requests.RequestException) as e:
+        logger.error(f"OpenAI API error: {e}")
+        return "OpenAI API error. Using fallback response."
+    except Exception as e:
+        logger.error(f"Unexpected OpenAI error: {e}")
+        return "OpenAI error. Using fallback response."
+
+BATCH_MAX_MESSAGES = int(os.getenv("BATCH_MAX_MESSAGES", "1000"))
+# Upstream-bound answers of a batch (weather/news lookups, OpenAI) run concurrently here
+batch_pool = ThreadPoolExecutor(max_workers=int(os.getenv("BATCH_CONCURRENCY", "8")), thread_name_prefix="batch")
+# Each of these messages gets its own answer even when identical (one queued task per message)
+SIDE_EFFECT_INTENTS = {"schedule"}
+
+def _answer_safely(func, *args):
+    try:
+        return func(*args)
+    except Exception as e:
+        logger.error(f"Error in process_batch: {e}")
+        return "Error processing your request. Try again."
+
+def _answer_upstream(func, *args):
+    # One upstream slot per concurrent call, so UPSTREAM_CONCURRENCY bounds batch work too
+    if admission_control is None:
+        return _answer_safely(func, *args)
+    try:
+        with admission_control.upstream_slot():
+            return _answer_safely(func, *args)
+    except admission.Rejected as e:
+        return str(e)
+
+def process_batch(messages, bypass_cache=False):
+    """process_query for many messages at once; the replies come back in the same order.
+
+    Identical messages are answered once, so a city or topic asked about twice is
+    looked up once (different phrasings of it still share the weather/news caches'
+    single fetch). Messages for the weather/news APIs and OpenAI run concurrently on
+    batch_pool, each holding an upstream slot while admission control is on, and
+    every message that reaches the NLTK fallback is tagged in one call.
+    """
+    replies = [None] * len(messages)
+    matches, groups = {}, {}
+    knowledge.refresh()
+    with metrics.timer("chatbot_stage_seconds", stage="intent_match"):
+        for i, message in enumerate(messages):
+            if not message or not isinstance(message, str):
+                replies[i] = "Please provide a valid question!"
+                continue
+            text = nlp.normalize(message)
+            if text not in matches:
+                matches[text] = router.match(text)
+            groups.setdefault((text, i) if matches[text].intents & SIDE_EFFECT_INTENTS else (text, None), []).append(i)
+    answers, futures = {}, {}
+    for key in groups:
+        match = matches[key[0]]
+        if match.intents & UPSTREAM_INTENTS:
+            futures[key] = batch_pool.submit(_answer_upstream, router.dispatch, key[0], match)
+        elif match.intents:
+            answers[key] = _answer_safely(router.dispatch, key[0], match)
+    fallback = [key for key in groups if key not in futures and answers.get(key) is None]
+    try:
+        tagged = nlp.pos_tag_many([text for text, _ in fallback])
+    except Exception as e:
+        logger.error(f"Error tagging batch: {e}")
+        tagged = [None] * len(fallback)
+    for key, tags in zip(fallback, tagged):
+        answers[key] = "Error processing your request. Try again." if tags is None else \
+            _answer_safely(answer_from_tags, key[0], tags)
+        if answers[key] is None:
+            futures[key] = batch_pool.submit(_answer_upstream, answer_with_llm, key[0], bypass_cache)
+    for key, future in futures.items():
+        # An upstream intent that declined to answer goes through the rest of process_query on its own
+        answers[key] = future.result() or process_query(key[0], bypass_cache)
+    for key, indexes in groups.items():
+        for i in indexes:
+            replies[i] = answers[key]
+    return replies
+
+def answer_batch(user_id, chat_id, messages, bypass_cache=False):
+    """Answer a user's messages in order and save every turn in one transaction; returns (replies, current chat_id).
+
+    As with /get_response_route, a "new chat" message starts a new chat for the messages after it.
+    """
+    new_chat = [isinstance(message, str) and "new chat" in message.lower() for message in messages]
+    answers = iter(process_batch([message for message, new in zip(messages, new_chat) if not new], bypass_cache))
+    timestamp = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+    replies, rows = [], []
+    for message, new in zip(messages, new_chat):
+        if new:
+            chat_id = f"chat_{user_id}_{datetime.now().strftime('%Y_%m_%dT%H_%M_%S_%fZ').rstrip('0').rstrip('.')}"
+            replies.append("New chat started!")
+            rows.append((user_id, chat_id, "New chat started!", False, timestamp))
+            continue
+        reply = next(answers)
+        replies.append(reply)
+        rows += [(user_id, chat_id, message, True, timestamp), (user_id, chat_id, reply, False, timestamp)]
+    db.insert_messages(rows)
+    return replies, chat_id
+
 def save_learned_knowledge(question, answer):
     category = re.sub(r'\W+', '_', question.split('?')[0].strip())
-    if category not in knowledge_base:
-        knowledge_base[category] = []
-    knowledge_base[category].append(answer)
-    with open(KNOWLEDGE_BASE_FILE, 'w') as f:
-        json.dump(knowledge_base, f)
+    knowledge.add(category, answer)
     return "Thank you! I’ve learned: " + answer
 
 def init_db():
-    conn = sqlite3.connect('chat_history.db', check_same_thread=False)
-    c = conn.cursor()
-    # Create the users table with initial columns
-    c.execute('''CREATE TABLE IF NOT EXISTS users
-                 (id INTEGER PRIMARY KEY, username TEXT UNIQUE, password TEXT, name TEXT, email TEXT)''')
-    # Add new columns if they don't exist (migration logic)
-    c.execute("PRAGMA table_info(users)")
-    columns = [row[1] for row in c.fetchall()]
-    if 'two_factor_enabled' not in columns:
-        c.execute("ALTER TABLE users ADD COLUMN two_factor_enabled INTEGER DEFAULT 0")
-    if 'email_notifications' not in columns:
-        c.execute("ALTER TABLE users ADD COLUMN email_notifications INTEGER DEFAULT 1")
-    if 'sms_notifications' not in columns:
-        c.execute("ALTER TABLE users ADD COLUMN sms_notifications INTEGER DEFAULT 0")
-    if 'security_question1' not in columns:
-        c.execute("ALTER TABLE users ADD COLUMN security_question1 TEXT")
-    if 'security_answer1' not in columns:
-        c.execute("ALTER TABLE users ADD COLUMN security_answer1 TEXT")
-    if 'security_question2' not in columns:
-        c.execute("ALTER TABLE users ADD COLUMN security_question2 TEXT")
-    if 'security_answer2' not in columns:
-        c.execute("ALTER TABLE users ADD COLUMN security_answer2 TEXT")
-    if 'profile_picture' not in columns:
-        c.execute("ALTER TABLE users ADD COLUMN profile_picture TEXT")
-    # Create the chats table
-    c.execute('''CREATE TABLE IF NOT EXISTS chats
-                 (id INTEGER PRIMARY KEY, user_id TEXT, chat_id TEXT, message TEXT, is_user INTEGER, timestamp TEXT)''')
-    # Check and migrate old chat_id formats or handle potential data loss
-    c.execute("SELECT chat_id, user_id FROM chats")
-    migration_count = 0
-    for row in c.fetchall():
-        old_chat_id, user_id = row
-        # Check for old format (e.g., with hyphens and no T) or date mismatch
-        if '-' in old_chat_id and 'T' not in old_chat_id:
+    # A single version lookup when the schema is already current, so worker boot skips the migration scan
+    if db.get_schema_version() >= db.SCHEMA_VERSION:
+        logger.debug("Schema is up to date, skipping migrations.")
+        return
+    with db.transaction() as conn:
+        c = conn.cursor()
+        # Re-check under the write lock in case another worker migrated first
+        if db.get_schema_version(conn) >= db.SCHEMA_VERSION:
+            return
+        # Create the users table with initial columns
+        c.execute('''CREATE TABLE IF NOT EXISTS users
+                     (id INTEGER PRIMARY KEY, username TEXT UNIQUE, password TEXT, name TEXT, email TEXT)''')
+        # Add new columns if they don't exist (migration logic)
+        c.execute("PRAGMA table_info(users)")
+        columns = [row[1] for row in c.fetchall()]
+        if 'two_factor_enabled' not in columns:
+            c.execute("ALTER TABLE users ADD COLUMN two_factor_enabled INTEGER DEFAULT 0")
+        if 'email_notifications' not in columns:
+            c.execute("ALTER TABLE users ADD COLUMN email_notifications INTEGER DEFAULT 1")
+        if 'sms_notifications' not in columns:
+            c.execute("ALTER TABLE users ADD COLUMN sms_notifications INTEGER DEFAULT 0")
+        if 'security_question1' not in columns:
+            c.execute("ALTER TABLE users ADD COLUMN security_question1 TEXT")
+        if 'security_answer1' not in columns:
+            c.execute("ALTER TABLE users ADD COLUMN security_answer1 TEXT")
+        if 'security_question2' not in columns:
+            c.execute("ALTER TABLE users ADD COLUMN security_question2 TEXT")
+        if 'security_answer2' not in columns:
+            c.execute("ALTER TABLE users ADD COLUMN security_answer2 TEXT")
+        if 'profile_picture' not in columns:
+            c.execute("ALTER TABLE users ADD COLUMN profile_picture TEXT")
+        if 'retention_days' not in columns:
+            c.execute("ALTER TABLE users ADD COLUMN retention_days INTEGER")
+        # Create the chats table
+        c.execute('''CREATE TABLE IF NOT EXISTS chats
+                     (id INTEGER PRIMARY KEY, user_id TEXT, chat_id TEXT, message TEXT, is_user INTEGER, timestamp TEXT)''')
+        # Migrate old chat_id formats (with hyphens and no T); instr() is case-sensitive unlike LIKE
+        c.execute("SELECT DISTINCT chat_id, user_id FROM chats WHERE instr(chat_id, '-') > 0 AND instr(chat_id, 'T') = 0")
+        migration_count = 0
+        for old_chat_id, user_id in c.fetchall():
             new_chat_id = f"chat_{user_id}_{datetime.strptime(old_chat_id.replace('chat_', ''), '%Y-%m-%d_%H%M%S').strftime('%Y_%m_%dT%H_%M_%S_%fZ').rstrip('0').rstrip('.')}"
             c.execute("UPDATE chats SET chat_id = ? WHERE chat_id = ?", (new_chat_id, old_chat_id))
-            logger.debug(f"Migrated chat_id from {old_chat_id} to {new_chat_id}")
+            logger.debug("Migrated chat_id from %s to %s", old_chat_id, new_chat_id)
             migration_count += 1
-        # Log existing chat_ids for debugging
-        logger.debug(f"Existing chat_id: {old_chat_id}")
-    if migration_count == 0:
-        logger.debug("No chat_id migrations needed.")
-    else:
-        conn.commit()
-    conn.close()
-
-init_db()
-
-def get_user(username):
-    conn = sqlite3.connect('chat_history.db', check_same_thread=False)
-    c = conn.cursor()
-    c.execute("SELECT * FROM users WHERE username = ?", (username,))
-    row = c.fetchone()
-    conn.close()
-    if row:
-        columns = ['id', 'username', 'password', 'name', 'email', 'two_factor_enabled', 'email_notifications',
-                   'sms_notifications', 'security_question1', 'security_answer1', 'security_question2',
-                   'security_answer2', 'profile_picture']
-        return dict(zip(columns, row))
-    return None
+        if migration_count == 0:
+            logger.debug("No chat_id migrations needed.")
+        # Indexes and the chat_sessions summary table; rebuilt if chat_ids were rewritten above
+        db.migrate_chat_indexes(conn, rebuild=migration_count > 0)
+        # Shared weather/news cache (used when RESPONSE_CACHE_SHARED=1)
+        c.execute(db.RESPONSE_CACHE_SCHEMA)
+        # Outbox for Zapier task deliveries
+        for statement in db.TASK_OUTBOX_SCHEMA:
+            c.execute(statement)
+        # Latency histograms shared by all workers
+        for statement in db.METRICS_SCHEMA:
+            c.execute(statement)
+        # Append-only knowledge base, seeded once from the legacy knowledge_base.json
+        for statement in db.KNOWLEDGE_SCHEMA:
+            c.execute(statement)
+        knowledge_store.import_seed(conn)
+        # Per-user encrypted profile records, replacing the shared credentials.enc
+        c.execute(db.CREDENTIALS_SCHEMA)
+        credential_store.import_legacy(conn)
+        # Rows encrypted with the committed key.key move to the untracked key
+        credential_store.rekey_legacy(conn)
+        # Full-text index over chat messages, kept in sync by triggers on chats
+        db.migrate_chats_fts(conn)
+        # Rate-limit buckets and upstream slots shared by all workers
+        for statement in db.ADMISSION_SCHEMA:
+            c.execute(statement)
+        # Index of archived chats and the maintenance schedule
+        for statement in db.CHAT_ARCHIVE_SCHEMA:
+            c.execute(statement)
+        db.set_schema_version(conn, db.SCHEMA_VERSION)
+        logger.debug("Migrated schema to version %s", db.SCHEMA_VERSION)
+    # Only once the import and re-encryption above have committed
+    credential_store.retire_legacy_files()
 
-def encrypt_credentials(username, password, name=None, email=None, two_factor_enabled=None, email_notifications=None, 
-                       sms_notifications=None, security_question1=None, security_answer1=None, 
-                       security_question2=None, security_answer2=None, profile_picture=None):
-    key = Fernet.generate_key()
-    cipher_suite = Fernet(key)
-    credentials = {
-        "username": username, "password": password, "name": name, "email": email,
-        "two_factor_enabled": two_factor_enabled, "email_notifications": email_notifications,
-        "sms_notifications": sms_notifications, "security_question1": security_question1,
-        "security_answer1": security_answer1, "security_question2": security_question2,
-        "security_answer2": security_answer2, "profile_picture": profile_picture
-    }
-    encrypted_data = cipher_suite.encrypt(json.dumps(credentials).encode())
-    with open('credentials.enc', 'wb') as f:
-        f.write(encrypted_data)
-    with open('key.key', 'wb') as f:
-        f.write(key)
-
-def decrypt_credentials():
-    if not os.path.exists('credentials.enc') or not os.path.exists('key.key'):
-        return {}
-    try:
-        with open('key.key', 'rb') as f:
-            key = f.read()
-        with open('credentials.enc', 'rb') as f:
-            encrypted_data = f.read()
-        return json.loads(Fernet(key).decrypt(encrypted_data).decode())
-    except Exception as e:
-        logger.error(f"Decryption error: {e}")
-        return {}
+write_queue = None
+task_dispatcher = None
+metrics_flusher = None
+request_recorder = None
+maintenance_scheduler = None
+
+def create_app():
+    """Per-worker startup: schema check, credentials key, write-behind queue, task dispatcher, metrics flusher and maintenance scheduler. No network access."""
+    global write_queue, task_dispatcher, metrics_flusher, request_recorder, maintenance_scheduler
+    # A no-op unless this process was forked after import (gunicorn --preload), which needs its own listener
+    log_config.configure()
+    init_db()
+    atexit.register(db.close_all)
+    # Read the credentials key now rather than inside the first register/settings request
+    credential_store.cipher()
+    # Optional write-behind queue for chat turns (CHAT_WRITE_BEHIND=1); drained before the pool closes
+    if write_behind.ENABLED and write_queue is None:
+        write_queue = write_behind.WriteBehindQueue()
+        atexit.register(write_queue.close)
+    # Background delivery of queued Zapier tasks (TASK_DISPATCHER=0 to run it elsewhere, e.g. `flask dispatch-tasks`)
+    if task_outbox.ENABLED and ZAPIER_WEBHOOK_URL and task_dispatcher is None:
+        task_dispatcher = task_outbox.TaskDispatcher(ZAPIER_WEBHOOK_URL).start()
+        atexit.register(task_dispatcher.close)
+    # Pushes this worker's latency samples to the shared metrics table behind /metrics
+    if metrics.ENABLED and metrics.SHARED and metrics_flusher is None:
+        metrics_flusher = metrics.Flusher().start()
+        atexit.register(metrics_flusher.close)
+    # Chat requests captured for `benchmark.py replay` (REQUEST_LOG=1), one file per worker
+    if request_log.ENABLED and request_recorder is None:
+        request_recorder = request_log.RequestLog().start()
+        atexit.register(request_recorder.close)
+    # Retention, archival and vacuum in-process (MAINTENANCE=1); by default cron runs `flask --app app maintain`
+    if maintenance.ENABLED and maintenance_scheduler is None:
+        maintenance_scheduler = maintenance.Scheduler().start()
+        atexit.register(maintenance_scheduler.close)
+    return app
+
+# Password hashing policy (PASSWORD_HASH_METHOD) and recently read user rows
+password_hasher = auth.PasswordHasher()
+user_cache = auth.UserCache()
+
+def get_user(username, fresh=False):
+    """User row; fresh=True always reads the database (password checks, username availability)."""
+    if fresh:
+        user = db.fetch_user(username)
+        if user is not None:
+            user_cache.put(username, user)
+        return user
+    # Set by settings, so a worker still holding the pre-update row refetches it
+    changed_at = session.get('user_changed_at', 0) if has_request_context() else 0
+    return user_cache.get(username, db.fetch_user, changed_at)
 
 def save_message(user_id, message, is_user, chat_id=None):
     if chat_id is None:
         chat_id = f"chat_{user_id}_{datetime.now().strftime('%Y_%m_%dT%H_%M_%S_%fZ').rstrip('0').rstrip('.')}"
-    conn = sqlite3.connect('chat_history.db', check_same_thread=False)
-    c = conn.cursor()
     timestamp = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
     try:
-        c.execute("INSERT INTO chats (user_id, chat_id, message, is_user, timestamp) VALUES (?, ?, ?, ?, ?)",
-                  (user_id, chat_id, message, is_user, timestamp))
-        conn.commit()
-        logger.debug(f"Successfully saved message for chat_id: {chat_id}, user_id: {user_id}")
+        db.insert_message(user_id, chat_id, message, is_user, timestamp)
+        logger.debug("Successfully saved message for chat_id: %s, user_id: %s", chat_id, user_id)
     except sqlite3.Error as e:
         logger.error(f"Database error in save_message for chat_id {chat_id}: {e}")
         raise
-    finally:
-        conn.close()
     return chat_id
 
-def get_chat_history(user_id, chat_id):
-    conn = sqlite3.connect('chat_history.db', check_same_thread=False)
-    c = conn.cursor()
-    c.execute("SELECT timestamp, message, is_user FROM chats WHERE user_id = ? AND chat_id = ? ORDER BY timestamp ASC",
-              (user_id, chat_id))
-    history = [{"timestamp": row[0], "message": row[1], "isUser": bool(row[2])} for row in c.fetchall()]
-    conn.close()
-    return history
+def save_turn(user_id, chat_id, user_message, response):
+    timestamp = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+    try:
+        if write_queue:
+            write_queue.submit_turn(user_id, chat_id, user_message, response, timestamp)
+        else:
+            db.insert_turn(user_id, chat_id, user_message, response, timestamp)
+        logger.debug("Successfully saved turn for chat_id: %s, user_id: %s", chat_id, user_id)
+    except sqlite3.Error as e:
+        logger.error(f"Database error in save_turn for chat_id {chat_id}: {e}")
+        raise
+    return chat_id
+
+HISTORY_PAGE_SIZE = 50
+HISTORY_MAX_PAGE_SIZE = 200
+
+def get_chat_history(user_id, chat_id, before=None, since=None, limit=HISTORY_PAGE_SIZE):
+    """One page of a chat, oldest first, plus whether there is more beyond it (see db.fetch_history_page).
+
+    Scrolling back past the oldest live message continues into the chat's archived part, if it has one.
+    """
+    limit = max(1, min(limit, HISTORY_MAX_PAGE_SIZE))
+    history, has_more = db.fetch_history_page(user_id, chat_id, limit, before=before, since=since)
+    if has_more or since is not None:
+        return history, has_more
+    older, has_more = chat_archive.history_page(user_id, chat_id, limit - len(history),
+                                                before=history[0]["id"] if history else before)
+    return older + history, has_more
+
+SEARCH_PAGE_SIZE = 20
+SEARCH_MAX_PAGE_SIZE = 100
+
+def search_chats(user_id, text, limit=SEARCH_PAGE_SIZE, offset=0):
+    """Ranked snippets of the user's messages matching text; matched words are wrapped in <mark>, the rest escaped."""
+    results, has_more = db.search_chats(user_id, text, max(1, min(limit, SEARCH_MAX_PAGE_SIZE)), max(0, offset))
+    for result in results:
+        result["snippet"] = (html.escape(result["snippet"]).replace(db.SNIPPET_START, "<mark>")
+                             .replace(db.SNIPPET_END, "</mark>"))
+    return results, has_more
 
 def delete_chat(user_id, chat_id):
-    conn = sqlite3.connect('chat_history.db', check_same_thread=False)
-    c = conn.cursor()
     try:
-        # Check if the chat exists for the user
-        c.execute("SELECT COUNT(*) FROM chats WHERE user_id = ? AND chat_id = ?", (user_id, chat_id))
-        count = c.fetchone()[0]
-        logger.debug(f"Chat {chat_id} count for user {user_id}: {count}")
+        count = db.delete_chat(user_id, chat_id)
+        logger.debug("Chat %s count for user %s: %s", chat_id, user_id, count)
         if count == 0:
             return {"status": "Error", "message": f"Chat {chat_id} not found for user {user_id}"}
-        c.execute("DELETE FROM chats WHERE user_id = ? AND chat_id = ?", (user_id, chat_id))
-        conn.commit()
-        logger.debug(f"Deleted chat {chat_id} for user {user_id}")
+        logger.debug("Deleted chat %s for user %s", chat_id, user_id)
         return {"status": "OK", "message": f"Chat {chat_id} deleted"}
     except sqlite3.Error as e:
         logger.error(f"Database error in delete_chat for chat_id {chat_id}: {e}")
         return {"status": "Error", "message": str(e)}
-    finally:
-        conn.close()
+
+@app.before_request
+def start_request_timer():
+    g.request_start = time.perf_counter()
+
+@app.after_request
+def record_request_latency(response):
+    # For streamed replies this is time to first byte; the body is still being generated
+    if 'request_start' in g:
+        metrics.observe("chatbot_request_seconds", time.perf_counter() - g.request_start,
+                        endpoint=request.endpoint or "unknown", status=response.status_code)
+    return response
+
+def captured(view):
+    """Append one request_log record per call of view while capture is on.
+
+    A streamed reply is recorded when its generator closes, with the bytes sent
+    and the latency up to then, so it covers the whole stream.
+    """
+    @wraps(view)
+    def wrapper(*args, **kwargs):
+        # A captured view calling another one (/get_response_stream on "new chat") is one request
+        if request_recorder is None or g.get("captured"):
+            return view(*args, **kwargs)
+        g.captured = True
+        start = time.perf_counter()
+        if request.is_json:
+            body = request.get_json(silent=True)
+            body = body if isinstance(body, dict) else {}
+            message, no_cache = body.get("messages"), bool(body.get("noCache"))
+        else:
+            message, no_cache = request.form.get("message"), request.form.get("noCache") == "1"
+        user_id, endpoint = session.get('user_id'), request.endpoint
+        with metrics.trace() as samples:
+            response = app.make_response(view(*args, **kwargs))
+
+        def record(response_bytes):
+            request_recorder.write(request_log.build_record(
+                message, user_id, response.status_code, time.perf_counter() - start, samples,
+                response_bytes=response_bytes, no_cache=no_cache, endpoint=endpoint))
+
+        if not response.is_streamed:
+            record(response.content_length or 0)
+            return response
+        chunks = response.response
+
+        def recorded():
+            sent = 0
+            try:
+                with metrics.trace() as stream_samples:
+                    try:
+                        for chunk in chunks:
+                            sent += len(chunk.encode() if isinstance(chunk, str) else chunk)
+                            yield chunk
+                    finally:
+                        # Closing it here runs the view's own cleanup (saving the turn) inside the trace
+                        if hasattr(chunks, "close"):
+                            chunks.close()
+            finally:
+                samples.extend(stream_samples)
+                record(sent)
+
+        response.response = recorded()
+        return response
+    return wrapper
+
+# Intents whose handlers call an external API; a message no intent answers may go to OpenAI
+UPSTREAM_INTENTS = {"web_search", "news"}
+admission_control = admission.Admission() if admission.ENABLED else None
+
+def cost_class(message):
+    """'upstream' if answering message may call the weather/news APIs or OpenAI, else 'local'."""
+    message = nlp.normalize(message)
+    if "new chat" in message:
+        return "local"
+    intents = router.match(message).intents
+    if intents & UPSTREAM_INTENTS:
+        return "upstream"
+    return "local" if intents or not openai_available else "upstream"
+
+def request_cost():
+    """(cost class, tokens) of the chat request being handled, or None if it carries no message.
+
+    A batch costs one token from its own "batch" bucket per distinct message that
+    may go upstream (process_batch answers repeats once), or one local token if
+    none may. It holds no upstream slot; process_batch takes one per call.
+    """
+    if request.is_json:
+        body = request.get_json(silent=True)
+        messages = body.get("messages") if isinstance(body, dict) else None
+        # Malformed and oversized batches are refused by the view without any work
+        if not messages or not isinstance(messages, list) or len(messages) > BATCH_MAX_MESSAGES:
+            return None
+        texts = {nlp.normalize(message) for message in messages if isinstance(message, str) and message}
+        upstream = sum(cost_class(text) == "upstream" for text in texts)
+        return ("batch", upstream) if upstream else ("local", 1)
+    message = request.form.get("message")
+    return (cost_class(message), 1) if message else None
+
+def admitted(view):
+    """Run view only if the user's rate limits and the upstream slots allow it (see admission.py)."""
+    @wraps(view)
+    def wrapper(*args, **kwargs):
+        # Once per request: get_response_stream hands "new chat" to get_response_route
+        if admission_control is None or not session.get('logged_in') or 'admission_ticket' in g:
+            return view(*args, **kwargs)
+        cost = request_cost()
+        if cost is None:
+            return view(*args, **kwargs)
+        try:
+            ticket = g.admission_ticket = admission_control.admit(session.get('user_id'), *cost)
+        except admission.Rejected as e:
+            response = app.make_response((str(e), e.status))
+            response.retry_after = e.retry_after
+            return response
+        try:
+            response = app.make_response(view(*args, **kwargs))
+        except BaseException:
+            ticket.release()
+            raise
+        # A streamed reply keeps calling upstream after the view returns
+        if response.is_streamed:
+            response.call_on_close(ticket.release)
+        else:
+            ticket.release()
+        return response
+    return wrapper
+
+@app.route("/metrics")
+def metrics_route():
+    return Response(metrics.render(), mimetype="text/plain; version=0.0.4")
+
+def _immutable(response):
+    # The URL changes whenever the content does, so the browser never needs to revalidate
+    response.cache_control.public = True
+    response.cache_control.immutable = True
+    return response
+
+@app.route("/assets/<path:filename>")
+def asset(filename):
+    variant = asset_manifest.variant(filename, request.accept_encodings)
+    if variant is None:
+        abort(404)
+    path, encoding, etag = variant
+    response = send_from_directory(asset_manifest.dist, path, mimetype=mimetypes.guess_type(filename)[0],
+                                   download_name=os.path.basename(filename), etag=etag, max_age=assets.MAX_AGE)
+    if encoding:
+        response.headers["Content-Encoding"] = encoding
+    response.vary.add("Accept-Encoding")
+    return _immutable(response)
+
+@app.route("/uploads/avatars/<filename>")
+def avatar(filename):
+    # Thumbnails are named by the hash of their content (see avatars.py)
+    response = send_from_directory(os.path.join(app.config['UPLOAD_FOLDER'], avatars.SUBDIR), filename,
+                                   etag=os.path.splitext(filename)[0], max_age=assets.MAX_AGE)
+    return _immutable(response)
 
 @app.route("/")
 def home():
@@ -349,29 +725,32 @@ def home():
     if not current_chat_id:
         current_chat_id = f"chat_{user_id}_{datetime.now().strftime('%Y_%m_%dT%H_%M_%S_%fZ').rstrip('0').rstrip('.')}"
         session['current_chat_id'] = current_chat_id
-    history = get_chat_history(user_id, current_chat_id)
-    conn = sqlite3.connect('chat_history.db', check_same_thread=False)
-    c = conn.cursor()
-    c.execute("SELECT DISTINCT chat_id FROM chats WHERE user_id = ? ORDER BY timestamp DESC", (user_id,))
-    chat_ids = [row[0] for row in c.fetchall()]
-    conn.close()
-    logger.debug(f"Rendering index.html for user: {user_id}, current_chat_id: {current_chat_id}")
-    return render_template("index.html", logged_in=True, user_id=user_id, current_chat_id=current_chat_id, history=history, chatIds=chat_ids, openai_available=openai_available)
+    # Only the newest page is rendered; older messages load as the user scrolls up
+    history, has_more = get_chat_history(user_id, current_chat_id)
+    chat_ids = db.list_chat_ids(user_id)
+    logger.debug("Rendering index.html for user: %s, current_chat_id: %s", user_id, current_chat_id)
+    user = get_user(user_id)
+    return render_template("index.html", logged_in=True, user_id=user_id, current_chat_id=current_chat_id, history=history, has_more=has_more, chatIds=chat_ids, openai_available=openai_available,
+                           avatar=avatar_url(user.get('profile_picture') if user else None))
 
 @app.route("/login", methods=["GET", "POST"])
 def login():
-    logger.debug(f"Accessing login route, method: {request.method}")
+    logger.debug("Accessing login route, method: %s", request.method)
     if request.method == "POST":
         username = request.form.get("username")
         password = request.form.get("password")
-        logger.debug(f"Login attempt for username: {username}")
-        user = get_user(username)
-        if user and check_password_hash(user['password'], password):
+        logger.debug("Login attempt for username: %s", username)
+        user = get_user(username, fresh=True)
+        if user and password_hasher.verify(user['password'], password):
+            if password_hasher.needs_rehash(user['password']):
+                # The hashing policy changed since this password was set; upgrade it while we have it in clear
+                db.update_password(username, password_hasher.hash(password))
+                user_cache.invalidate(username)
+                logger.debug("Rehashed password for user: %s", username)
             session['logged_in'] = True
             session['user_id'] = username
             session['current_chat_id'] = f"chat_{username}_{datetime.now().strftime('%Y_%m_%dT%H_%M_%S_%fZ').rstrip('0').rstrip('.')}"
-            encrypt_credentials(username, password, user['name'], user['email'], user['two_factor_enabled'], user['email_notifications'], user['sms_notifications'], user['security_question1'], user['security_answer1'], user['security_question2'], user['security_answer2'], user['profile_picture'])
-            logger.debug(f"Successful login for user: {username}")
+            logger.debug("Successful login for user: %s", username)
             return redirect(url_for('home'))
         logger.debug("Login failed: Invalid username or password")
         return render_template("login.html", error="Invalid username or password")
@@ -389,33 +768,30 @@ def logout():
 
 @app.route("/register", methods=["GET", "POST"])
 def register():
-    logger.debug(f"Accessing register route, method: {request.method}")
+    logger.debug("Accessing register route, method: %s", request.method)
     if request.method == "POST":
         username = request.form.get("username")
         password = request.form.get("password")
         name = request.form.get("name")
         email = request.form.get("email")
-        logger.debug(f"Registration attempt for username: {username}")
+        logger.debug("Registration attempt for username: %s", username)
         if len(password) < 6:
             logger.debug("Registration failed: Password too short")
             return render_template("register.html", error="Password must be at least 6 characters")
-        if get_user(username):
+        if get_user(username, fresh=True):
             logger.debug("Registration failed: Username already exists")
             return render_template("register.html", error="Username already exists")
-        hashed_password = generate_password_hash(password)
-        conn = sqlite3.connect('chat_history.db', check_same_thread=False)
-        c = conn.cursor()
-        c.execute("INSERT INTO users (username, password, name, email) VALUES (?, ?, ?, ?)",
-                  (username, hashed_password, name, email))
-        conn.commit()
-        conn.close()
-        encrypt_credentials(username, password, name, email)
-        logger.debug(f"Successful registration for user: {username}")
+        hashed_password = password_hasher.hash(password)
+        db.create_user(username, hashed_password, name, email)
+        credential_store.save(username, name=name, email=email)
+        logger.debug("Successful registration for user: %s", username)
         return redirect(url_for('login'))
     logger.debug("Rendering register page")
     return render_template("register.html")
 
 @app.route("/get_response_route", methods=["POST"])
+@captured
+@admitted
 def get_response_route():
     logger.debug("Accessing get_response route")
     if not session.get('logged_in'):
@@ -425,26 +801,131 @@ def get_response_route():
         user_message = request.form.get("message")
         user_id = session.get('user_id')
         chat_id = request.form.get("chatId") or session.get('current_chat_id', f"chat_{user_id}_{datetime.now().strftime('%Y_%m_%dT%H_%M_%S_%fZ').rstrip('0').rstrip('.')}")
-        logger.debug(f"Processing message: {user_message} for user: {user_id}, chat_id: {chat_id}")
+        logger.debug("Processing message (%d chars) for user: %s, chat_id: %s", len(user_message or ""), user_id, chat_id)
         if not user_message:
             logger.debug("No message provided")
             return "No message provided"
         if "new chat" in user_message.lower():
             chat_id = f"chat_{user_id}_{datetime.now().strftime('%Y_%m_%dT%H_%M_%S_%fZ').rstrip('0').rstrip('.')}"
             session['current_chat_id'] = chat_id
-            logger.debug(f"New chat started, chat_id: {chat_id}")
+            logger.debug("New chat started, chat_id: %s", chat_id)
             save_message(user_id, "New chat started!", False, chat_id)
             return "New chat started!"
-        response = process_query(user_message)
-        save_message(user_id, user_message, True, chat_id)
-        save_message(user_id, response, False, chat_id)
+        response = process_query(user_message, bypass_cache=request.form.get("noCache") == "1")
+        save_turn(user_id, chat_id, user_message, response)
         session['current_chat_id'] = chat_id
-        logger.debug(f"Response sent: {response}")
+        logger.debug("Response sent (%d chars)", len(response))
         return response
     except Exception as e:
         logger.error(f"Exception in get_response_route: {e}")
         return "An error occurred. Try again."
 
+@app.route("/get_response_batch", methods=["POST"])
+@captured
+@admitted
+def get_response_batch():
+    """JSON {"messages": [...], "chatId"?, "noCache"?} -> {"responses": [...], "chatId"}, one reply per message."""
+    if not session.get('logged_in'):
+        return jsonify({"error": "Please log in"})
+    body = request.get_json(silent=True)
+    messages = body.get("messages") if isinstance(body, dict) else None
+    if not messages or not isinstance(messages, list) or not all(isinstance(m, str) and m for m in messages):
+        return jsonify({"error": "Expected a JSON body with a non-empty list of messages"}), 400
+    if len(messages) > BATCH_MAX_MESSAGES:
+        return jsonify({"error": f"At most {BATCH_MAX_MESSAGES} messages per batch"}), 413
+    user_id = session.get('user_id')
+    chat_id = body.get("chatId") or session.get('current_chat_id', f"chat_{user_id}_{datetime.now().strftime('%Y_%m_%dT%H_%M_%S_%fZ').rstrip('0').rstrip('.')}")
+    try:
+        responses, chat_id = answer_batch(user_id, chat_id, messages, bypass_cache=bool(body.get("noCache")))
+    except sqlite3.Error as e:
+        logger.error(f"Database error in get_response_batch: {e}")
+        return jsonify({"error": "An error occurred. Try again."}), 500
+    session['current_chat_id'] = chat_id
+    logger.debug("Answered a batch of %d messages for user: %s", len(messages), user_id)
+    return jsonify({"responses": responses, "chatId": chat_id})
+
+@app.route("/get_response_stream", methods=["POST"])
+@captured
+@admitted
+def get_response_stream():
+    """Like /get_response_route, but streams the OpenAI fallback as plain-text chunks as tokens arrive."""
+    logger.debug("Accessing get_response_stream route")
+    if not session.get('logged_in'):
+        logger.debug("Unauthorized access to get_response_stream")
+        return "Please log in to chat"
+    user_message = request.form.get("message")
+    user_id = session.get('user_id')
+    chat_id = request.form.get("chatId") or session.get('current_chat_id', f"chat_{user_id}_{datetime.now().strftime('%Y_%m_%dT%H_%M_%S_%fZ').rstrip('0').rstrip('.')}")
+    if not user_message:
+        return "No message provided"
+    if "new chat" in user_message.lower():
+        return get_response_route()
+    session['current_chat_id'] = chat_id
+    bypass_cache = request.form.get("noCache") == "1"
+    try:
+        message = nlp.normalize(user_message)
+        response = answer_locally(message)
+        if response is None and not openai_available:
+            response = NO_LLM_RESPONSE
+        if response is None:
+            response = answer_cache.get(message, bypass=bypass_cache)
+    except Exception as e:
+        logger.error(f"Error in get_response_stream: {e}")
+        response = "Error processing your request. Try again."
+    if response is not None:
+        save_turn(user_id, chat_id, user_message, response)
+        return Response(response, mimetype="text/plain")
+
+    def generate():
+        parts = []
+        try:
+            for delta in llm.stream_completion(message):
+                parts.append(delta)
+                yield delta
+            # Only a completed stream is cached, never a partial answer from a disconnect or error
+            answer_cache.put(message, "".join(parts).strip(), bypass=bypass_cache)
+        except Exception as e:
+            logger.error(f"OpenAI streaming error: {e}")
+            if not parts:
+                parts.append("OpenAI API error. Using fallback response.")
+                yield parts[0]
+        finally:
+            # Runs on completion, error or client disconnect, so the turn is always persisted once
+            save_turn(user_id, chat_id, user_message, "".join(parts).strip())
+
+    return Response(stream_with_context(generate()), mimetype="text/plain",
+                    headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
+
+@app.route("/write_queue_stats")
+def write_queue_stats():
+    if not write_queue:
+        return jsonify({"enabled": False})
+    return jsonify({"enabled": True, **write_queue.stats()})
+
+@app.route("/answer_cache_stats")
+def answer_cache_stats():
+    # Counts only: the most-asked questions are other users' text, so they stay out of this unauthenticated route
+    return jsonify(answer_cache.stats(top=0))
+
+@app.route("/admission_stats")
+def admission_stats():
+    if admission_control is None:
+        return jsonify({"enabled": False})
+    return jsonify({"enabled": True, **admission_control.stats()})
+
+@app.route("/maintenance_stats")
+def maintenance_stats():
+    """When chat maintenance last ran, what it did, and when it is next due."""
+    return jsonify(maintenance.status() or {})
+
+@app.route("/tasks")
+def tasks():
+    logger.debug("Accessing tasks route")
+    if not session.get('logged_in'):
+        logger.debug("Unauthorized access to tasks")
+        return jsonify({"error": "Please log in"})
+    return jsonify({"tasks": task_outbox.list_tasks(session.get('user_id'))})
+
 @app.route("/save_message", methods=["POST"])
 def save_message_route():
     logger.debug("Accessing save_message route")
@@ -456,14 +937,9 @@ def save_message_route():
         message = request.form.get("message")
         is_user = request.form.get("isUser") == "true"
         chat_id = request.form.get("chatId") or session.get('current_chat_id')
-        logger.debug(f"Saving message: {message} for user: {user_id}, chat_id: {chat_id}")
+        logger.debug("Saving message (%d chars) for user: %s, chat_id: %s", len(message or ""), user_id, chat_id)
         timestamp = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-        conn = sqlite3.connect('chat_history.db', check_same_thread=False)
-        c = conn.cursor()
-        c.execute("INSERT INTO chats (user_id, chat_id, message, is_user, timestamp) VALUES (?, ?, ?, ?, ?)",
-                  (user_id, chat_id, message, is_user, timestamp))
-        conn.commit()
-        conn.close()
+        db.insert_message(user_id, chat_id, message, is_user, timestamp)
         return jsonify({"status": "OK", "chatId": chat_id})
     except Exception as e:
         logger.error(f"Error in save_message: {e}")
@@ -478,18 +954,47 @@ def get_history():
     try:
         user_id = session.get('user_id')
         chat_id = request.args.get('chatId') or session.get('current_chat_id')
-        logger.debug(f"Fetching history for user: {user_id}, chat_id: {chat_id}")
-        history = get_chat_history(user_id, chat_id)
-        conn = sqlite3.connect('chat_history.db', check_same_thread=False)
-        c = conn.cursor()
-        c.execute("SELECT DISTINCT chat_id FROM chats WHERE user_id = ? ORDER BY timestamp DESC", (user_id,))
-        chat_ids = [row[0] for row in c.fetchall()]
-        conn.close()
-        return jsonify({"history": history, "chatIds": chat_ids, "currentChatId": chat_id})
+        before = request.args.get('before', type=int)
+        since = request.args.get('since', type=int)
+        limit = request.args.get('limit', HISTORY_PAGE_SIZE, type=int)
+        logger.debug("Fetching history for user: %s, chat_id: %s, before: %s, since: %s", user_id, chat_id, before, since)
+        history, has_more = get_chat_history(user_id, chat_id, before=before, since=since, limit=limit)
+        # The chat list is served separately by /chat_ids, with ETag revalidation
+        return jsonify({"history": history, "hasMore": has_more, "currentChatId": chat_id})
     except Exception as e:
         logger.error(f"Error in get_history: {e}")
         return jsonify({"error": "Failed to load history"})
 
+@app.route("/search")
+def search_route():
+    if not session.get('logged_in'):
+        return jsonify({"error": "Please log in"})
+    try:
+        query = request.args.get('q', '').strip()
+        limit = request.args.get('limit', SEARCH_PAGE_SIZE, type=int)
+        offset = request.args.get('offset', 0, type=int)
+        results, has_more = search_chats(session.get('user_id'), query, limit=limit, offset=offset)
+        return jsonify({"results": results, "hasMore": has_more, "query": query})
+    except sqlite3.Error as e:
+        logger.error(f"Error in search: {e}")
+        return jsonify({"error": "Search failed"})
+
+@app.route("/chat_ids")
+def chat_ids_route():
+    if not session.get('logged_in'):
+        return jsonify({"error": "Please log in"})
+    user_id = session.get('user_id')
+    # The version query is one aggregate over the user's chat_sessions rows; a matching
+    # If-None-Match gets a 304 without building the list
+    etag = hashlib.sha1(f"{user_id}:{db.chat_list_version(user_id)}".encode()).hexdigest()
+    if request.if_none_match.contains(etag):
+        response = app.response_class(status=304)
+    else:
+        response = jsonify({"chatIds": db.list_chat_ids(user_id)})
+    response.set_etag(etag)
+    response.headers["Cache-Control"] = "private, no-cache"
+    return response
+
 @app.route("/delete_chat_route", methods=["POST"])
 def delete_chat_route():
     logger.debug("Accessing delete_chat route")
@@ -499,23 +1004,15 @@ def delete_chat_route():
     try:
         user_id = session.get('user_id')
         chat_id = request.form.get("chatId")
-        logger.debug(f"Deleting chat: {chat_id} for user: {user_id}, received chat_id: {chat_id}")
+        logger.debug("Deleting chat: %s for user: %s", chat_id, user_id)
         if not chat_id:
             logger.error("No chat ID provided in request")
             return jsonify({"status": "Error", "message": "No chat ID provided"})
-        # Log all existing chat_ids for this user
-        conn = sqlite3.connect('chat_history.db', check_same_thread=False)
-        c = conn.cursor()
-        c.execute("SELECT DISTINCT chat_id FROM chats WHERE user_id = ?", (user_id,))
-        existing_chat_ids = [row[0] for row in c.fetchall()]
-        logger.debug(f"Existing chat_ids for user {user_id}: {existing_chat_ids}")
         result = delete_chat(user_id, chat_id)
         if result["status"] == "OK" and chat_id == session.get('current_chat_id'):
             session['current_chat_id'] = f"chat_{user_id}_{datetime.now().strftime('%Y_%m_%dT%H_%M_%S_%fZ').rstrip('0').rstrip('.')}"
-        logger.debug(f"Delete result: {result}")
-        c.execute("SELECT DISTINCT chat_id FROM chats WHERE user_id = ? ORDER BY timestamp DESC", (user_id,))
-        updated_chat_ids = [row[0] for row in c.fetchall()]
-        conn.close()
+        logger.debug("Delete result: %s", result)
+        updated_chat_ids = db.list_chat_ids(user_id)
         return jsonify({**result, "updatedChatIds": updated_chat_ids})
     except Exception as e:
         logger.error(f"Error in delete_chat_route: {e}")
@@ -528,7 +1025,8 @@ def settings():
         logger.debug("Unauthorized access to settings, redirecting to login")
         return redirect(url_for('login'))
     user_id = session.get('user_id')
-    user = get_user(user_id)
+    # A POST checks the password against the stored row, not a cached copy that may predate a change
+    user = get_user(user_id, fresh=request.method == "POST")
     if request.method == "POST":
         current_password = request.form.get("current_password")
         new_password = request.form.get("new_password")
@@ -541,30 +1039,37 @@ def settings():
         security_answer1 = request.form.get("security_answer1")
         security_question2 = request.form.get("security_question2")
         security_answer2 = request.form.get("security_answer2")
+        # Empty for the server default (CHAT_RETENTION_DAYS), "0" to keep chats forever
+        retention = request.form.get("retention_days", "")
+        retention_days = int(retention) if retention.isdigit() else None
         profile_picture = None
 
-        if user and check_password_hash(user['password'], current_password):
+        if user and password_hasher.verify(user['password'], current_password):
             if new_password and len(new_password) >= 6:
-                hashed_password = generate_password_hash(new_password)
+                hashed_password = password_hasher.hash(new_password)
             else:
                 hashed_password = user['password']
 
             if 'profile_picture' in request.files:
                 file = request.files['profile_picture']
                 if file and file.filename:
-                    filename = secure_filename(f"{user_id}_{datetime.now().strftime('%Y%m%d_%H%M%S')}_{file.filename}")
-                    file_path = safe_join(app.config['UPLOAD_FOLDER'], filename)
-                    file.save(file_path)
-                    profile_picture = filename
-
-            conn = sqlite3.connect('chat_history.db', check_same_thread=False)
-            c = conn.cursor()
-            c.execute("UPDATE users SET password = ?, name = ?, email = ?, two_factor_enabled = ?, email_notifications = ?, sms_notifications = ?, security_question1 = ?, security_answer1 = ?, security_question2 = ?, security_answer2 = ?, profile_picture = ? WHERE username = ?",
-                      (hashed_password, name, email, two_factor, email_notifications, sms_notifications, security_question1, security_answer1, security_question2, security_answer2, profile_picture or user.get('profile_picture'), user_id))
-            conn.commit()
-            conn.close()
-            encrypt_credentials(user_id, new_password or current_password, name, email, two_factor, email_notifications, sms_notifications, security_question1, security_answer1, security_question2, security_answer2, profile_picture or user.get('profile_picture'))
-            logger.debug(f"Settings updated for user: {user_id}")
+                    # Stored as a small square thumbnail, whatever size was uploaded
+                    try:
+                        profile_picture = avatars.save(file.stream, app.config['UPLOAD_FOLDER'])
+                    except avatars.InvalidImage as e:
+                        return render_template("settings.html", user=user, error=str(e))
+
+            if retention_days != user.get('retention_days'):
+                db.update_retention(user_id, retention_days)
+            db.update_user(user_id, hashed_password, name, email, two_factor, email_notifications, sms_notifications, security_question1, security_answer1, security_question2, security_answer2, profile_picture or user.get('profile_picture'))
+            credential_store.save(user_id, name=name, email=email, two_factor_enabled=two_factor,
+                                  email_notifications=email_notifications, sms_notifications=sms_notifications,
+                                  security_question1=security_question1, security_answer1=security_answer1,
+                                  security_question2=security_question2, security_answer2=security_answer2,
+                                  profile_picture=profile_picture or user.get('profile_picture'))
+            user_cache.invalidate(user_id)
+            session['user_changed_at'] = time.time()
+            logger.debug("Settings updated for user: %s", user_id)
             return redirect(url_for('settings', success="Settings updated successfully"))
         logger.debug("Settings update failed: Invalid current password")
         return render_template("settings.html", user=user, error="Invalid current password")
@@ -580,7 +1085,7 @@ def learn():
     try:
         question = request.form.get("question")
         answer = request.form.get("answer")
-        logger.debug(f"Learning attempt: question={question}, answer={answer}")
+        logger.debug("Learning attempt (%d-char question, %d-char answer)", len(question or ""), len(answer or ""))
         if question and answer and "?" in question:
             response = save_learned_knowledge(question, answer)
             return jsonify({"status": "OK", "response": response})
@@ -589,6 +1094,50 @@ def learn():
         logger.error(f"Error in learn: {e}")
         return jsonify({"status": "Error", "message": str(e)})
 
+@app.cli.command("prepare")
+def prepare_command():
+    """Download NLTK corpora and migrate the database (run once per deploy, see build.sh)."""
+    if not nlp.download():
+        print("Some NLTK corpora could not be downloaded; tagging will fail until they are present.")
+    init_db()
+    print(f"Database schema at version {db.get_schema_version()}.")
+
+@app.cli.command("build-assets")
+def build_assets_command():
+    """Minify, fingerprint and precompress static css/js into static/dist (run once per deploy, see build.sh)."""
+    manifest = assets.build(app.static_folder)
+    print(f"Built {len(manifest)} assets into {asset_manifest.dist}.")
+
+@app.cli.command("migrate")
+def migrate_command():
+    """Migrate the database schema without touching NLTK data."""
+    init_db()
+    print(f"Database schema at version {db.get_schema_version()}.")
+
+@app.cli.command("maintain")
+@click.option("--vacuum", is_flag=True, help="First convert the database to incremental auto_vacuum with a full VACUUM.")
+def maintain_command(vacuum):
+    """Run chat retention, archival and vacuum now; schedule it daily from cron unless MAINTENANCE=1."""
+    init_db()
+    if vacuum and maintenance.convert_auto_vacuum():
+        print("Converted the database to incremental auto_vacuum.")
+    report = maintenance.run_if_due(force=True)
+    print(", ".join(f"{key}: {value}" for key, value in report.items()))
+
+@app.cli.command("dispatch-tasks")
+def dispatch_tasks_command():
+    """Deliver queued Zapier tasks in the foreground (for deployments with TASK_DISPATCHER=0)."""
+    if not ZAPIER_WEBHOOK_URL:
+        print("ZAPIER_WEBHOOK_URL is not set.")
+        return
+    init_db()
+    dispatcher = task_outbox.TaskDispatcher(ZAPIER_WEBHOOK_URL).start()
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        dispatcher.close()
+
 if __name__ == "__main__":
     port = int(os.environ.get("PORT", 10000))
-    app.run(host="0.0.0.0", port=port, debug=True)
\ No newline at end of file
+    create_app().run(host="0.0.0.0", port=port, debug=True)
\ No newline at end of file
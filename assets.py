@@ -0,0 +1,145 @@
+"""Build step for static/css and static/js, and the lookup table the app serves them from.
+
+`flask --app app build-assets` (run by build.sh) minifies every stylesheet and
+script, writes it to static/dist as <name>.<hash>.<ext> next to precompressed
+.gz and .br variants (.br needs the brotli package), and records the mapping in
+static/dist/manifest.json. Templates link assets with asset_url(), which gives
+the fingerprinted /assets/ URL once a build exists and the plain /static/ file
+before that.
+
+A fingerprinted file never changes under its name, so it is served with
+`Cache-Control: immutable` and a year's max-age: browsers stop asking for it
+until a new build renames it. The content hash doubles as the ETag, so
+revalidation gets a 304 on any worker or host.
+"""
+import os
+import re
+import json
+import gzip
+import shutil
+import hashlib
+import logging
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+logger = logging.getLogger(__name__)
+
+SOURCE_DIRS = ("css", "js")
+DIST_DIR = "dist"
+MANIFEST = "manifest.json"
+MAX_AGE = 365 * 24 * 3600
+# Preferred first; the suffix is appended to the fingerprinted file name
+ENCODINGS = (("br", ".br"), ("gzip", ".gz"))
+
+
+def minify_css(text):
+    text = re.sub(r"/\*.*?\*/", "", text, flags=re.S)
+    text = re.sub(r"\s+", " ", text)
+    # Spaces before ':' are left alone: in a selector they mean a descendant (".a :hover")
+    text = re.sub(r"\s*([{};,>])\s*", r"\1", text)
+    text = re.sub(r":\s+", ":", text)
+    return text.replace(";}", "}").strip() + "\n"
+
+
+def minify_js(text):
+    """Line-level minification: indentation, blank lines and whole-line // comments go.
+
+    Nothing inside a line is touched, so strings and regex literals are safe without a
+    tokenizer; lines inside a multi-line template literal are kept as they are.
+    """
+    lines = []
+    in_template = False
+    for line in text.splitlines():
+        stripped = line.strip()
+        if in_template:
+            lines.append(line)
+        elif stripped and not stripped.startswith("//"):
+            lines.append(stripped)
+        if len(re.findall(r"(?<!\\)`", line)) % 2:
+            in_template = not in_template
+    return "\n".join(lines) + "\n"
+
+
+MINIFIERS = {".css": minify_css, ".js": minify_js}
+
+
+def _compress(data):
+    variants = {"gzip": gzip.compress(data, compresslevel=9, mtime=0)}
+    if brotli is not None:
+        variants["br"] = brotli.compress(data, quality=11)
+    return variants
+
+
+def build(static_dir):
+    """Minify, fingerprint and precompress the assets under static_dir; returns the new manifest."""
+    dist = os.path.join(static_dir, DIST_DIR)
+    shutil.rmtree(dist, ignore_errors=True)
+    manifest = {}
+    for source_dir in SOURCE_DIRS:
+        for root, _, files in os.walk(os.path.join(static_dir, source_dir)):
+            for name in sorted(files):
+                base, ext = os.path.splitext(name)
+                if ext not in MINIFIERS:
+                    continue
+                source = os.path.join(root, name)
+                with open(source, encoding="utf-8") as f:
+                    data = MINIFIERS[ext](f.read()).encode("utf-8")
+                digest = hashlib.sha256(data).hexdigest()[:12]
+                path = os.path.relpath(source, static_dir).replace(os.sep, "/")
+                built = f"{os.path.dirname(path)}/{base}.{digest}{ext}"
+                os.makedirs(os.path.join(dist, os.path.dirname(built)), exist_ok=True)
+                with open(os.path.join(dist, built), "wb") as f:
+                    f.write(data)
+                encodings = []
+                for encoding, compressed in _compress(data).items():
+                    # Tiny files can come out larger; the identity file is enough for those
+                    if len(compressed) < len(data):
+                        with open(os.path.join(dist, built + dict(ENCODINGS)[encoding]), "wb") as f:
+                            f.write(compressed)
+                        encodings.append(encoding)
+                manifest[path] = {"file": built, "etag": digest, "encodings": encodings}
+                logger.debug("Built %s -> %s (%s)", path, built, ", ".join(encodings) or "identity only")
+    os.makedirs(dist, exist_ok=True)
+    with open(os.path.join(dist, MANIFEST), "w", encoding="utf-8") as f:
+        json.dump(manifest, f, indent=2, sort_keys=True)
+    return manifest
+
+
+class Manifest:
+    def __init__(self, static_dir):
+        self.dist = os.path.join(static_dir, DIST_DIR)
+        self.entries = {}
+        self.by_file = {}
+        self.reload()
+
+    def reload(self):
+        try:
+            with open(os.path.join(self.dist, MANIFEST), encoding="utf-8") as f:
+                self.entries = json.load(f)
+        except FileNotFoundError:
+            self.entries = {}
+        except ValueError as e:
+            logger.error(f"Unreadable asset manifest, serving unbuilt files: {e}")
+            self.entries = {}
+        self.by_file = {entry["file"]: entry for entry in self.entries.values()}
+
+    def built(self, path):
+        """Fingerprinted file for a static path, or None when there is no build of it."""
+        entry = self.entries.get(path)
+        return entry["file"] if entry else None
+
+    def variant(self, filename, accepted):
+        """(file to send, Content-Encoding or None, ETag) for a fingerprinted file, or None if unknown.
+
+        accepted is the request's Accept-Encoding (werkzeug MIMEAccept-like: supports `in`).
+        """
+        entry = self.by_file.get(filename)
+        if entry is None:
+            return None
+        for encoding, suffix in ENCODINGS:
+            if encoding in entry["encodings"] and encoding in accepted:
+                return filename + suffix, encoding, f"{entry['etag']}-{encoding}"
+        return filename, None, entry["etag"]
@@ -0,0 +1,85 @@
+"""Password hashing policy and a short-lived cache of user rows.
+
+PasswordHasher wraps werkzeug's hashing with a configurable method string
+(PASSWORD_HASH_METHOD, e.g. "pbkdf2:sha256:600000" or "scrypt:32768:8:1"), so
+the cost can be tuned per deployment. Stored hashes carry their own method,
+so old ones keep verifying; needs_rehash() tells login to re-hash a password
+whose hash does not match the current policy.
+
+UserCache keeps user rows for USER_CACHE_TTL seconds. Missing users are not
+cached, so a username registered in another worker is found immediately.
+Callers pass the time the user last changed (app.py keeps it in the session)
+to skip entries fetched before that change in any worker.
+"""
+import os
+import threading
+import time
+
+from werkzeug.security import generate_password_hash, check_password_hash, DEFAULT_PBKDF2_ITERATIONS
+
+METHOD = os.getenv("PASSWORD_HASH_METHOD", f"pbkdf2:sha256:{DEFAULT_PBKDF2_ITERATIONS}")
+SALT_LENGTH = int(os.getenv("PASSWORD_SALT_LENGTH", "16"))
+USER_CACHE_TTL = float(os.getenv("USER_CACHE_TTL", "30"))
+
+
+def canonical_method(method):
+    """method with werkzeug's defaults filled in, as it appears in front of the '$' of a stored hash."""
+    name, *params = method.split(":")
+    if name == "pbkdf2":
+        params = (params + ["sha256", str(DEFAULT_PBKDF2_ITERATIONS)][len(params):])
+    elif name == "scrypt":
+        params = (params + ["32768", "8", "1"][len(params):])
+    return ":".join([name, *params])
+
+
+class PasswordHasher:
+    def __init__(self, method=METHOD, salt_length=SALT_LENGTH):
+        self.method = canonical_method(method)
+        self.salt_length = salt_length
+
+    def hash(self, password):
+        return generate_password_hash(password, method=self.method, salt_length=self.salt_length)
+
+    def verify(self, stored_hash, password):
+        return bool(stored_hash) and check_password_hash(stored_hash, password)
+
+    def needs_rehash(self, stored_hash):
+        return stored_hash.split("$", 1)[0] != self.method
+
+
+class UserCache:
+    def __init__(self, ttl=USER_CACHE_TTL):
+        self.ttl = ttl
+        self._entries = {}
+        self._lock = threading.Lock()
+        self._stats = {"hits": 0, "misses": 0}
+
+    def get(self, username, fetch, changed_at=0.0):
+        """Cached row for username, or fetch(username) if absent, expired or older than changed_at."""
+        now = time.time()
+        with self._lock:
+            entry = self._entries.get(username)
+            if entry and now - entry[1] < self.ttl and entry[1] >= changed_at:
+                self._stats["hits"] += 1
+                return entry[0]
+            self._stats["misses"] += 1
+        user = fetch(username)
+        if user is not None:
+            self.put(username, user, now)
+        return user
+
+    def put(self, username, user, fetched_at=None):
+        with self._lock:
+            self._entries[username] = (user, time.time() if fetched_at is None else fetched_at)
+            # Bounded by sweeping expired rows rather than an LRU; entries are tiny and short-lived
+            if len(self._entries) > 10000:
+                cutoff = time.time() - self.ttl
+                self._entries = {name: entry for name, entry in self._entries.items() if entry[1] >= cutoff}
+
+    def invalidate(self, username):
+        with self._lock:
+            self._entries.pop(username, None)
+
+    def stats(self):
+        with self._lock:
+            return {**self._stats, "entries": len(self._entries)}
@@ -0,0 +1,56 @@
+"""Profile pictures, stored as small fixed-size thumbnails.
+
+settings used to save the uploaded file as-is, so a phone photo of several
+megabytes was what every avatar load fetched. save() decodes the upload with
+Pillow, applies its EXIF orientation, crops it to a square and scales it to
+SIZE x SIZE, and writes a WebP under uploads/avatars named by the hash of the
+result. The name changes whenever the picture does, so app.py can serve it
+with the same immutable caching as the fingerprinted assets.
+"""
+import io
+import os
+import hashlib
+import logging
+
+from PIL import Image, ImageOps, UnidentifiedImageError
+
+logger = logging.getLogger(__name__)
+
+SIZE = int(os.getenv("AVATAR_SIZE", "128"))
+QUALITY = int(os.getenv("AVATAR_QUALITY", "80"))
+# Uploads with more pixels than this are rejected before decoding (decompression bombs)
+MAX_PIXELS = int(os.getenv("AVATAR_MAX_PIXELS", str(40 * 1000 * 1000)))
+SUBDIR = "avatars"
+
+
+class InvalidImage(Exception):
+    """The upload is not an image Pillow can read; str(e) is the message for the user."""
+
+
+def thumbnail(stream, size=SIZE, quality=QUALITY):
+    """WebP bytes of the image in stream, cropped to a square and scaled to size x size."""
+    try:
+        with Image.open(stream) as image:
+            if image.width * image.height > MAX_PIXELS:
+                raise InvalidImage("Profile picture is too large.")
+            image = ImageOps.exif_transpose(image)
+            image = ImageOps.fit(image.convert("RGBA" if image.mode in ("RGBA", "LA", "P") else "RGB"),
+                                 (size, size), Image.LANCZOS)
+    except (UnidentifiedImageError, OSError, Image.DecompressionBombError) as e:
+        raise InvalidImage("Profile picture must be a PNG, JPEG, GIF or WebP image.") from e
+    output = io.BytesIO()
+    image.save(output, "WEBP", quality=quality, method=6)
+    return output.getvalue()
+
+
+def save(stream, upload_folder):
+    """Store the thumbnail of an upload; returns its path relative to upload_folder."""
+    data = thumbnail(stream)
+    filename = f"{SUBDIR}/{hashlib.sha256(data).hexdigest()[:16]}.webp"
+    path = os.path.join(upload_folder, filename)
+    if not os.path.exists(path):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, "wb") as f:
+            f.write(data)
+    logger.debug("Saved %d-byte avatar as %s", len(data), filename)
+    return filename
@@ -0,0 +1,1571 @@
+"""Performance benchmarks for the chatbot.
+
+Run one benchmark at a time, e.g.:
+
+    python benchmark.py db --messages 5000 --threads 4
+
+Every benchmark works on a throwaway database in a temp directory, so it never
+touches the real chat_history.db or the credential files beside it.
+"""
+import argparse
+import atexit
+import io
+import itertools
+import json
+import logging
+import os
+import random
+import re
+import shutil
+import statistics
+import subprocess
+import sys
+import sqlite3
+import tempfile
+import threading
+import time
+from datetime import datetime, timedelta
+
+import auth
+import credential_store
+import db
+import knowledge_store
+import llm
+import outbound
+import request_log
+import write_behind
+from answer_cache import AnswerCache
+from intent_router import IntentRouter
+from semantic_index import MIN_SCORE, SemanticIndex
+from stub_server import StubUpstream
+
+CHATS_SCHEMA = '''CREATE TABLE IF NOT EXISTS chats
+                 (id INTEGER PRIMARY KEY, user_id TEXT, chat_id TEXT, message TEXT, is_user INTEGER, timestamp TEXT)'''
+
+
+def _timestamp():
+    return datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+
+
+def _run_threads(threads, target):
+    workers = [threading.Thread(target=target, args=(i,)) for i in range(threads)]
+    start = time.perf_counter()
+    for w in workers:
+        w.start()
+    for w in workers:
+        w.join()
+    return time.perf_counter() - start
+
+
+def _legacy_save(path, user_id, chat_id, message, is_user):
+    # What app.py used to do for every message: fresh connection, rollback journal.
+    conn = sqlite3.connect(path, check_same_thread=False, timeout=30)
+    c = conn.cursor()
+    c.execute("INSERT INTO chats (user_id, chat_id, message, is_user, timestamp) VALUES (?, ?, ?, ?, ?)",
+              (user_id, chat_id, message, is_user, _timestamp()))
+    conn.commit()
+    conn.close()
+
+
+def bench_db(args):
+    per_thread = args.messages // args.threads
+    total = per_thread * args.threads
+    with tempfile.TemporaryDirectory() as tmp:
+        legacy_path = os.path.join(tmp, 'legacy.db')
+        conn = sqlite3.connect(legacy_path)
+        conn.execute(CHATS_SCHEMA)
+        conn.close()
+
+        def legacy(i):
+            for n in range(per_thread):
+                _legacy_save(legacy_path, f"user{i}", f"chat_{i}", f"message {n}", n % 2)
+
+        legacy_time = _run_threads(args.threads, legacy)
+
+        db.configure(os.path.join(tmp, 'pooled.db'))
+        db.get_connection().execute(CHATS_SCHEMA)
+
+        def pooled(i):
+            for n in range(per_thread):
+                db.insert_message(f"user{i}", f"chat_{i}", f"message {n}", n % 2, _timestamp())
+
+        pooled_time = _run_threads(args.threads, pooled)
+        db.close_all()
+
+    print(f"{total} messages, {args.threads} thread(s)")
+    print(f"  per-call connect : {total / legacy_time:10.0f} msg/s")
+    print(f"  pooled WAL       : {total / pooled_time:10.0f} msg/s  ({legacy_time / pooled_time:.1f}x)")
+
+
+def bench_turns(args):
+    per_thread = args.turns // args.threads
+    total = per_thread * args.threads
+    with tempfile.TemporaryDirectory() as tmp:
+        results = {}
+        for mode in ("two commits", "one transaction", "write-behind"):
+            db.configure(os.path.join(tmp, mode.replace(' ', '_') + '.db'))
+            with db.transaction() as conn:
+                conn.execute(CHATS_SCHEMA)
+                db.migrate_chat_indexes(conn)
+            queue = write_behind.WriteBehindQueue() if mode == "write-behind" else None
+
+            def worker(i):
+                for n in range(per_thread):
+                    ts = _timestamp()
+                    if mode == "two commits":
+                        db.insert_message(f"user{i}", f"chat_{i}", f"question {n}", True, ts)
+                        db.insert_message(f"user{i}", f"chat_{i}", f"answer {n}", False, ts)
+                    elif mode == "one transaction":
+                        db.insert_turn(f"user{i}", f"chat_{i}", f"question {n}", f"answer {n}", ts)
+                    else:
+                        queue.submit_turn(f"user{i}", f"chat_{i}", f"question {n}", f"answer {n}", ts)
+
+            elapsed = _run_threads(args.threads, worker)
+            if queue:
+                queue.flush()
+                stats = queue.stats()
+                queue.close()
+            results[mode] = elapsed
+            db.close_all()
+
+    print(f"{total} turns, {args.threads} thread(s)")
+    for mode, elapsed in results.items():
+        print(f"  {mode:16}: {total / elapsed:10.0f} turns/s")
+    print(f"  write-behind flushes: {stats['flushed_batches']} batches, avg {stats['avg_flush_ms']} ms, "
+          f"max {stats['max_flush_ms']} ms")
+
+
+def _legacy_route(message, knowledge_base):
+    # The substring cascade process_query used before the intent router
+    if "weather" in message or "great wall of china" in message:
+        return "web_search"
+    elif "time" in message:
+        return "time"
+    elif "?" in message:
+        for category in knowledge_base:
+            if category in message:
+                return category
+        return "knowledge"
+    if "news" in message:
+        return "news"
+    if "schedule" in message or "task" in message:
+        return "schedule"
+    if any(word in message for word in ["hi", "hello", "hey"]):
+        return "greeting"
+    return None
+
+
+ROUTER_INTENTS = (("web_search", ["weather", "great wall of china"]), ("time", ["time"]), ("knowledge", ["?"]),
+                  ("news", ["news"]), ("schedule", ["schedule", "task"]), ("greeting", ["hi", "hello", "hey"]),
+                  ("identity", ["who are you", "what are you"]))
+
+
+def _build_router():
+    # Same triggers and order as app.py, with handlers that just name the intent
+    router = IntentRouter()
+    for name, triggers in ROUTER_INTENTS:
+        router.intent(name, triggers)(lambda message, match, name=name: match.categories[0]
+                                      if name == "knowledge" and match.categories else name)
+    return router
+
+
+def bench_router(args):
+    rng = random.Random(42)
+    words = ["".join(rng.choice("abcdefghijklmnopqrstuvwxyz") for _ in range(rng.randint(3, 9)))
+             for _ in range(2000)]
+    knowledge_base = {}
+    while len(knowledge_base) < args.categories:
+        knowledge_base["_".join(rng.sample(words, rng.randint(2, 4)))] = ["answer"]
+    categories = list(knowledge_base)
+    messages = []
+    for i in range(args.messages):
+        if i % 2:
+            messages.append(f"what about {rng.choice(categories)}?")
+        else:
+            messages.append(" ".join(rng.sample(words, 8)) + "?")
+
+    router = _build_router()
+    start = time.perf_counter()
+    router.add_categories(knowledge_base)
+    compile_ms = (time.perf_counter() - start) * 1000
+
+    start = time.perf_counter()
+    legacy = [_legacy_route(m, knowledge_base) for m in messages]
+    legacy_time = time.perf_counter() - start
+    start = time.perf_counter()
+    routed = [router.dispatch(m) for m in messages]
+    router_time = time.perf_counter() - start
+    mismatches = sum(1 for a, b in zip(legacy, routed) if a != b)
+
+    start = time.perf_counter()
+    for i in range(args.learn):
+        router.add_category(f"newly_learned_{i}")
+    learn_us = (time.perf_counter() - start) / max(1, args.learn) * 1e6
+
+    print(f"{args.categories} categories, {args.messages} messages")
+    print(f"  automaton compile : {compile_ms:8.1f} ms")
+    print(f"  substring cascade : {legacy_time / args.messages * 1e6:8.1f} us/message")
+    print(f"  intent router     : {router_time / args.messages * 1e6:8.1f} us/message "
+          f"({legacy_time / router_time:.1f}x, {mismatches} mismatches)")
+    print(f"  add_category      : {learn_us:8.1f} us amortized over {args.learn} additions")
+
+
+NLTK_SAMPLES = {
+    "web_search": ["weather in london", "what's the weather in paris today"],
+    "time": ["what time is it", "tell me the time please"],
+    "knowledge": ["how_are_you?", "where is the eiffel tower?"],
+    "news": ["news about technology", "latest news on football"],
+    "greeting": ["hello there", "hey bot"],
+    "fallback": ["please help me with my homework", "goodbye", "the quick brown fox jumps"],
+}
+
+
+def bench_nltk(args):
+    import nltk
+    import nlp
+
+    nltk.data.path.append(os.path.join(os.getcwd(), 'nltk_data'))
+    router = _build_router()
+    try:
+        nltk.pos_tag(nltk.word_tokenize("warm up the tagger"))
+    except LookupError as e:
+        print(f"NLTK data missing, run ./build.sh first: {e}")
+        return
+
+    def eager(message):
+        tagged = nltk.pos_tag(nltk.word_tokenize(message))
+        return router.dispatch(message) or tagged
+
+    def lazy(message):
+        return router.dispatch(message) or nlp.pos_tag(message)
+
+    print(f"per-message latency over {args.repeat} repeats (us)")
+    print(f"  {'intent':12} {'eager':>10} {'lazy':>10} {'saving':>10}")
+    for intent, messages in NLTK_SAMPLES.items():
+        timings = []
+        for fn in (eager, lazy):
+            nlp.tokenize.cache_clear()
+            nlp.pos_tag.cache_clear()
+            start = time.perf_counter()
+            for _ in range(args.repeat):
+                for message in messages:
+                    fn(message)
+            timings.append((time.perf_counter() - start) / (args.repeat * len(messages)) * 1e6)
+        print(f"  {intent:12} {timings[0]:10.1f} {timings[1]:10.1f} {timings[0] - timings[1]:10.1f}")
+
+
+def bench_startup(args):
+    # Each run is a fresh interpreter doing what a gunicorn worker does at boot
+    script = "import app; app.create_app()"
+    repo = os.path.dirname(os.path.abspath(__file__))
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, 'chat_history.db')
+        shutil.copy(os.path.join(repo, 'chat_history.db'), path)
+        env = {**os.environ, "CHAT_DB_PATH": path}
+        timings = []
+        for _ in range(args.runs + 1):
+            start = time.perf_counter()
+            subprocess.run([sys.executable, "-c", script], cwd=repo, env=env, check=True)
+            timings.append((time.perf_counter() - start) * 1000)
+    first, warm = timings[0], timings[1:]
+    median = statistics.median(warm)
+    print(f"first boot (runs migrations): {first:8.1f} ms")
+    print(f"warm boot median of {args.runs}   : {median:8.1f} ms  (min {min(warm):.1f}, max {max(warm):.1f})")
+    print(f"target {args.target_ms} ms: {'PASS' if median <= args.target_ms else 'FAIL'}")
+
+
+def _import_app(stub, tmp, **env):
+    # app reads its configuration at import time, so point it at the stub and a scratch database first;
+    # credential_store keeps its key and looks for legacy files beside that database, inside tmp
+    os.environ.update({
+        "CHAT_DB_PATH": os.path.join(tmp, 'chat_history.db'),
+        "WEATHER_API_KEY": "stub", "NEWSAPI_KEY": "stub", "ZAPIER_WEBHOOK_URL": stub.url + "/hooks/catch",
+        "WEATHER_API_URL": stub.url + "/v1/current.json", "NEWS_API_URL": stub.url + "/v2/everything",
+        **env,
+    })
+    db.configure(os.environ["CHAT_DB_PATH"])
+    import app
+    app.init_db()
+    return app
+
+
+def bench_cache(args):
+    cities = [f"city{i}" for i in range(args.cities)]
+    with tempfile.TemporaryDirectory() as tmp, StubUpstream(latency=args.latency) as stub:
+        app = _import_app(stub, tmp, RESPONSE_CACHE_SHARED="1" if args.shared else "0")
+
+        def burst(lookup):
+            def worker(i):
+                for n in range(args.requests):
+                    lookup(cities[(i + n) % len(cities)])
+            before = sum(stub.hits.values())
+            elapsed = _run_threads(args.threads, worker)
+            return elapsed, sum(stub.hits.values()) - before
+
+        uncached_time, uncached_hits = burst(app.fetch_weather)
+        cached_time, cached_hits = burst(lambda city: app.web_search(f"weather in {city}"))
+        stats = app.weather_cache.stats()
+        db.close_all()
+
+    total = args.threads * args.requests
+    print(f"{total} weather lookups over {args.cities} cities, {args.threads} threads, "
+          f"{args.latency * 1000:.0f} ms upstream latency")
+    print(f"  uncached : {uncached_time:6.2f}s, {uncached_hits} upstream calls")
+    print(f"  cached   : {cached_time:6.2f}s, {cached_hits} upstream calls "
+          f"({stats['coalesced']} coalesced, {stats['hits']} hits)")
+
+
+def bench_outbound(args):
+    import requests
+
+    def bare(url):
+        # What app.py did before: fresh connection, flat 5s timeout, no retries
+        return requests.get(url, timeout=5)
+
+    def pooled(url):
+        return outbound.get("weather", url)
+
+    print(f"{args.calls} sequential weather calls per scenario")
+    print(f"  {'scenario':28} {'client':8} {'ok':>5} {'mean ms':>9} {'p99 ms':>9}")
+    for label, latency, failure_rate in (("healthy", args.latency, 0.0),
+                                         (f"{args.failure_rate:.0%} injected 503s", args.latency, args.failure_rate),
+                                         ("upstream down (100% 503)", args.latency, 1.0)):
+        for name, client in (("bare", bare), ("outbound", pooled)):
+            for breaker in outbound._breakers.values():
+                breaker.record_success()
+            with StubUpstream(latency=latency, failure_rate=failure_rate) as stub:
+                url = stub.url + "/v1/current.json?q=london"
+                timings, ok = [], 0
+                for _ in range(args.calls):
+                    start = time.perf_counter()
+                    try:
+                        ok += client(url).status_code == 200
+                    except requests.RequestException:
+                        pass
+                    timings.append((time.perf_counter() - start) * 1000)
+            timings.sort()
+            print(f"  {label:28} {name:8} {ok:5d} {statistics.mean(timings):9.2f} "
+                  f"{timings[int(len(timings) * 0.99) - 1]:9.2f}")
+    print(f"  breaker states after run: {outbound.stats()}")
+
+
+def bench_outbox(args):
+    with tempfile.TemporaryDirectory() as tmp, StubUpstream(latency=args.latency) as stub:
+        app = _import_app(stub, tmp)
+        app.create_app()
+
+        start = time.perf_counter()
+        for n in range(args.tasks):
+            outbound.post("zapier", stub.url + "/hooks/catch", json={"task": f"inline {n}", "date": "tomorrow"})
+        inline_ms = (time.perf_counter() - start) / args.tasks * 1000
+
+        start = time.perf_counter()
+        for n in range(args.tasks):
+            app.process_query(f"schedule queued {n}")
+        queued_ms = (time.perf_counter() - start) / args.tasks * 1000
+        while db.get_connection().execute("SELECT COUNT(*) FROM task_outbox WHERE status != 'delivered'").fetchone()[0]:
+            time.sleep(0.05)
+        drained = time.perf_counter() - start
+        # Stopped here rather than at exit, when their final flushes would write into a removed directory
+        for worker in (app.task_dispatcher, app.metrics_flusher, app.request_recorder, app.maintenance_scheduler,
+                       app.write_queue):
+            if worker is not None:
+                worker.close()
+                atexit.unregister(worker.close)
+        db.close_all()
+
+    print(f"{args.tasks} tasks, {args.latency * 1000:.0f} ms webhook latency")
+    print(f"  inline POST reply latency : {inline_ms:8.2f} ms/task")
+    print(f"  queued reply latency      : {queued_ms:8.2f} ms/task")
+    print(f"  outbox fully delivered in : {drained:8.2f} s")
+
+
+def bench_logging(args):
+    import log_config
+    credentials = {"username": "bench", "password": "bench-password", "name": "Bench", "email": "bench@example.com"}
+    root = logging.getLogger()
+    saved_handlers, saved_level = root.handlers[:], root.level
+    with tempfile.TemporaryDirectory() as tmp, StubUpstream() as stub:
+        app = _import_app(stub, tmp)
+        client = app.app.test_client()
+        client.post("/register", data=credentials)
+        client.post("/login", data=credentials)
+
+        def timed_requests():
+            timings = []
+            for n in range(args.requests):
+                start = time.perf_counter()
+                client.post("/get_response_route", data={"message": "hi"})
+                timings.append((time.perf_counter() - start) * 1e6)
+            return timings
+
+        def before():
+            # What app.py did: basicConfig(level=DEBUG, filename='app.log', filemode='w')
+            handler = logging.FileHandler(os.path.join(tmp, "app.log"), mode="w")
+            handler.setFormatter(logging.Formatter(logging.BASIC_FORMAT))
+            root.addHandler(handler)
+            root.setLevel(logging.DEBUG)
+
+        path = os.path.join(tmp, "app-{pid}.log")
+        scenarios = (
+            ("logging off", lambda: root.setLevel(logging.CRITICAL)),
+            ("sync file, DEBUG (before)", before),
+            ("queue + JSON, DEBUG", lambda: log_config.configure("DEBUG", path, force=True)),
+            (f"queue + JSON, DEBUG {args.sample:.0%} sampled", lambda: log_config.configure("DEBUG", path, sample=args.sample, force=True)),
+            ("queue + JSON, INFO (production)", lambda: log_config.configure("INFO", path, force=True)),
+        )
+        results = {label: [] for label, _ in scenarios}
+        cpu_us = dict.fromkeys(results, 0.0)
+        timed_requests()  # warm-up
+        try:
+            # Interleaved rounds, so drift over the run does not favour whichever scenario went first
+            for _ in range(args.rounds):
+                for label, setup in scenarios:
+                    root.handlers = []
+                    log_config.shutdown()
+                    setup()
+                    cpu = time.process_time()
+                    results[label].extend(timed_requests())
+                    # Stopping the writer drains its queue, so its CPU counts towards this scenario
+                    log_config.shutdown()
+                    cpu_us[label] += (time.process_time() - cpu) * 1e6
+        finally:
+            log_config.shutdown()
+            root.handlers, root.level = saved_handlers, saved_level
+            db.close_all()
+
+    total = args.requests * args.rounds
+    baseline = statistics.median(results["logging off"])
+    cpu_baseline = cpu_us["logging off"] / total
+    print(f"{total} chat requests per scenario (Flask test client, greeting intent)")
+    print(f"  {'scenario':36} {'median us':>10} {'p99 us':>9} {'+latency us':>12} {'+CPU us/req':>12}")
+    for label, timings in results.items():
+        median = statistics.median(timings)
+        print(f"  {label:36} {median:10.1f} {_percentile(timings, 99):9.1f} {median - baseline:12.1f} "
+              f"{cpu_us[label] / total - cpu_baseline:12.1f}")
+
+
+def _legacy_encrypt_credentials(directory, username, password, user):
+    # What login did before: a new Fernet key and a rewrite of the one shared credentials.enc/key.key pair
+    from cryptography.fernet import Fernet
+    key = Fernet.generate_key()
+    record = {"username": username, "password": password, **{field: user[field] for field in credential_store.PROFILE_FIELDS}}
+    with open(os.path.join(directory, 'credentials.enc'), 'wb') as f:
+        f.write(Fernet(key).encrypt(json.dumps(record).encode()))
+    with open(os.path.join(directory, 'key.key'), 'wb') as f:
+        f.write(key)
+
+
+def bench_login(args):
+    from cryptography.fernet import Fernet, InvalidToken
+    from werkzeug.security import generate_password_hash
+    with tempfile.TemporaryDirectory() as tmp, StubUpstream() as stub:
+        app = _import_app(stub, tmp)
+        # One hash shared by every bench user, so setup does not pay the hashing cost per user
+        hashed = generate_password_hash("bench-password")
+        users = [f"login{i}" for i in range(args.threads)]
+        for user in users:
+            db.create_user(user, hashed, user, f"{user}@example.com")
+            credential_store.save(user, name=user, email=f"{user}@example.com")
+        login_view = app.app.view_functions["login"]
+
+        def legacy_login():
+            response = app.app.make_response(login_view())
+            if response.status_code == 302:
+                from flask import request
+                username = request.form["username"]
+                _legacy_encrypt_credentials(tmp, username, request.form["password"], db.fetch_user(username))
+            return response
+
+        def run(label):
+            latencies = []
+
+            def worker(i):
+                client = app.app.test_client()
+                for _ in range(args.logins):
+                    start = time.perf_counter()
+                    response = client.post("/login", data={"username": users[i], "password": "bench-password"})
+                    latencies.append((time.perf_counter() - start) * 1000)
+                    assert response.status_code == 302, response.status_code
+
+            elapsed = _run_threads(args.threads, worker)
+            print(f"  {label:28} {len(latencies) / elapsed:8.1f} logins/s   p50 {_percentile(latencies, 50):7.1f} ms"
+                  f"   p95 {_percentile(latencies, 95):7.1f} ms")
+
+        print(f"{args.threads} threads x {args.logins} logins, werkzeug default password hash")
+        app.app.view_functions["login"] = legacy_login
+        run("before (shared file pair)")
+        try:
+            with open(os.path.join(tmp, 'key.key'), 'rb') as f:
+                Fernet(f.read()).decrypt(open(os.path.join(tmp, 'credentials.enc'), 'rb').read())
+            pair = "consistent"
+        except InvalidToken:
+            pair = "key.key no longer decrypts credentials.enc (concurrent logins interleaved)"
+        app.app.view_functions["login"] = login_view
+        run("after (no writes)")
+        # A new hashing policy: each user's first login re-hashes, later ones verify at the new cost
+        app.password_hasher = auth.PasswordHasher(args.method)
+        run(f"after, {app.password_hasher.method}")
+        rehashed = sum(db.fetch_user(user)['password'].startswith(app.password_hasher.method + "$") for user in users)
+
+        with app.app.test_request_context():
+            start = time.perf_counter()
+            for _ in range(args.writes):
+                db.fetch_user(users[0])
+            query_us = (time.perf_counter() - start) / args.writes * 1e6
+            start = time.perf_counter()
+            for _ in range(args.writes):
+                app.get_user(users[0])
+            cached_us = (time.perf_counter() - start) / args.writes * 1e6
+
+        # The part of a login that went away, without the password hash that dominates both
+        user = db.fetch_user(users[0])
+        start = time.perf_counter()
+        for _ in range(args.writes):
+            _legacy_encrypt_credentials(tmp, users[0], "bench-password", user)
+        legacy_ms = (time.perf_counter() - start) / args.writes * 1000
+        start = time.perf_counter()
+        for _ in range(args.writes):
+            credential_store.load(users[0])
+        load_ms = (time.perf_counter() - start) / args.writes * 1000
+        db.close_all()
+
+    print(f"  users re-hashed to the new policy on login: {rehashed}/{len(users)}")
+    print(f"  legacy file pair after the run: {pair}")
+    print(f"  legacy key + encrypt + 2 file writes : {legacy_ms:7.3f} ms per login")
+    print(f"  per-user record read (cached cipher) : {load_ms:7.3f} ms")
+    print(f"  user row: query {query_us:.1f} us, cached get_user {cached_us:.1f} us")
+
+
+def _serve_app(app):
+    from werkzeug.serving import make_server
+    server = make_server("127.0.0.1", 0, app.app, threaded=True)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, f"http://127.0.0.1:{server.server_port}"
+
+
+def _login(base_url, username="bench"):
+    import requests
+    client = requests.Session()
+    credentials = {"username": username, "password": "bench-password", "name": "Bench", "email": f"{username}@example.com"}
+    client.post(base_url + "/register", data=credentials)
+    client.post(base_url + "/login", data=credentials)
+    return client
+
+
+def _free_port():
+    import socket
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def _start_gunicorn(worker_class, workers, env):
+    import requests
+    port = _free_port()
+    repo = os.path.dirname(os.path.abspath(__file__))
+    process = subprocess.Popen([sys.executable, "-m", "gunicorn", "-c", "gunicorn.conf.py", "-k", worker_class,
+                                "-w", str(workers), "-b", f"127.0.0.1:{port}", "--log-level", "error",
+                                "app:create_app()"], cwd=repo, env={**os.environ, **env})
+    base_url = f"http://127.0.0.1:{port}"
+    for _ in range(100):
+        if process.poll() is not None:
+            break
+        try:
+            requests.get(base_url + "/login", timeout=1)
+            return process, base_url
+        except requests.ConnectionError:
+            time.sleep(0.1)
+    process.terminate()
+    raise RuntimeError(f"gunicorn ({worker_class}) did not start")
+
+
+def _load_step(base_url, users, duration):
+    # Closed loop: each user sends its next message as soon as the previous reply arrives
+    clients = [_login(base_url) for _ in range(users)]
+    latencies, errors = [], []
+    deadline = time.perf_counter() + duration
+
+    def user(i):
+        n = 0
+        while time.perf_counter() < deadline:
+            n += 1
+            start = time.perf_counter()
+            try:
+                # A new city every time, so each reply waits on the (stub) weather API
+                clients[i].post(base_url + "/get_response_route", data={"message": f"weather in city{users}x{i}x{n}"},
+                                timeout=30).raise_for_status()
+                latencies.append((time.perf_counter() - start) * 1000)
+            except Exception as e:
+                errors.append(e)
+
+    _run_threads(users, user)
+    return latencies, errors
+
+
+def bench_serving(args):
+    with tempfile.TemporaryDirectory() as tmp, StubUpstream(latency=args.latency) as stub:
+        env = {"CHAT_DB_PATH": os.path.join(tmp, 'chat_history.db'), "WEATHER_API_KEY": "stub",
+               "WEATHER_API_URL": stub.url + "/v1/current.json", "TASK_DISPATCHER": "0", "RATE_LIMIT": "0",
+               "OUTBOUND_POOL_SIZE": str(max(args.users))}
+        print(f"{args.workers} workers, {args.latency * 1000:.0f} ms upstream latency, "
+              f"p95 target {args.p95_ms} ms, {args.duration:.0f}s per step")
+        for worker_class in ("sync", "gevent"):
+            process, base_url = _start_gunicorn(worker_class, args.workers, env)
+            sustained = 0
+            try:
+                for users in args.users:
+                    latencies, errors = _load_step(base_url, users, args.duration)
+                    p95 = _percentile(latencies, 95) if latencies else float("inf")
+                    print(f"  {worker_class:6} {users:4} users: {len(latencies) / args.duration:7.1f} req/s, "
+                          f"p95 {p95:8.1f} ms, {len(errors)} errors")
+                    if errors or p95 > args.p95_ms:
+                        break
+                    sustained = users
+            finally:
+                process.terminate()
+                process.wait()
+            print(f"  {worker_class}: {sustained} concurrent users within p95 {args.p95_ms} ms")
+
+
+def bench_admission(args):
+    # Well-behaved users mostly chat locally and ask for the weather in a few cities (cached after the first)
+    polite = ["hi", "what time is it", "weather in london", "hello", "weather in paris", "who are you"]
+    with tempfile.TemporaryDirectory() as tmp, StubUpstream(latency=args.latency) as stub:
+        env = {"CHAT_DB_PATH": os.path.join(tmp, 'chat_history.db'), "WEATHER_API_KEY": "stub",
+               "WEATHER_API_URL": stub.url + "/v1/current.json", "TASK_DISPATCHER": "0",
+               "UPSTREAM_CONCURRENCY": str(args.concurrency), "OUTBOUND_POOL_SIZE": str(args.abuser_threads)}
+        print(f"{args.workers} sync workers, {args.users} users pausing {args.think * 1000:.0f} ms between messages, "
+              f"abuser with {args.abuser_threads} connections, {args.latency * 1000:.0f} ms upstream, {args.duration:.0f}s")
+        print(f"  {'':24} {'users p50':>10} {'p99':>9} {'429/503':>8}   {'abuser req/s':>12} {'200':>6} {'429':>6} "
+              f"{'503':>5} {'upstream calls':>15}")
+        for label, limited, abuse in (("no abuser", "1", False), ("abuser, no limits", "0", True),
+                                      ("abuser, admission on", "1", True)):
+            process, base_url = _start_gunicorn("sync", args.workers, {**env, "RATE_LIMIT": limited})
+            try:
+                users = [_login(base_url, f"user{i}") for i in range(args.users)]
+                abuser = _login(base_url, "abuser")
+                latencies, refused, abuse_codes = [], [], []
+                before = sum(stub.hits.values())
+                deadline = time.perf_counter() + args.duration
+
+                def worker(i):
+                    n = 0
+                    while time.perf_counter() < deadline:
+                        n += 1
+                        if i >= args.users:
+                            # A fresh city every time, so nothing is served from the weather cache
+                            try:
+                                response = abuser.post(base_url + "/get_response_route", timeout=30,
+                                                       data={"message": f"weather in abuse{i}x{n}"})
+                                abuse_codes.append(response.status_code)
+                            except Exception:
+                                abuse_codes.append(0)
+                            continue
+                        start = time.perf_counter()
+                        try:
+                            response = users[i].post(base_url + "/get_response_route", timeout=30,
+                                                     data={"message": polite[(i + n) % len(polite)]})
+                            latencies.append((time.perf_counter() - start) * 1000)
+                            if response.status_code != 200:
+                                refused.append(response.status_code)
+                        except Exception:
+                            refused.append(0)
+                        time.sleep(args.think)
+
+                _run_threads(args.users + (args.abuser_threads if abuse else 0), worker)
+                upstream = sum(stub.hits.values()) - before
+            finally:
+                process.terminate()
+                process.wait()
+            codes = {code: abuse_codes.count(code) for code in (200, 429, 503)}
+            print(f"  {label:24} {statistics.median(latencies):8.1f}ms {_percentile(latencies, 99):7.1f}ms "
+                  f"{refused.count(429):4d}/{refused.count(503):<3d}   "
+                  f"{len(abuse_codes) / args.duration:12.1f} {codes[200]:6d} {codes[429]:6d} {codes[503]:5d} {upstream:15d}")
+
+
+def bench_stream(args):
+    # A message with no intent trigger and no noun/help/bye, so it falls through to the LLM
+    message = "could you possibly elaborate"
+    with tempfile.TemporaryDirectory() as tmp, StubUpstream(token_delay=args.token_delay) as stub:
+        app = _import_app(stub, tmp, OPENAI_API_KEY="stub", OPENAI_API_BASE=stub.url + "/v1")
+        app.openai_available = True
+        server, base_url = _serve_app(app)
+        client = _login(base_url)
+        print(f"{len(stub.completion_tokens())}-token completion, {args.token_delay * 1000:.0f} ms between tokens")
+        for route in ("/get_response_route", "/get_response_stream"):
+            first, total = [], []
+            for _ in range(args.requests):
+                start = time.perf_counter()
+                with client.post(base_url + route, data={"message": message, "noCache": "1"},
+                                 stream=True) as response:
+                    chunks = response.iter_content(chunk_size=None)
+                    body = next(chunks)
+                    first.append((time.perf_counter() - start) * 1000)
+                    body += b"".join(chunks)
+                total.append((time.perf_counter() - start) * 1000)
+            print(f"  {route:22} TTFB {statistics.median(first):8.1f} ms   total {statistics.median(total):8.1f} ms"
+                  f"   ({body[:40].decode(errors='replace')}...)")
+        server.shutdown()
+        db.close_all()
+
+
+REPHRASINGS = (
+    lambda q: q,
+    lambda q: q.upper() + "?",
+    lambda q: q.replace("what is", "what's"),
+    lambda q: "please " + q,
+    lambda q: q.replace(" the ", " ") + "??",
+)
+
+
+def bench_answers(args):
+    rng = random.Random(0)
+    letters = "abcdefghijklmnopqrstuvwxyz"
+    word = lambda: "".join(rng.choice(letters) for _ in range(rng.randint(4, 8)))
+    # In pairs that differ in their last word only, which must not share an answer
+    prefixes = [f"what is the {word()} of {word()}" for _ in range(args.questions // 2)]
+    questions = [f"{prefix} {word()}" for prefix in prefixes for _ in range(2)]
+    workload = [(q, rng.choice(REPHRASINGS)(q)) for q in questions for _ in range(args.repeats)]
+    rng.shuffle(workload)
+    # Every phrasing maps back to its question, to catch a near hit that returns another question's answer
+    source = {AnswerCache.normalize(rephrase(q)): q for q in questions for rephrase in REPHRASINGS}
+    with StubUpstream(latency=args.latency, echo=True) as stub:
+        os.environ.update({"OPENAI_API_KEY": "stub", "OPENAI_API_BASE": stub.url + "/v1"})
+        results = {}
+        for mode, cache in (("no cache", AnswerCache(enabled=False)),
+                            ("exact only", AnswerCache(similarity=0, shared=False)),
+                            ("exact + near", AnswerCache(similarity=0.85, shared=False))):
+            # The LLM branch of process_query: cache, then the (fake) completion endpoint
+            before = stub.hits["/v1/chat/completions"]
+            latencies, wrong = [], 0
+            for question, asked in workload:
+                start = time.perf_counter()
+                answer = cache.get(asked)
+                if answer is None:
+                    answer = llm.complete(asked)
+                    cache.put(asked, answer)
+                latencies.append((time.perf_counter() - start) * 1000)
+                wrong += source[AnswerCache.normalize(answer[len("Answer to: "):])] != question
+            results[mode] = (stub.hits["/v1/chat/completions"] - before, latencies, wrong, cache.stats())
+
+    print(f"{len(workload)} questions ({args.questions} distinct, rephrased), "
+          f"{args.latency * 1000:.0f} ms completion latency")
+    for mode, (calls, latencies, wrong, stats) in results.items():
+        print(f"  {mode:12}: {calls:5} API calls, median {statistics.median(latencies):7.2f} ms, "
+              f"p99 {_percentile(latencies, 99):7.2f} ms, {stats['hits']} exact / {stats['near_hits']} near hits, "
+              f"{wrong} answers for another question")
+
+
+def _populate(conn, messages, users, messages_per_chat):
+    conn.execute(CHATS_SCHEMA)
+    chats_per_user = max(1, messages // (users * messages_per_chat))
+
+    def rows():
+        n = 0
+        for u in range(users):
+            for c in range(chats_per_user):
+                for m in range(messages_per_chat):
+                    n += 1
+                    ts = f"2025-{1 + c % 12:02d}-{1 + m % 28:02d} {u % 24:02d}:{c % 60:02d}:{m % 60:02d}"
+                    yield (f"user{u}", f"chat_user{u}_{c}", f"synthetic message {n}", m % 2, ts)
+
+    conn.executemany("INSERT INTO chats (user_id, chat_id, message, is_user, timestamp) VALUES (?, ?, ?, ?, ?)",
+                     rows())
+    conn.commit()
+    return users * chats_per_user * messages_per_chat
+
+
+def _time_queries(queries, repeat):
+    start = time.perf_counter()
+    for _ in range(repeat):
+        for fn in queries:
+            fn()
+    return (time.perf_counter() - start) / (repeat * len(queries)) * 1000
+
+
+def bench_sessions(args):
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, 'sessions.db')
+        conn = sqlite3.connect(path)
+        total = _populate(conn, args.messages, args.users, args.messages_per_chat)
+        conn.close()
+        print(f"{total} synthetic messages, {args.users} users")
+
+        conn = sqlite3.connect(path)
+        sample = [f"user{u}" for u in range(0, args.users, max(1, args.users // 10))]
+
+        def legacy_sidebar(user):
+            return lambda: conn.execute("SELECT DISTINCT chat_id FROM chats WHERE user_id = ? ORDER BY timestamp DESC",
+                                        (user,)).fetchall()
+
+        def legacy_history(user):
+            return lambda: conn.execute("SELECT timestamp, message, is_user FROM chats WHERE user_id = ? AND chat_id = ? "
+                                        "ORDER BY timestamp ASC", (user, f"chat_{user}_0")).fetchall()
+
+        before_sidebar = _time_queries([legacy_sidebar(u) for u in sample], args.repeat)
+        before_history = _time_queries([legacy_history(u) for u in sample], args.repeat)
+        conn.close()
+
+        db.configure(path)
+        start = time.perf_counter()
+        with db.transaction() as conn:
+            db.migrate_chat_indexes(conn)
+        migrate_time = time.perf_counter() - start
+
+        after_sidebar = _time_queries([(lambda u=u: db.list_chat_ids(u)) for u in sample], args.repeat)
+        after_history = _time_queries([(lambda u=u: db.fetch_history(u, f"chat_{u}_0")) for u in sample], args.repeat)
+        db.close_all()
+
+    print(f"  migration (indexes + chat_sessions backfill): {migrate_time:.1f}s")
+    print(f"  sidebar chat list : {before_sidebar:8.2f} ms -> {after_sidebar:8.3f} ms")
+    print(f"  chat history      : {before_history:8.2f} ms -> {after_history:8.3f} ms")
+
+
+def bench_search(args):
+    rng = random.Random(7)
+    vocab = [f"w{n:05d}" for n in range(args.vocab)]
+    # Zipf-like word frequencies, so queries mix very common and rare terms
+    cum_weights = list(itertools.accumulate(1 / (n + 1) for n in range(args.vocab)))
+    with tempfile.TemporaryDirectory() as tmp:
+        db.configure(os.path.join(tmp, 'search.db'))
+        start = time.perf_counter()
+        with db.transaction() as conn:
+            conn.execute(CHATS_SCHEMA)
+            conn.executemany(db.INSERT_MESSAGE, (
+                (f"user{n % args.users}", f"chat_user{n % args.users}_{n // 5000}",
+                 " ".join(rng.choices(vocab, cum_weights=cum_weights, k=rng.randint(4, 20))), n % 2, f"2025-01-01 00:00:{n % 60:02d}")
+                for n in range(args.messages)))
+            db.migrate_chat_indexes(conn)
+        load_time = time.perf_counter() - start
+        start = time.perf_counter()
+        with db.transaction() as conn:
+            db.migrate_chats_fts(conn)
+        build_time = time.perf_counter() - start
+        size = os.path.getsize(os.path.join(tmp, 'search.db'))
+
+        users = [f"user{rng.randrange(args.users)}" for _ in range(args.queries)]
+        kinds = {"common word": lambda: vocab[rng.randrange(10)],
+                 "rare word": lambda: vocab[rng.randrange(args.vocab // 2, args.vocab)],
+                 "two words": lambda: f"{vocab[rng.randrange(100)]} {vocab[rng.randrange(100, 1000)]}",
+                 "three words": lambda: " ".join(vocab[rng.randrange(n, 10 * n)] for n in (10, 100, 1000))}
+        conn = db.get_connection()
+        print(f"{args.messages} messages, {args.users} users: load {load_time:.1f}s, "
+              f"FTS backfill {build_time:.1f}s, database {size / 2**20:.0f} MiB")
+        print(f"  {'query':12} {'LIKE p50':>10} {'LIKE p95':>10} {'FTS p50':>10} {'FTS p95':>10}")
+        for kind, term in kinds.items():
+            terms = [term() for _ in users]
+            like, fts = [], []
+            for user, text in zip(users, terms):
+                # What a search without the index has to do: scan every message of the user
+                pattern = "%" + "%".join(text.split()) + "%"
+                begin = time.perf_counter()
+                conn.execute("SELECT id, chat_id, timestamp, message FROM chats WHERE user_id = ? AND message LIKE ? "
+                             "ORDER BY timestamp DESC LIMIT 20", (user, pattern)).fetchall()
+                like.append((time.perf_counter() - begin) * 1000)
+                begin = time.perf_counter()
+                db.search_chats(user, text, 20)
+                fts.append((time.perf_counter() - begin) * 1000)
+            print(f"  {kind:12} {_percentile(like, 50):8.2f}ms {_percentile(like, 95):8.2f}ms "
+                  f"{_percentile(fts, 50):8.2f}ms {_percentile(fts, 95):8.2f}ms")
+        db.close_all()
+
+
+def _dir_size(path):
+    return sum(os.path.getsize(os.path.join(root, name)) for root, _, files in os.walk(path) for name in files)
+
+
+def bench_maintenance(args):
+    rng = random.Random(11)
+    vocab = [f"w{n:05d}" for n in range(5000)]
+    cum_weights = list(itertools.accumulate(1 / (n + 1) for n in range(len(vocab))))
+    with tempfile.TemporaryDirectory() as tmp, StubUpstream() as stub:
+        # Created the way the app used to create it: no auto_vacuum, so the conversion is part of the cost
+        path = os.path.join(tmp, 'chat_history.db')
+        sqlite3.connect(path).execute("PRAGMA journal_mode=WAL").close()
+        app = _import_app(stub, tmp, MAINTENANCE="0", CHAT_ARCHIVE_AFTER_DAYS=str(args.archive_after),
+                          CHAT_RETENTION_DAYS=str(args.retention))
+        import chat_archive
+        import maintenance
+        now = datetime.now()
+        chats = []
+        start = time.perf_counter()
+        with db.transaction() as conn:
+            n = 0
+            while n < args.messages:
+                user = f"user{rng.randrange(args.users)}"
+                chat_id = f"chat_{user}_{len(chats)}"
+                day = now - timedelta(days=rng.random() * args.days)
+                length = rng.randint(2, 2 * args.messages_per_chat) // 2 * 2
+                conn.executemany(db.INSERT_MESSAGE, (
+                    (user, chat_id, " ".join(rng.choices(vocab, cum_weights=cum_weights, k=rng.randint(4, 30))), m % 2,
+                     (day + timedelta(seconds=30 * m)).strftime("%Y-%m-%d %H:%M:%S")) for m in range(length)))
+                chats.append((user, chat_id, day))
+                n += length
+        # Users delete some chats over the years, leaving free pages behind
+        db.delete_chats([(user, chat_id) for user, chat_id, _ in rng.sample(chats, int(len(chats) * args.deleted))])
+        db.checkpoint()
+        load_time = time.perf_counter() - start
+        live = {(user, chat_id) for user, chat_id in db.get_connection().execute(
+            "SELECT user_id, chat_id FROM chat_sessions")}
+        cutoff = now - timedelta(days=args.archive_after)
+        expiry = now - timedelta(days=args.retention or args.days + 1)
+        recent = [(u, c) for u, c, day in chats if (u, c) in live and day > cutoff]
+        # Old enough to be archived, young enough to outlive retention
+        old = [(u, c) for u, c, day in chats if (u, c) in live and expiry < day <= cutoff]
+        sample_users = [f"user{rng.randrange(args.users)}" for _ in range(args.queries)]
+        sample_recent = [rng.choice(recent) for _ in range(args.queries)]
+        sample_old = [rng.choice(old) for _ in range(args.queries)]
+        conn = db.get_connection()
+
+        def measure():
+            def timed(fn, samples):
+                latencies = []
+                for sample in samples:
+                    begin = time.perf_counter()
+                    fn(*sample)
+                    latencies.append((time.perf_counter() - begin) * 1000)
+                return _percentile(latencies, 50), _percentile(latencies, 95)
+
+            chat_archive._read_block.cache_clear()
+            return {
+                "sidebar chat list": timed(lambda u: db.list_chat_ids(u), [(u,) for u in sample_users]),
+                "recent chat page": timed(lambda u, c: app.get_chat_history(u, c), sample_recent),
+                "old chat page (cold)": timed(lambda u, c: app.get_chat_history(u, c), sample_old),
+                # Reopening a few chats: archived blocks now come from the per-process cache
+                "old chat page (warm)": timed(lambda u, c: app.get_chat_history(u, c),
+                                              [sample_old[i % 10] for i in range(args.queries)]),
+                "search": timed(lambda u: db.search_chats(u, rng.choice(vocab[50:500]), 20),
+                                [(u,) for u in sample_users]),
+                "full-table scan": timed(lambda: conn.execute(
+                    "SELECT COUNT(*) FROM chats WHERE message LIKE '%w0499%'").fetchone(), [()] * 10),
+                "turn insert": timed(lambda u, c: db.insert_turn(u, c, "hello", "hi", _timestamp()), sample_recent),
+            }
+
+        def size():
+            db.checkpoint()
+            return os.path.getsize(path), db.freelist_count()
+
+        before_size, before_free = size()
+        before = measure()
+        start = time.perf_counter()
+        maintenance.convert_auto_vacuum()
+        vacuum_time = time.perf_counter() - start
+        start = time.perf_counter()
+        report = maintenance.run_once()
+        run_time = time.perf_counter() - start
+        after_size, after_free = size()
+        archive_size = _dir_size(chat_archive.archive_dir())
+        after = measure()
+        # An incremental run a week later: only what became old (or was deleted) since
+        db.delete_chats(rng.sample(recent, len(recent) // 20))
+        start = time.perf_counter()
+        second = maintenance.run_once(now + timedelta(days=7))
+        second_time = time.perf_counter() - start
+        db.close_all()
+
+    print(f"{args.messages} messages in {len(chats)} chats over {args.days} days, {args.users} users, "
+          f"{args.deleted:.0%} of chats deleted; built in {load_time:.0f}s")
+    print(f"  retention {f'{args.retention} days' if args.retention else 'forever'}, archive after {args.archive_after} days")
+    print(f"  database        : {before_size / 2**20:7.1f} MiB ({before_free} free pages) -> "
+          f"{after_size / 2**20:7.1f} MiB ({after_free} free pages) + {archive_size / 2**20:.1f} MiB of archives")
+    print(f"  one-time VACUUM (auto_vacuum conversion): {vacuum_time:.1f}s")
+    print(f"  first run       : {run_time:.1f}s, {report}")
+    print(f"  run a week later: {second_time:.2f}s, {second}")
+    print(f"  {'query':22} {'before p50':>11} {'p95':>9} {'after p50':>11} {'p95':>9}")
+    for name in before:
+        (b50, b95), (a50, a95) = before[name], after[name]
+        print(f"  {name:22} {b50:9.2f}ms {b95:7.2f}ms {a50:9.2f}ms {a95:7.2f}ms")
+
+
+BATCH_TEMPLATES = (
+    (30, lambda rng: f"weather in {rng.choice(BATCH_CITIES)}"),
+    (15, lambda rng: f"news about {rng.choice(BATCH_TOPICS)}"),
+    (10, lambda rng: rng.choice(["hi", "hello there", "hey"])),
+    (5, lambda rng: "what time is it"),
+    (5, lambda rng: "who are you"),
+    # Reaches the NLTK fallback (the router matches substrings, so no "hi", "time"... inside words)
+    (20, lambda rng: f"describe {rng.choice(BATCH_TOPICS)} trends {rng.randrange(1000)}"),
+    (15, lambda rng: rng.choice(["please help me", "ok bye", "thanks a lot"])),
+)
+BATCH_CITIES = ["London", "Paris", "Tokyo", "Delhi", "Lagos", "Lima", "Oslo", "Cairo", "Sydney", "Toronto",
+                "Berlin", "Madrid", "Rome", "Seoul", "Dubai", "Nairobi", "Quito", "Hanoi", "Dublin", "Austin"]
+BATCH_TOPICS = ["tech", "sports", "science", "music", "finance", "health", "travel", "movies", "space", "food"]
+
+
+def bench_batch(args):
+    import nlp
+    try:
+        nlp.pos_tag_many(["warm up the tagger"])
+    except LookupError as e:
+        print(f"NLTK data missing, run ./build.sh first: {e}")
+        return
+    rng = random.Random(3)
+    weights = list(itertools.accumulate(weight for weight, _ in BATCH_TEMPLATES))
+    batches = [[rng.choices(BATCH_TEMPLATES, cum_weights=weights)[0][1](rng) for _ in range(args.size)]
+               for _ in range(args.batches)]
+    with tempfile.TemporaryDirectory() as tmp, StubUpstream(latency=args.latency, echo=True) as stub:
+        # Rate limits off: the sequential client sends a batch's worth of messages back to back
+        app = _import_app(stub, tmp, RATE_LIMIT="0", MAINTENANCE="0", OPENAI_API_KEY="stub",
+                          OPENAI_API_BASE=stub.url + "/v1")
+        server, base_url = _serve_app(app)
+        client = _login(base_url)
+        results = {}
+        for mode in ("sequential", "batch"):
+            upstream_before = sum(stub.hits.values())
+            elapsed = []
+            for messages in batches:
+                for cache in (app.weather_cache, app.news_cache, app.answer_cache):
+                    cache.clear()
+                start = time.perf_counter()
+                if mode == "sequential":
+                    for message in messages:
+                        client.post(base_url + "/get_response_route", data={"message": message}).raise_for_status()
+                else:
+                    response = client.post(base_url + "/get_response_batch", json={"messages": messages})
+                    response.raise_for_status()
+                    assert len(response.json()["responses"]) == len(messages)
+                elapsed.append(time.perf_counter() - start)
+            results[mode] = (elapsed, sum(stub.hits.values()) - upstream_before)
+        server.shutdown()
+        db.close_all()
+
+    print(f"{args.batches} batches of {args.size} messages, {args.latency * 1000:.0f} ms upstream latency, "
+          f"caches cleared before each batch")
+    for mode, (elapsed, upstream) in results.items():
+        total = args.batches * args.size
+        print(f"  {mode:10}: {total / sum(elapsed):8.0f} messages/s, {statistics.median(elapsed):7.2f} s per "
+              f"{args.size} messages, {upstream / args.batches:6.0f} upstream calls per batch")
+
+
+def bench_knowledge(args):
+    per_worker = args.writes // args.workers
+    total = per_worker * args.workers
+    seed = {f"seed_category_{n}": [f"seed answer {n}"] for n in range(args.entries)}
+    with tempfile.TemporaryDirectory() as tmp:
+        # Legacy: every worker loaded its own copy of the JSON at import and rewrites the whole file per /learn
+        seed_path = os.path.join(tmp, 'seed.json')
+        with open(seed_path, 'w') as f:
+            json.dump(seed, f)
+        path = os.path.join(tmp, 'knowledge_base.json')
+        shutil.copy(seed_path, path)
+        copies = [json.loads(json.dumps(seed)) for _ in range(args.workers)]
+        start = time.perf_counter()
+        for n in range(per_worker):
+            for i, kb in enumerate(copies):
+                kb.setdefault(f"learned_{i}_{n}", []).append(f"answer {n}")
+                with open(path, 'w') as f:
+                    json.dump(kb, f)
+        legacy_time = time.perf_counter() - start
+        with open(path) as f:
+            legacy_kept = sum(key.startswith("learned_") for key in json.load(f))
+
+        db.configure(os.path.join(tmp, 'knowledge.db'))
+        with db.transaction() as conn:
+            for statement in db.KNOWLEDGE_SCHEMA:
+                conn.execute(statement)
+            knowledge_store.import_seed(conn, seed_path)
+        stores = [knowledge_store.KnowledgeBase() for _ in range(args.workers + 1)]
+        for store in stores:
+            store.refresh(force=True)
+
+        def writer(i):
+            for n in range(per_worker):
+                stores[i].add(f"learned_{i}_{n}", f"answer {n}")
+
+        store_time = _run_threads(args.workers, writer)
+        # The extra store never wrote anything; it catches up on every worker's answers in one query
+        reader = stores[-1]
+        start = time.perf_counter()
+        reader.refresh(force=True)
+        pickup_ms = (time.perf_counter() - start) * 1000
+        store_kept = sum(key.startswith("learned_") for key in reader.entries)
+        db.close_all()
+
+    print(f"{total} learned answers from {args.workers} workers on top of {args.entries} existing entries")
+    print(f"  rewrite knowledge_base.json : {total / legacy_time:10.0f} writes/s  ({legacy_kept}/{total} survive)")
+    print(f"  append to knowledge table   : {total / store_time:10.0f} writes/s  ({store_kept}/{total} survive, "
+          f"{legacy_time / store_time:.1f}x)")
+    print(f"  incremental pickup by an idle worker: {pickup_ms:.2f} ms")
+
+
+def _paraphrase(words, rng):
+    # Drop a word, shuffle, wrap in filler and add a typo: no category survives verbatim
+    words = list(words)
+    if len(words) > 3:
+        words.pop(rng.randrange(len(words)))
+    rng.shuffle(words)
+    i = rng.randrange(len(words))
+    w = words[i]
+    if len(w) > 3:
+        j = rng.randrange(len(w) - 1)
+        words[i] = w[:j] + w[j + 1] + w[j] + w[j + 2:]
+    return f"{rng.choice(['can you tell me', 'do you know', 'please explain', 'i wonder'])} {' '.join(words)}?"
+
+
+def _percentile(samples, pct):
+    ordered = sorted(samples)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * pct / 100))]
+
+
+def bench_semantic(args):
+    rng = random.Random(0)
+    letters = "abcdefghijklmnopqrstuvwxyz"
+    vocab = sorted({"".join(rng.choice(letters) for _ in range(rng.randint(4, 9))) for _ in range(args.vocab)})
+    entries = []
+    for n in range(args.entries):
+        words = rng.sample(vocab, rng.randint(3, 5))
+        entries.append(("_".join(words), words, " ".join(rng.sample(vocab, 8))))
+
+    index = SemanticIndex(min_score=0.0)
+    start = time.perf_counter()
+    index.add([c for c, _, _ in entries], [f"{c} {a}" for c, _, a in entries])
+    build_time = time.perf_counter() - start
+
+    sample = rng.sample(entries, args.queries)
+    queries = [(c, _paraphrase(words, rng)) for c, words, _ in sample]
+    legacy_hits = sum(c in q for c, q in queries)
+    latencies, top1, top5 = [], 0, 0
+    for category, query in queries:
+        start = time.perf_counter()
+        hits = index.search(query, k=5)
+        latencies.append((time.perf_counter() - start) * 1000)
+        keys = [key for key, _ in hits]
+        top1 += bool(keys) and keys[0] == category
+        top5 += category in keys
+    start = time.perf_counter()
+    index.search_many([q for _, q in queries], k=5)
+    batch_ms = (time.perf_counter() - start) * 1000 / len(queries)
+
+    learned = [(f"learned_{n}_{w1}_{w2}_{w3}", [w1, w2, w3, f"learned{n}"], "fresh answer")
+               for n, (w1, w2, w3) in enumerate(rng.sample(vocab, 3) for _ in range(args.learn))]
+    start = time.perf_counter()
+    for category, _, answer in learned:
+        index.add([category], [f"{category} {answer}"])
+    add_ms = (time.perf_counter() - start) * 1000 / len(learned)
+    learned_top1 = sum(bool(hits) and hits[0][0] == category
+                       for (category, words, _), hits in zip(learned, index.search_many(
+                           [_paraphrase(words, rng) for _, words, _ in learned])))
+
+    # Questions that must go unanswered: one category word swapped for a word the entry never uses, or unrelated words
+    guarded = SemanticIndex(min_score=0.0, match_words=True)
+    guarded.add([c for c, _, _ in entries], [f"{c} {a}" for c, _, a in entries])
+
+    def swap_one(words, answer):
+        # Swapped after paraphrasing, so the dropped word is never the replacement
+        used = set(words) | set(answer.split())
+        replacement = rng.choice(vocab)
+        while replacement in used:
+            replacement = rng.choice(vocab)
+        tokens = _paraphrase(words, rng).rstrip("?").split()
+        i = rng.choice([i for i, token in enumerate(tokens) if token in words])
+        tokens[i] = replacement
+        return " ".join(tokens) + "?"
+
+    near_misses = [swap_one(words, answer) for _, words, answer in sample]
+    unrelated = [_paraphrase(rng.sample(vocab, 3), rng) for _ in sample]
+
+    def precision(min_score, match_words):
+        # The same index at each threshold, with and without the content-word check
+        guarded.min_score, guarded.match_words = min_score, match_words
+        top = [hits[0][0] if hits else None for hits in guarded.search_many([q for _, q in queries])]
+        right = sum(key == category for key, (category, _) in zip(top, queries))
+        wrong = sum(key is not None and key != category for key, (category, _) in zip(top, queries))
+        near = sum(bool(hits) for hits in guarded.search_many(near_misses))
+        stray = sum(bool(hits) for hits in guarded.search_many(unrelated))
+        return right, near, stray, right / max(1, right + wrong + near + stray)
+
+    n = len(queries)
+    checks = [(f"{min_score:.2f} {label}", precision(min_score, match_words)) for min_score in (0.0, MIN_SCORE)
+              for label, match_words in (("score only", False), ("+ words", True))]
+    print(f"{args.entries} entries, {n} paraphrased queries")
+    print(f"  build               : {build_time:8.2f} s")
+    print(f"  recall (substring)  : {legacy_hits / n:8.1%}")
+    print(f"  recall@1 / recall@5 : {top1 / n:8.1%} / {top5 / n:.1%}")
+    print(f"  lookup p50 / p99    : {statistics.median(latencies):8.2f} ms / {_percentile(latencies, 99):.2f} ms")
+    print(f"  batched lookup      : {batch_ms:8.2f} ms/query")
+    print(f"  incremental add     : {add_ms:8.2f} ms/entry amortized over {len(learned)}, "
+          f"recall@1 on them {learned_top1 / len(learned):.1%}")
+    print(f"By min_score and check, {n} near-miss and {n} unrelated queries that should go unanswered:")
+    for label, (right, near, stray, share) in checks:
+        print(f"  {label:<16}: recall@1 {right / n:6.1%}, answered near-miss {near / n:6.1%}, "
+              f"unrelated {stray / n:6.1%}, precision {share:6.1%}")
+
+
+def bench_history(args):
+    with tempfile.TemporaryDirectory() as tmp, StubUpstream() as stub:
+        app = _import_app(stub, tmp)
+        with db.transaction() as conn:
+            conn.executemany(db.INSERT_MESSAGE, (("bench", "chat_long", f"message {n} " + "x" * 200, n % 2,
+                                                  _timestamp()) for n in range(args.messages)))
+            conn.executemany(db.INSERT_MESSAGE, (("bench", f"chat_{n}", "hello", 1, _timestamp())
+                                                 for n in range(args.chats)))
+        server, base_url = _serve_app(app)
+        client = _login(base_url)
+
+        def timed(url, headers=None):
+            start = time.perf_counter()
+            for _ in range(args.repeat):
+                response = client.get(base_url + url, headers=headers)
+            return (time.perf_counter() - start) * 1000 / args.repeat, response
+
+        full_ms = _time_queries([lambda: db.fetch_history("bench", "chat_long")], args.repeat)
+        full_bytes = len(json.dumps(db.fetch_history("bench", "chat_long")))
+        page_ms, page = timed("/get_history?chatId=chat_long")
+        oldest = page.json()["history"][0]["id"]
+        older_ms, _ = timed(f"/get_history?chatId=chat_long&before={oldest}")
+        newest = page.json()["history"][-1]["id"]
+        since_ms, since = timed(f"/get_history?chatId=chat_long&since={newest}")
+        list_ms, listing = timed("/chat_ids")
+        cached_ms, not_modified = timed("/chat_ids", headers={"If-None-Match": listing.headers["ETag"]})
+        server.shutdown()
+        db.close_all()
+
+    print(f"chat with {args.messages} messages, {args.chats} chats in the sidebar")
+    print(f"  full history (old /get_history) : {full_ms:8.2f} ms query, {full_bytes / 1024:8.0f} KiB")
+    print(f"  newest page                     : {page_ms:8.2f} ms request, {len(page.content) / 1024:8.1f} KiB")
+    print(f"  older page (before=)            : {older_ms:8.2f} ms request")
+    print(f"  new messages (since=)           : {since_ms:8.2f} ms request, {len(since.content)} bytes")
+    print(f"  chat list                       : {list_ms:8.2f} ms request, {len(listing.content) / 1024:8.1f} KiB")
+    print(f"  chat list, If-None-Match        : {cached_ms:8.2f} ms request, status {not_modified.status_code}")
+
+
+def _page_load(client, page, cache):
+    """(requests, bytes) to load page and its same-origin css/js; cache holds (ETag, Cache-Control) from earlier visits."""
+    response = client.get(page)
+    requests, total = 1, len(response.data)
+    for url in re.findall(r'(?:href|src)="(/[^"]+\.(?:css|js))"', response.get_data(as_text=True)):
+        if url in cache and "immutable" in cache[url][1]:
+            continue
+        headers = {"Accept-Encoding": "gzip, br"}
+        if url in cache:
+            headers["If-None-Match"] = cache[url][0]
+        asset = client.get(url, headers=headers)
+        requests += 1
+        total += len(asset.data)
+        if asset.status_code == 200:
+            cache[url] = (asset.headers.get("ETag", ""), asset.headers.get("Cache-Control", ""))
+    return requests, total
+
+
+def _photo(width, height):
+    from PIL import Image, ImageFilter
+    # Smoothed noise compresses roughly like a photo, unlike a flat colour
+    noise = Image.effect_noise((width // 4, height // 4), 64).resize((width, height)).filter(ImageFilter.GaussianBlur(2))
+    image = Image.merge("RGB", (noise, noise.transpose(Image.FLIP_LEFT_RIGHT), noise.transpose(Image.FLIP_TOP_BOTTOM)))
+    output = io.BytesIO()
+    image.save(output, "JPEG", quality=90)
+    return output.getvalue()
+
+
+def bench_assets(args):
+    import assets
+    import avatars
+    with tempfile.TemporaryDirectory() as tmp, StubUpstream() as stub:
+        app = _import_app(stub, tmp)
+        static = os.path.join(tmp, "static")
+        shutil.copytree(app.app.static_folder, static, ignore=shutil.ignore_patterns("dist", "uploads"))
+        app.app.static_folder = static
+        app.app.config['UPLOAD_FOLDER'] = os.path.join(static, "uploads")
+        app.asset_manifest = assets.Manifest(static)
+        client = app.app.test_client()
+        credentials = {"username": "bench", "password": "bench-password", "name": "Bench", "email": "bench@example.com"}
+        client.post("/register", data=credentials)
+        client.post("/login", data=credentials)
+        photo = _photo(args.width, args.height)
+        client.post("/settings", content_type="multipart/form-data", data={
+            **credentials, "current_password": credentials["password"],
+            "profile_picture": (io.BytesIO(photo), "photo.jpg")})
+
+        # The page as it was: css and js inline, so none of it is cacheable
+        inline = len(client.get("/").data) + sum(os.path.getsize(os.path.join(static, path))
+                                                 for path in ("css/chat.css", "js/chat.js"))
+        unbuilt_cache = {}
+        unbuilt = [_page_load(client, "/", unbuilt_cache) for _ in range(2)]
+        manifest = assets.build(static)
+        app.asset_manifest.reload()
+        built_cache = {}
+        built = [_page_load(client, "/", built_cache) for _ in range(2)]
+        avatar = client.get(re.search(r'<img src="([^"]+)" class="avatar"', client.get("/").get_data(as_text=True))[1])
+        db.close_all()
+
+    print(f"index page, {len(manifest)} assets built ({'gzip + brotli' if assets.brotli else 'gzip only'})")
+    print(f"  {'':34} {'first visit':>22} {'repeat visit':>22}")
+    print(f"  {'inline css/js (before)':34} {1:5d} req {inline / 1024:9.1f} KiB {1:5d} req {inline / 1024:9.1f} KiB")
+    for label, (first, repeat) in (("/static/ files, no build", unbuilt), ("fingerprinted + compressed", built)):
+        print(f"  {label:34} {first[0]:5d} req {first[1] / 1024:9.1f} KiB {repeat[0]:5d} req {repeat[1] / 1024:9.1f} KiB")
+    print(f"  avatar: {args.width}x{args.height} upload {len(photo) / 1024:.0f} KiB -> {avatars.SIZE}px thumbnail "
+          f"{len(avatar.data) / 1024:.1f} KiB ({avatar.headers['Cache-Control']})")
+
+
+# Replies process_query and get_response_route give instead of raising
+ERROR_REPLIES = {"An error occurred. Try again.", "Error processing your request. Try again.",
+                 "OpenAI API error. Using fallback response.", "OpenAI error. Using fallback response."}
+
+
+def _replay(base_url, records, concurrency, speed):
+    import requests
+    # Log every user in once up front; workers reuse the session cookie, so password hashing stays out of the timings
+    logins = {}
+    for record in records:
+        user = f"replay_{record.get('user') or 'anonymous'}"
+        if user not in logins:
+            logins[user] = _login(base_url, user).cookies
+    # Workers take records in log order; with speed > 0 each waits for its recorded offset (divided by speed)
+    results = [None] * len(records)
+    cursor = iter(range(len(records)))
+    cursor_lock = threading.Lock()
+    first_ts = records[0].get("ts", 0)
+    start = time.perf_counter()
+
+    def worker(i):
+        clients = {}
+        while True:
+            with cursor_lock:
+                n = next(cursor, None)
+            if n is None:
+                return
+            record = records[n]
+            if speed:
+                delay = (record.get("ts", first_ts) - first_ts) / speed - (time.perf_counter() - start)
+                if delay > 0:
+                    time.sleep(delay)
+            user = f"replay_{record.get('user') or 'anonymous'}"
+            if user not in clients:
+                clients[user] = requests.Session()
+                clients[user].cookies.update(logins[user])
+            endpoint = record.get("endpoint") or "get_response_route"
+            sent = time.perf_counter()
+            try:
+                if endpoint == "get_response_batch":
+                    response = clients[user].post(base_url + "/get_response_batch", timeout=30, json={
+                        "messages": record["message"], "noCache": bool(record.get("no_cache"))})
+                    ok = response.status_code == 200 and "responses" in response.json()
+                else:
+                    # A streamed reply is read to the end, so its time is the whole stream's
+                    response = clients[user].post(f"{base_url}/{endpoint}", timeout=30, data={
+                        "message": record["message"], "noCache": "1" if record.get("no_cache") else "0"})
+                    ok = response.status_code == 200 and response.text not in ERROR_REPLIES
+                results[n] = ((time.perf_counter() - sent) * 1000, ok)
+            except Exception:
+                results[n] = ((time.perf_counter() - sent) * 1000, False)
+
+    elapsed = _run_threads(concurrency, worker)
+    return results, elapsed
+
+
+def bench_replay(args):
+    records = [record for record in request_log.read(args.log) if record.get("message")][:args.limit or None]
+    if not records:
+        sys.exit(f"No requests found in {' '.join(args.log)}")
+    with tempfile.TemporaryDirectory() as tmp, StubUpstream(latency=args.latency, echo=True) as stub:
+        env = {"CHAT_DB_PATH": os.path.join(tmp, 'chat_history.db'), "OPENAI_API_KEY": "stub",
+               "OPENAI_API_BASE": stub.url + "/v1", "REQUEST_LOG": "0"}
+        if args.gunicorn:
+            env.update({"WEATHER_API_KEY": "stub", "NEWSAPI_KEY": "stub", "ZAPIER_WEBHOOK_URL": stub.url + "/hooks/catch",
+                        "WEATHER_API_URL": stub.url + "/v1/current.json", "NEWS_API_URL": stub.url + "/v2/everything",
+                        "OUTBOUND_POOL_SIZE": str(args.concurrency)})
+            process, base_url = _start_gunicorn(args.gunicorn, args.workers, env)
+        else:
+            app = _import_app(stub, tmp, **env)
+            app.openai_available = True
+            server, base_url = _serve_app(app)
+        try:
+            results, elapsed = _replay(base_url, records, args.concurrency, args.speed)
+        finally:
+            if args.gunicorn:
+                process.terminate()
+                process.wait()
+            else:
+                server.shutdown()
+                db.close_all()
+        upstream = dict(stub.hits)
+
+    latencies = [ms for ms, _ in results]
+    errors = sum(not ok for _, ok in results)
+    target = f"gunicorn {args.gunicorn} x{args.workers}" if args.gunicorn else "in-process server"
+    pace = f"{args.speed:g}x recorded pace" if args.speed else "closed loop"
+    print(f"{len(records)} requests from {len(args.log)} log(s), {args.concurrency} concurrent, {pace}, {target}, "
+          f"{args.latency * 1000:.0f} ms stub latency")
+    print(f"  throughput : {len(records) / elapsed:8.1f} req/s ({elapsed:.2f}s)")
+    print(f"  latency    : p50 {_percentile(latencies, 50):8.2f} ms   p95 {_percentile(latencies, 95):8.2f} ms   "
+          f"p99 {_percentile(latencies, 99):8.2f} ms")
+    print(f"  errors     : {errors} ({errors / len(records):.1%})")
+    print(f"  upstream   : {', '.join(f'{path} {hits}' for path, hits in sorted(upstream.items())) or 'none'}")
+    by_intent = {}
+    for record, (ms, _) in zip(records, results):
+        by_intent.setdefault(record.get("intent") or "fallback", []).append((ms, record.get("latency_ms")))
+    print(f"  {'intent':16} {'count':>6} {'p50 ms':>9} {'p95 ms':>9} {'in-app p50 (log)':>17}")
+    for intent, samples in sorted(by_intent.items(), key=lambda item: -len(item[1])):
+        replayed = [ms for ms, _ in samples]
+        recorded = [ms for _, ms in samples if ms is not None]
+        print(f"  {intent:16} {len(samples):6} {_percentile(replayed, 50):9.2f} {_percentile(replayed, 95):9.2f} "
+              f"{_percentile(recorded, 50) if recorded else float('nan'):17.2f}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Chatbot performance benchmarks")
+    sub = parser.add_subparsers(dest="benchmark", required=True)
+
+    p = sub.add_parser("db", help="message writes/sec: per-call sqlite3.connect vs pooled WAL connections")
+    p.add_argument("--messages", type=int, default=5000)
+    p.add_argument("--threads", type=int, default=4)
+    p.set_defaults(func=bench_db)
+
+    p = sub.add_parser("turns", help="turns/sec: two commits vs one transaction vs write-behind queue")
+    p.add_argument("--turns", type=int, default=5000)
+    p.add_argument("--threads", type=int, default=4)
+    p.set_defaults(func=bench_turns)
+
+    p = sub.add_parser("router", help="intent routing latency: substring cascade vs compiled automaton")
+    p.add_argument("--categories", type=int, default=10000)
+    p.add_argument("--messages", type=int, default=2000)
+    p.add_argument("--learn", type=int, default=1000)
+    p.set_defaults(func=bench_router)
+
+    p = sub.add_parser("nltk", help="per-intent latency: eager tokenize/tag vs lazy memoized features")
+    p.add_argument("--repeat", type=int, default=200)
+    p.set_defaults(func=bench_nltk)
+
+    p = sub.add_parser("startup", help="cold-start time of a worker (import app + create_app)")
+    p.add_argument("--runs", type=int, default=10)
+    p.add_argument("--target-ms", type=int, default=1000)
+    p.set_defaults(func=bench_startup)
+
+    p = sub.add_parser("cache", help="weather burst against a local stub: upstream calls with and without the cache")
+    p.add_argument("--cities", type=int, default=5)
+    p.add_argument("--threads", type=int, default=20)
+    p.add_argument("--requests", type=int, default=10)
+    p.add_argument("--latency", type=float, default=0.2)
+    p.add_argument("--shared", action="store_true", help="also back the cache with the SQLite table")
+    p.set_defaults(func=bench_cache)
+
+    p = sub.add_parser("outbound", help="bare requests vs pooled client with retries and circuit breaker")
+    p.add_argument("--calls", type=int, default=200)
+    p.add_argument("--latency", type=float, default=0.005)
+    p.add_argument("--failure-rate", type=float, default=0.3)
+    p.set_defaults(func=bench_outbound)
+
+    p = sub.add_parser("outbox", help="chat reply latency: inline Zapier POST vs durable outbox")
+    p.add_argument("--tasks", type=int, default=20)
+    p.add_argument("--latency", type=float, default=0.3)
+    p.set_defaults(func=bench_outbox)
+
+    p = sub.add_parser("admission", help="users' p50/p99 while one client floods uncached lookups, with and without admission control")
+    p.add_argument("--workers", type=int, default=4)
+    p.add_argument("--users", type=int, default=8)
+    p.add_argument("--think", type=float, default=1.0, help="pause between a user's messages in seconds")
+    p.add_argument("--abuser-threads", type=int, default=16)
+    p.add_argument("--concurrency", type=int, default=3, help="UPSTREAM_CONCURRENCY for the run")
+    p.add_argument("--latency", type=float, default=0.2)
+    p.add_argument("--duration", type=float, default=10)
+    p.set_defaults(func=bench_admission)
+
+    p = sub.add_parser("stream", help="time-to-first-byte of the OpenAI fallback: blocking vs streaming route")
+    p.add_argument("--requests", type=int, default=5)
+    p.add_argument("--token-delay", type=float, default=0.05)
+    p.set_defaults(func=bench_stream)
+
+    p = sub.add_parser("answers", help="OpenAI calls and latency for repeated questions with and without the answer cache")
+    p.add_argument("--questions", type=int, default=200)
+    p.add_argument("--repeats", type=int, default=5)
+    p.add_argument("--latency", type=float, default=0.05)
+    p.set_defaults(func=bench_answers)
+
+    p = sub.add_parser("serving", help="concurrent users sustained at a fixed p95: sync vs gevent gunicorn workers")
+    p.add_argument("--workers", type=int, default=2)
+    p.add_argument("--users", type=int, nargs="+", default=[1, 2, 4, 8, 16, 32, 64, 128])
+    p.add_argument("--latency", type=float, default=0.2)
+    p.add_argument("--p95-ms", type=int, default=500)
+    p.add_argument("--duration", type=float, default=3.0)
+    p.set_defaults(func=bench_serving)
+
+    p = sub.add_parser("history", help="paginated history, since= fetches and the chat list ETag vs the full history")
+    p.add_argument("--messages", type=int, default=50000)
+    p.add_argument("--chats", type=int, default=2000)
+    p.add_argument("--repeat", type=int, default=20)
+    p.set_defaults(func=bench_history)
+
+    p = sub.add_parser("assets", help="index page requests and bytes: inline css/js vs fingerprinted, precompressed assets")
+    p.add_argument("--width", type=int, default=3000, help="size of the synthetic profile photo uploaded")
+    p.add_argument("--height", type=int, default=2000)
+    p.set_defaults(func=bench_assets)
+
+    p = sub.add_parser("sessions", help="sidebar/history query latency before and after the chat_sessions migration")
+    p.add_argument("--messages", type=int, default=1000000)
+    p.add_argument("--users", type=int, default=200)
+    p.add_argument("--messages-per-chat", type=int, default=50)
+    p.add_argument("--repeat", type=int, default=5)
+    p.set_defaults(func=bench_sessions)
+
+    p = sub.add_parser("search", help="message search latency: LIKE scan vs the chats_fts index, p50/p95")
+    p.add_argument("--messages", type=int, default=2000000)
+    p.add_argument("--users", type=int, default=100)
+    p.add_argument("--vocab", type=int, default=20000)
+    p.add_argument("--queries", type=int, default=200)
+    p.set_defaults(func=bench_search)
+
+    p = sub.add_parser("maintenance", help="database size and query latency on an aged dataset before and after retention/archival/vacuum")
+    p.add_argument("--messages", type=int, default=500000)
+    p.add_argument("--users", type=int, default=200)
+    p.add_argument("--messages-per-chat", type=int, default=30)
+    p.add_argument("--days", type=int, default=730, help="age of the oldest chat")
+    p.add_argument("--archive-after", type=int, default=30)
+    p.add_argument("--retention", type=int, default=365, help="CHAT_RETENTION_DAYS (0 keeps chats forever)")
+    p.add_argument("--deleted", type=float, default=0.2, help="fraction of chats deleted before maintenance runs")
+    p.add_argument("--queries", type=int, default=200)
+    p.set_defaults(func=bench_maintenance)
+
+    p = sub.add_parser("batch", help="messages/s for 1k-message batches: one /get_response_route call each vs /get_response_batch")
+    p.add_argument("--batches", type=int, default=3)
+    p.add_argument("--size", type=int, default=1000)
+    p.add_argument("--latency", type=float, default=0.05, help="stub weather/news/OpenAI latency in seconds")
+    p.set_defaults(func=bench_batch)
+
+    p = sub.add_parser("knowledge", help="/learn write throughput: rewriting knowledge_base.json vs the knowledge table")
+    p.add_argument("--entries", type=int, default=10000)
+    p.add_argument("--writes", type=int, default=400)
+    p.add_argument("--workers", type=int, default=4)
+    p.set_defaults(func=bench_knowledge)
+
+    p = sub.add_parser("semantic", help="paraphrase recall, near-miss precision and lookup latency of the knowledge similarity index")
+    p.add_argument("--entries", type=int, default=100000)
+    p.add_argument("--vocab", type=int, default=20000)
+    p.add_argument("--queries", type=int, default=1000)
+    p.add_argument("--learn", type=int, default=500)
+    p.set_defaults(func=bench_semantic)
+
+    p = sub.add_parser("login", help="login throughput: credentials.enc rewrites, hashing policy, cached user rows")
+    p.add_argument("--threads", type=int, default=4)
+    p.add_argument("--logins", type=int, default=10)
+    p.add_argument("--writes", type=int, default=500)
+    p.add_argument("--method", default="pbkdf2:sha256:100000", help="hashing policy to switch to (PASSWORD_HASH_METHOD)")
+    p.set_defaults(func=bench_login)
+
+    p = sub.add_parser("logging", help="per-request logging overhead: synchronous DEBUG file vs queued JSON records")
+    p.add_argument("--requests", type=int, default=2000)
+    p.add_argument("--rounds", type=int, default=5)
+    p.add_argument("--sample", type=float, default=0.1)
+    p.set_defaults(func=bench_logging)
+
+    p = sub.add_parser("replay", help="replay a REQUEST_LOG=1 capture against stubbed upstreams: throughput, p50/p95/p99, errors")
+    p.add_argument("log", nargs="+", help="request log files or globs (rotated backups are included)")
+    p.add_argument("--concurrency", type=int, default=8)
+    p.add_argument("--speed", type=float, default=0, help="replay at N times the recorded pace (0: as fast as possible)")
+    p.add_argument("--limit", type=int, default=0)
+    p.add_argument("--latency", type=float, default=0.05, help="stub upstream latency in seconds")
+    p.add_argument("--gunicorn", metavar="WORKER_CLASS", help="serve with gunicorn (sync/gevent) instead of in-process")
+    p.add_argument("--workers", type=int, default=2)
+    p.set_defaults(func=bench_replay)
+
+    args = parser.parse_args()
+    # Keep retry warnings and app debug output off the console while timing; app.py's own log goes nowhere
+    os.environ.setdefault("LOG_FILE", os.devnull)
+    os.environ.setdefault("LOG_LEVEL", "ERROR")
+    logging.basicConfig(level=logging.ERROR)
+    logging.getLogger("werkzeug").setLevel(logging.ERROR)
+    args.func(args)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,3 +1,6 @@
 #!/bin/bash
 pip install -r requirements.txt
-python -c "import nltk; nltk.download('punkt', download_dir='./nltk_data'); nltk.download('wordnet', download_dir='./nltk_data')"
\ No newline at end of file
+# One-time NLTK corpus download and database migration, so worker boot does neither
+flask --app app prepare
+# Minified, fingerprinted and precompressed css/js in static/dist
+flask --app app build-assets
@@ -0,0 +1,173 @@
+"""Per-user archive files for chats that have gone quiet.
+
+When CHAT_ARCHIVE_AFTER_DAYS is set, the maintenance job (maintenance.py)
+moves chats whose last message is older than that out of the chats table into
+one file per user under CHAT_ARCHIVE_DIR (default: chat_archive next to the
+database). Each chat is one compressed block of JSON lines, one message per
+line in the /get_history shape, appended to the file. chat_archive records the
+block's byte range, so opening an archived chat reads and decompresses that
+block and nothing else. Archived messages are not in the full-text index, so
+/search does not find them. Blocks are zstd frames when the zstandard package
+is installed and gzip members otherwise; both concatenate, so a whole file
+also reads back with `zstd -dc` or `zcat`.
+
+Deleting or re-archiving a chat leaves its old block behind as dead bytes;
+compact() rewrites a file under a new name once most of it is dead.
+"""
+import os
+import gzip
+import json
+import time
+import hashlib
+import logging
+from functools import lru_cache
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+import db
+
+logger = logging.getLogger(__name__)
+
+ARCHIVE_DIR = os.getenv("CHAT_ARCHIVE_DIR")
+LEVEL = os.getenv("CHAT_ARCHIVE_LEVEL")
+# Decompressed blocks kept per process, for scrolling back through an archived chat page by page
+CACHE_SIZE = int(os.getenv("CHAT_ARCHIVE_CACHE_SIZE", "64"))
+# A file is rewritten once more than this fraction of it belongs to deleted or re-archived chats
+COMPACT_DEAD_RATIO = 0.5
+SUFFIXES = (".jsonl.zst", ".jsonl.gz")
+
+
+def archive_dir():
+    return ARCHIVE_DIR or os.path.join(os.path.dirname(os.path.abspath(db.DB_PATH)), "chat_archive")
+
+
+def _compress(archive_file, data):
+    if archive_file.endswith(".zst"):
+        return zstandard.ZstdCompressor(level=int(LEVEL or 10)).compress(data)
+    return gzip.compress(data, compresslevel=int(LEVEL or 6), mtime=0)
+
+
+def _decompress(archive_file, data):
+    if archive_file.endswith(".zst"):
+        return zstandard.ZstdDecompressor().decompress(data)
+    return gzip.decompress(data)
+
+
+def _new_file(user_id, suffix=None):
+    # Hashed so usernames do not show up in the directory listing; the timestamp keeps rewrites apart
+    key = hashlib.sha256(str(user_id).encode("utf-8")).hexdigest()[:16]
+    return f"{key}.{time.time_ns()}{suffix or SUFFIXES[0 if zstandard is not None else 1]}"
+
+
+def _writable_file(user_id):
+    archive_file = db.user_archive_file(user_id)
+    # A zstd file cannot be appended to without zstandard; start a gzip one beside it
+    if archive_file is None or (archive_file.endswith(".zst") and zstandard is None):
+        return _new_file(user_id)
+    return archive_file
+
+
+@lru_cache(maxsize=CACHE_SIZE)
+def _read_block(archive_file, offset, length):
+    with open(os.path.join(archive_dir(), archive_file), "rb") as f:
+        f.seek(offset)
+        data = f.read(length)
+    return tuple(json.loads(line) for line in _decompress(archive_file, data).splitlines())
+
+
+def _messages(user_id, chat_id):
+    entry = db.fetch_archived_chat(user_id, chat_id)
+    if entry is None:
+        return ()
+    try:
+        return _read_block(entry["archive_file"], entry["archive_offset"], entry["archive_length"])
+    except FileNotFoundError:
+        # compact() replaced the file between the lookup and the read; the row points at the new one now
+        entry = db.fetch_archived_chat(user_id, chat_id)
+        return _read_block(entry["archive_file"], entry["archive_offset"], entry["archive_length"]) if entry else ()
+
+
+def history_page(user_id, chat_id, limit, before=None):
+    """Up to limit archived messages of a chat before id `before`, oldest first, and whether older ones exist."""
+    messages = _messages(user_id, chat_id)
+    if before is not None:
+        messages = [message for message in messages if message["id"] < before]
+    page = messages[max(0, len(messages) - limit):] if limit > 0 else ()
+    return [dict(message) for message in page], len(messages) > len(page)
+
+
+def archive_chats(user_id, chat_ids, archived_at):
+    """Move chats of one user into their archive file; returns how many were archived.
+
+    The blocks are written and synced before the rows are deleted, so a crash in
+    between leaves the chat live and a dead block that compact() drops later.
+    A chat that already has an archived part is rewritten as one block with both.
+    """
+    archive_file = _writable_file(user_id)
+    os.makedirs(archive_dir(), exist_ok=True)
+    entries = []
+    with open(os.path.join(archive_dir(), archive_file), "ab") as f:
+        for chat_id in chat_ids:
+            live = db.fetch_history(user_id, chat_id)
+            if not live:
+                continue
+            messages = list(_messages(user_id, chat_id)) + live
+            data = "".join(json.dumps(message, ensure_ascii=False, separators=(",", ":")) + "\n"
+                           for message in messages).encode("utf-8")
+            block = _compress(archive_file, data)
+            offset = f.tell()
+            f.write(block)
+            timestamps = [message["timestamp"] for message in messages]
+            entries.append((len(live), (user_id, chat_id, min(timestamps), max(timestamps), len(messages),
+                                        live[-1]["id"], archive_file, offset, len(block))))
+        f.flush()
+        os.fsync(f.fileno())
+    archived = db.record_archived_chats(entries, archived_at)
+    logger.debug("Archived %d chats of %s into %s", archived, user_id, archive_file)
+    return archived
+
+
+def compact(dead_ratio=COMPACT_DEAD_RATIO):
+    """Rewrite archive files that are mostly dead blocks and delete unreferenced ones.
+
+    Returns (files rewritten or removed, bytes freed).
+    """
+    directory = archive_dir()
+    if not os.path.isdir(directory):
+        return 0, 0
+    in_use = {archive_file: (user_id, live_bytes) for archive_file, user_id, live_bytes in db.archive_files()}
+    files = bytes_freed = 0
+    for name in os.listdir(directory):
+        if not name.endswith(SUFFIXES):
+            continue
+        path = os.path.join(directory, name)
+        size = os.path.getsize(path)
+        if name not in in_use:
+            os.remove(path)
+            files += 1
+            bytes_freed += size
+            continue
+        user_id, live_bytes = in_use[name]
+        if size - live_bytes <= size * dead_ratio:
+            continue
+        # Blocks are copied as they are, so the new file keeps the old one's codec
+        new_name = _new_file(user_id, next(suffix for suffix in SUFFIXES if name.endswith(suffix)))
+        moves = []
+        with open(path, "rb") as source, open(os.path.join(directory, new_name), "wb") as target:
+            for entry_user, chat_id, offset, length in db.archive_file_entries(name):
+                source.seek(offset)
+                moves.append((new_name, target.tell(), entry_user, chat_id, name, offset))
+                target.write(source.read(length))
+            target.flush()
+            os.fsync(target.fileno())
+        db.move_archived_chats(moves)
+        # Entries that changed while the copy was made still point at the old file; it goes on a later run
+        if not db.archive_file_entries(name):
+            os.remove(path)
+            bytes_freed += size - os.path.getsize(os.path.join(directory, new_name))
+        files += 1
+        logger.debug("Compacted archive %s into %s", name, new_name)
+    return files, bytes_freed
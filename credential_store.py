@@ -0,0 +1,165 @@
+"""Per-user encrypted profile records in the credentials table of chat_history.db.
+
+Replaces credentials.enc/key.key, which held one record for whichever user
+touched them last and were rewritten with a fresh Fernet key on every login,
+register and settings update. The key is now read once per process and the
+Fernet cipher is cached, so login writes nothing; register and settings upsert
+the user's own row. Passwords are not part of the record: the users table
+keeps their hash, and nothing needs them back in clear.
+
+The key comes from CREDENTIALS_KEY, or else from CREDENTIALS_KEY_FILE
+(credentials.key next to the database, untracked), which is generated with
+mode 0600 if missing. key.key was committed to the repository, so it is never
+used as the key; the migration only reads it to import a legacy
+credentials.enc and to re-encrypt rows written with it, then renames both
+files to *.imported. All three files are looked up in the database's
+directory, so a scratch database never reads or renames the checkout's files.
+"""
+import os
+import json
+import threading
+import logging
+from datetime import datetime
+
+from cryptography.fernet import Fernet, InvalidToken
+
+import db
+
+logger = logging.getLogger(__name__)
+
+KEY_FILE = os.getenv("CREDENTIALS_KEY_FILE")
+LEGACY_KEY_FILE = 'key.key'
+LEGACY_FILE = 'credentials.enc'
+RETIRED_SUFFIX = '.imported'
+PROFILE_FIELDS = ("name", "email", "two_factor_enabled", "email_notifications", "sms_notifications",
+                  "security_question1", "security_answer1", "security_question2", "security_answer2",
+                  "profile_picture")
+
+_cipher = None
+_lock = threading.Lock()
+
+
+def _beside_db(name):
+    return os.path.join(os.path.dirname(os.path.abspath(db.DB_PATH)), name)
+
+
+def key_path():
+    return KEY_FILE or _beside_db("credentials.key")
+
+
+def _load_key(path):
+    key = os.getenv("CREDENTIALS_KEY")
+    if key:
+        return key.encode()
+    if os.path.exists(path):
+        with open(path, 'rb') as f:
+            return f.read().strip()
+    # Written in full to a private file, then linked into place: of several workers starting
+    # together one link wins, and the others read a complete key instead of an empty file
+    key = Fernet.generate_key()
+    tmp = f"{path}.{os.getpid()}.tmp"
+    fd = os.open(tmp, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            f.write(key)
+            f.flush()
+            os.fsync(f.fileno())
+        os.link(tmp, path)
+    except FileExistsError:
+        with open(path, 'rb') as f:
+            return f.read().strip()
+    finally:
+        os.remove(tmp)
+    logger.warning("Generated a new credentials key in %s; set CREDENTIALS_KEY to share one between hosts", path)
+    return key
+
+
+def cipher(path=None):
+    """The process-wide Fernet cipher; the key is read (or created) on the first call only."""
+    global _cipher
+    if _cipher is None:
+        with _lock:
+            if _cipher is None:
+                _cipher = Fernet(_load_key(path or key_path()))
+    return _cipher
+
+
+def _timestamp():
+    return datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+
+
+def _record(username, profile):
+    return {"username": username, **{field: profile.get(field) for field in PROFILE_FIELDS}}
+
+
+def save(username, conn=None, **profile):
+    data = cipher().encrypt(json.dumps(_record(username, profile)).encode())
+    db.put_credentials(username, data, _timestamp(), conn)
+
+
+def load(username):
+    data = db.fetch_credentials(username)
+    if data is None:
+        return {}
+    try:
+        return json.loads(cipher().decrypt(data).decode())
+    except (InvalidToken, ValueError) as e:
+        logger.error(f"Decryption error for {username}: {e}")
+        return {}
+
+
+def _legacy_cipher(key_path):
+    if not os.path.exists(key_path):
+        return None
+    with open(key_path, 'rb') as f:
+        return Fernet(f.read().strip())
+
+
+def import_legacy(conn, path=None, key_path=None):
+    """Move the record from a legacy credentials.enc into the credentials table (run inside the migration)."""
+    path = path or _beside_db(LEGACY_FILE)
+    key_path = key_path or _beside_db(LEGACY_KEY_FILE)
+    if not os.path.exists(path) or not os.path.exists(key_path):
+        return False
+    try:
+        legacy = _legacy_cipher(key_path)
+        with open(path, 'rb') as f:
+            record = json.loads(legacy.decrypt(f.read()).decode())
+    except (InvalidToken, ValueError) as e:
+        logger.error(f"Could not read legacy {path}: {e}")
+        return False
+    username = record.pop("username", None)
+    if not username:
+        return False
+    save(username, conn, **record)
+    logger.debug("Imported legacy credentials for %s", username)
+    return True
+
+
+def rekey_legacy(conn, key_path=None):
+    """Re-encrypt rows still under the committed key.key with the current key; returns how many (run inside the migration)."""
+    key_path = key_path or _beside_db(LEGACY_KEY_FILE)
+    legacy = _legacy_cipher(key_path)
+    if legacy is None:
+        return 0
+    current = cipher()
+    rekeyed = 0
+    for username, data in db.all_credentials(conn):
+        try:
+            plain = legacy.decrypt(data)
+        except InvalidToken:
+            # Already under the current key
+            continue
+        db.put_credentials(username, current.encrypt(plain), _timestamp(), conn)
+        rekeyed += 1
+    if rekeyed:
+        logger.warning("Re-encrypted %d credential records that used %s", rekeyed, key_path)
+    return rekeyed
+
+
+def retire_legacy_files(paths=None):
+    """Rename legacy files once the migration that read them has committed, so they are not read again."""
+    for path in paths or (_beside_db(LEGACY_FILE), _beside_db(LEGACY_KEY_FILE)):
+        if os.path.exists(path):
+            os.replace(path, path + RETIRED_SUFFIX)
+            logger.warning("Renamed %s to %s%s; delete it once the migration is verified", path, path, RETIRED_SUFFIX)
@@ -0,0 +1,836 @@
+"""SQLite data-access layer for chat_history.db.
+
+Every call site in app.py goes through this module instead of opening its own
+sqlite3 connection. Connections are pooled per thread (and re-created after a
+fork, so each gunicorn worker gets its own), run in WAL mode, and keep the
+SQL strings below constant so sqlite3's statement cache reuses the prepared
+statements on every call.
+
+Under gunicorn's gevent workers every request is a greenlet in one OS thread,
+and SQLite calls never yield: a write waiting out busy_timeout, or a long
+query, would stall every request in the worker. Functions that run after
+startup (the @_timed ones and those marked @offloaded) therefore hand the call
+to gevent's native thread pool when they are called from the hub's thread. The
+greenlet waits cooperatively, and each pool thread has its own pooled
+connection, so greenlets never share a connection or a transaction. Callers
+that need several statements in one transaction wrap them in a function marked
+@offloaded. Outside gevent (sync workers, threads, the CLI) everything runs
+inline on the calling thread's connection, as before.
+"""
+import os
+import re
+import sqlite3
+import inspect
+import threading
+import logging
+from contextlib import contextmanager
+from functools import wraps
+
+try:
+    from gevent import monkey as gevent_monkey
+except ImportError:
+    gevent_monkey = None
+
+import metrics
+
+logger = logging.getLogger(__name__)
+
+DB_PATH = os.getenv("CHAT_DB_PATH", "chat_history.db")
+# Bump whenever init_db gains a migration step; workers skip init_db's work when the stored version matches
+SCHEMA_VERSION = 12
+STATEMENT_CACHE_SIZE = 128
+
+PRAGMAS = (
+    # Only takes effect before the first write to a new file (switching to WAL is one), so it comes first;
+    # an existing database is converted by maintenance.convert_auto_vacuum()
+    "PRAGMA auto_vacuum=INCREMENTAL",
+    "PRAGMA journal_mode=WAL",
+    "PRAGMA synchronous=NORMAL",
+    "PRAGMA busy_timeout=5000",
+    "PRAGMA cache_size=-8000",
+    "PRAGMA temp_store=MEMORY",
+)
+
+USER_COLUMNS = ['id', 'username', 'password', 'name', 'email', 'two_factor_enabled', 'email_notifications',
+                'sms_notifications', 'security_question1', 'security_answer1', 'security_question2',
+                'security_answer2', 'profile_picture', 'retention_days']
+
+SELECT_USER = "SELECT " + ", ".join(USER_COLUMNS) + " FROM users WHERE username = ?"
+INSERT_USER = "INSERT INTO users (username, password, name, email) VALUES (?, ?, ?, ?)"
+UPDATE_USER = ("UPDATE users SET password = ?, name = ?, email = ?, two_factor_enabled = ?, email_notifications = ?, "
+               "sms_notifications = ?, security_question1 = ?, security_answer1 = ?, security_question2 = ?, "
+               "security_answer2 = ?, profile_picture = ? WHERE username = ?")
+UPDATE_PASSWORD = "UPDATE users SET password = ? WHERE username = ?"
+UPDATE_RETENTION = "UPDATE users SET retention_days = ? WHERE username = ?"
+INSERT_MESSAGE = "INSERT INTO chats (user_id, chat_id, message, is_user, timestamp) VALUES (?, ?, ?, ?, ?)"
+# History is ordered by id (insertion order), which also serves as the pagination cursor
+MAX_ID = 2 ** 63 - 1
+SELECT_HISTORY = "SELECT id, timestamp, message, is_user FROM chats WHERE user_id = ? AND chat_id = ? ORDER BY id"
+SELECT_HISTORY_BEFORE = ("SELECT id, timestamp, message, is_user FROM chats WHERE user_id = ? AND chat_id = ? "
+                         "AND id < ? ORDER BY id DESC LIMIT ?")
+SELECT_HISTORY_SINCE = ("SELECT id, timestamp, message, is_user FROM chats WHERE user_id = ? AND chat_id = ? "
+                        "AND id > ? ORDER BY id LIMIT ?")
+# Live and archived chats; a chat with messages on both sides is listed once
+SELECT_CHAT_IDS = ("SELECT chat_id FROM (SELECT chat_id, created_at, last_message_at FROM chat_sessions WHERE user_id = ?1 "
+                   "UNION ALL SELECT chat_id, created_at, last_message_at FROM chat_archive WHERE user_id = ?1) "
+                   "GROUP BY chat_id ORDER BY MAX(last_message_at) DESC, MIN(created_at) DESC")
+# Changes whenever a chat is added, deleted, archived or gets a message; used as the chat list ETag
+CHAT_LIST_VERSION = ("SELECT COUNT(*), MAX(created_at), MAX(last_message_at), TOTAL(message_count), "
+                     "(SELECT COUNT(*) || '.' || TOTAL(message_count) FROM chat_archive WHERE user_id = ?1) "
+                     "FROM chat_sessions WHERE user_id = ?1")
+COUNT_CHAT = "SELECT message_count FROM chat_sessions WHERE user_id = ? AND chat_id = ?"
+DELETE_CHAT = "DELETE FROM chats WHERE user_id = ? AND chat_id = ?"
+
+# chat_sessions is a denormalized one-row-per-chat summary of chats, kept in
+# sync by triggers so every insert path (including /save_message) maintains it
+# and the sidebar list costs O(chats) instead of O(messages).
+CHAT_INDEXES = (
+    "DROP INDEX IF EXISTS idx_chats_user_chat_ts",
+    "CREATE INDEX IF NOT EXISTS idx_chats_user_chat_id ON chats (user_id, chat_id, id)",
+)
+CHAT_SESSIONS_SCHEMA = (
+    '''CREATE TABLE IF NOT EXISTS chat_sessions
+       (user_id TEXT NOT NULL, chat_id TEXT NOT NULL, created_at TEXT, last_message_at TEXT,
+        message_count INTEGER NOT NULL DEFAULT 0, PRIMARY KEY (user_id, chat_id))''',
+    "CREATE INDEX IF NOT EXISTS idx_chat_sessions_user_last ON chat_sessions (user_id, last_message_at)",
+    '''CREATE TRIGGER IF NOT EXISTS trg_chats_insert_session AFTER INSERT ON chats BEGIN
+         INSERT INTO chat_sessions (user_id, chat_id, created_at, last_message_at, message_count)
+         VALUES (NEW.user_id, NEW.chat_id, NEW.timestamp, NEW.timestamp, 1)
+         ON CONFLICT (user_id, chat_id) DO UPDATE SET
+           last_message_at = max(last_message_at, excluded.last_message_at),
+           message_count = message_count + 1;
+       END''',
+    '''CREATE TRIGGER IF NOT EXISTS trg_chats_delete_session AFTER DELETE ON chats BEGIN
+         UPDATE chat_sessions SET message_count = message_count - 1
+         WHERE user_id = OLD.user_id AND chat_id = OLD.chat_id;
+         DELETE FROM chat_sessions
+         WHERE user_id = OLD.user_id AND chat_id = OLD.chat_id AND message_count <= 0;
+       END''',
+)
+REBUILD_CHAT_SESSIONS = (
+    "DELETE FROM chat_sessions",
+    '''INSERT INTO chat_sessions (user_id, chat_id, created_at, last_message_at, message_count)
+       SELECT user_id, chat_id, MIN(timestamp), MAX(timestamp), COUNT(*) FROM chats GROUP BY user_id, chat_id''',
+)
+
+# Full-text index over chats.message. External content, so the text is only stored in chats;
+# user_id is indexed as well so a search walks one user's postings instead of everyone's.
+CHATS_FTS_SCHEMA = (
+    '''CREATE VIRTUAL TABLE IF NOT EXISTS chats_fts USING fts5
+       (message, user_id, content='chats', content_rowid='id', tokenize='porter unicode61')''',
+    '''CREATE TRIGGER IF NOT EXISTS trg_chats_insert_fts AFTER INSERT ON chats BEGIN
+         INSERT INTO chats_fts (rowid, message, user_id) VALUES (NEW.id, NEW.message, NEW.user_id);
+       END''',
+    '''CREATE TRIGGER IF NOT EXISTS trg_chats_delete_fts AFTER DELETE ON chats BEGIN
+         INSERT INTO chats_fts (chats_fts, rowid, message, user_id) VALUES ('delete', OLD.id, OLD.message, OLD.user_id);
+       END''',
+    '''CREATE TRIGGER IF NOT EXISTS trg_chats_update_fts AFTER UPDATE OF message, user_id ON chats BEGIN
+         INSERT INTO chats_fts (chats_fts, rowid, message, user_id) VALUES ('delete', OLD.id, OLD.message, OLD.user_id);
+         INSERT INTO chats_fts (rowid, message, user_id) VALUES (NEW.id, NEW.message, NEW.user_id);
+       END''',
+)
+REBUILD_CHATS_FTS = "INSERT INTO chats_fts (chats_fts) VALUES ('rebuild')"
+# The MATCH narrows to the user's postings; c.user_id = ? is the exact check ("bob" also matches "bob_x")
+SEARCH_CHATS = ("SELECT c.id, c.chat_id, c.timestamp, c.is_user, snippet(chats_fts, 0, ?, ?, '…', ?) "
+                "FROM chats_fts JOIN chats c ON c.id = chats_fts.rowid "
+                "WHERE chats_fts MATCH ? AND c.user_id = ? ORDER BY bm25(chats_fts, 1.0, 0.0) LIMIT ? OFFSET ?")
+SNIPPET_START, SNIPPET_END = "\ue000", "\ue001"
+SNIPPET_TOKENS = 12
+
+# Chats moved out of chats into per-user archive files (see chat_archive.py): one row per chat
+# giving the byte range of its compressed block, so reading it back never scans the file.
+CHAT_ARCHIVE_SCHEMA = (
+    '''CREATE TABLE IF NOT EXISTS chat_archive
+       (user_id TEXT NOT NULL, chat_id TEXT NOT NULL, created_at TEXT, last_message_at TEXT,
+        message_count INTEGER NOT NULL, last_id INTEGER NOT NULL, archive_file TEXT NOT NULL,
+        archive_offset INTEGER NOT NULL, archive_length INTEGER NOT NULL, archived_at TEXT NOT NULL,
+        PRIMARY KEY (user_id, chat_id)) WITHOUT ROWID''',
+    "CREATE INDEX IF NOT EXISTS idx_chat_archive_file ON chat_archive (archive_file)",
+    '''CREATE TABLE IF NOT EXISTS maintenance_runs
+       (job TEXT PRIMARY KEY, next_run_at REAL NOT NULL, last_run_at REAL, last_result TEXT) WITHOUT ROWID''',
+)
+ARCHIVE_ENTRY_COLUMNS = ("created_at", "last_message_at", "message_count", "last_id", "archive_file",
+                         "archive_offset", "archive_length")
+SELECT_ARCHIVED_CHAT = ("SELECT " + ", ".join(ARCHIVE_ENTRY_COLUMNS) +
+                        " FROM chat_archive WHERE user_id = ? AND chat_id = ?")
+UPSERT_ARCHIVED_CHAT = ("INSERT INTO chat_archive (user_id, chat_id, created_at, last_message_at, message_count, "
+                        "last_id, archive_file, archive_offset, archive_length, archived_at) "
+                        "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?) ON CONFLICT (user_id, chat_id) DO UPDATE SET "
+                        "created_at = excluded.created_at, last_message_at = excluded.last_message_at, "
+                        "message_count = excluded.message_count, last_id = excluded.last_id, "
+                        "archive_file = excluded.archive_file, archive_offset = excluded.archive_offset, "
+                        "archive_length = excluded.archive_length, archived_at = excluded.archived_at")
+DELETE_ARCHIVED_CHAT = "DELETE FROM chat_archive WHERE user_id = ? AND chat_id = ?"
+# Only the rows up to the last archived id: a message that arrived while the archive was written stays live
+DELETE_ARCHIVED_MESSAGES = "DELETE FROM chats WHERE user_id = ? AND chat_id = ? AND id <= ?"
+SELECT_ARCHIVE_CANDIDATES = ("SELECT user_id, chat_id FROM chat_sessions WHERE last_message_at < ? "
+                             "ORDER BY user_id LIMIT ?")
+SELECT_ARCHIVE_FILES = "SELECT archive_file, MIN(user_id), TOTAL(archive_length) FROM chat_archive GROUP BY archive_file"
+SELECT_ARCHIVE_FILE_ENTRIES = ("SELECT user_id, chat_id, archive_offset, archive_length FROM chat_archive "
+                               "WHERE archive_file = ? ORDER BY archive_offset")
+SELECT_USER_ARCHIVE_FILE = "SELECT archive_file FROM chat_archive WHERE user_id = ? LIMIT 1"
+MOVE_ARCHIVED_CHAT = ("UPDATE chat_archive SET archive_file = ?, archive_offset = ? "
+                      "WHERE user_id = ? AND chat_id = ? AND archive_file = ? AND archive_offset = ?")
+# Retention is per user (users.retention_days, NULL for the default; 0 keeps chats forever) and
+# applies to whole chats by their last message. An archived chat with newer live messages is kept.
+EXPIRED_CUTOFF = "datetime(:now, '-' || COALESCE(u.retention_days, :default) || ' days')"
+SELECT_EXPIRED_CHATS = ("SELECT s.user_id, s.chat_id FROM chat_sessions s LEFT JOIN users u ON u.username = s.user_id "
+                        "WHERE COALESCE(u.retention_days, :default) > 0 AND s.last_message_at < " + EXPIRED_CUTOFF +
+                        " LIMIT :limit")
+SELECT_EXPIRED_ARCHIVED_CHATS = ("SELECT a.user_id, a.chat_id FROM chat_archive a "
+                                 "LEFT JOIN users u ON u.username = a.user_id "
+                                 "WHERE COALESCE(u.retention_days, :default) > 0 AND a.last_message_at < " +
+                                 EXPIRED_CUTOFF + " AND NOT EXISTS (SELECT 1 FROM chat_sessions s "
+                                 "WHERE s.user_id = a.user_id AND s.chat_id = a.chat_id) LIMIT :limit")
+# A job runs when it claims its row: next_run_at moves forward, so one worker runs it per interval
+CLAIM_MAINTENANCE = "UPDATE maintenance_runs SET next_run_at = ? WHERE job = ? AND next_run_at <= ?"
+INSERT_MAINTENANCE = "INSERT OR IGNORE INTO maintenance_runs (job, next_run_at) VALUES (?, ?)"
+FINISH_MAINTENANCE = "UPDATE maintenance_runs SET last_run_at = ?, last_result = ? WHERE job = ?"
+SELECT_MAINTENANCE = "SELECT next_run_at, last_run_at, last_result FROM maintenance_runs WHERE job = ?"
+
+# Token buckets and in-flight upstream slots shared by every worker (see admission.py)
+ADMISSION_SCHEMA = (
+    '''CREATE TABLE IF NOT EXISTS rate_buckets
+       (key TEXT PRIMARY KEY, tokens REAL NOT NULL, updated_at REAL NOT NULL) WITHOUT ROWID''',
+    '''CREATE TABLE IF NOT EXISTS upstream_slots
+       (id INTEGER PRIMARY KEY, acquired_at REAL NOT NULL, pid INTEGER NOT NULL)''',
+)
+# Refill and take tokens in a single statement; no row changes when the bucket holds fewer than asked for
+TAKE_TOKEN = ("INSERT INTO rate_buckets (key, tokens, updated_at) VALUES (:key, :burst - :tokens, :now) "
+              "ON CONFLICT (key) DO UPDATE SET tokens = MIN(:burst, tokens + (:now - updated_at) * :rate) - :tokens, "
+              "updated_at = :now WHERE MIN(:burst, tokens + (:now - updated_at) * :rate) >= :tokens")
+SELECT_BUCKET = "SELECT tokens, updated_at FROM rate_buckets WHERE key = ?"
+PRUNE_BUCKETS = "DELETE FROM rate_buckets WHERE updated_at < ?"
+# Slots older than the lease belong to requests that died without releasing them
+ACQUIRE_SLOT = ("INSERT INTO upstream_slots (acquired_at, pid) SELECT ?, ? "
+                "WHERE (SELECT COUNT(*) FROM upstream_slots WHERE acquired_at > ?) < ?")
+RELEASE_SLOT = "DELETE FROM upstream_slots WHERE id = ?"
+PRUNE_SLOTS = "DELETE FROM upstream_slots WHERE acquired_at <= ?"
+COUNT_SLOTS = "SELECT COUNT(*) FROM upstream_slots WHERE acquired_at > ?"
+
+# One encrypted profile record per user (see credential_store.py)
+CREDENTIALS_SCHEMA = '''CREATE TABLE IF NOT EXISTS credentials
+       (username TEXT PRIMARY KEY, data BLOB NOT NULL, updated_at TEXT NOT NULL) WITHOUT ROWID'''
+SELECT_CREDENTIALS = "SELECT data FROM credentials WHERE username = ?"
+SELECT_ALL_CREDENTIALS = "SELECT username, data FROM credentials"
+UPSERT_CREDENTIALS = ("INSERT INTO credentials (username, data, updated_at) VALUES (?, ?, ?) "
+                      "ON CONFLICT (username) DO UPDATE SET data = excluded.data, updated_at = excluded.updated_at")
+
+RESPONSE_CACHE_SCHEMA = '''CREATE TABLE IF NOT EXISTS response_cache
+       (namespace TEXT NOT NULL, key TEXT NOT NULL, value TEXT, fetched_at REAL NOT NULL,
+        PRIMARY KEY (namespace, key)) WITHOUT ROWID'''
+SELECT_CACHE = "SELECT value, fetched_at FROM response_cache WHERE namespace = ? AND key = ?"
+UPSERT_CACHE = ("INSERT INTO response_cache (namespace, key, value, fetched_at) VALUES (?, ?, ?, ?) "
+                "ON CONFLICT (namespace, key) DO UPDATE SET value = excluded.value, fetched_at = excluded.fetched_at")
+
+# Durable outbox for Zapier task deliveries: queued -> sending -> delivered | failed.
+# A 'sending' row whose claim is older than the lease is treated as abandoned and claimed again.
+TASK_OUTBOX_SCHEMA = (
+    '''CREATE TABLE IF NOT EXISTS task_outbox
+       (id INTEGER PRIMARY KEY, user_id TEXT, payload TEXT NOT NULL, status TEXT NOT NULL DEFAULT 'queued',
+        attempts INTEGER NOT NULL DEFAULT 0, last_error TEXT, created_at TEXT NOT NULL, updated_at TEXT NOT NULL,
+        next_attempt_at REAL NOT NULL, claimed_at REAL)''',
+    "CREATE INDEX IF NOT EXISTS idx_task_outbox_due ON task_outbox (status, next_attempt_at)",
+    "CREATE INDEX IF NOT EXISTS idx_task_outbox_user ON task_outbox (user_id, id)",
+)
+INSERT_TASK = ("INSERT INTO task_outbox (user_id, payload, created_at, updated_at, next_attempt_at) "
+               "VALUES (?, ?, ?, ?, ?)")
+SELECT_DUE_TASKS = ("SELECT id, payload, attempts FROM task_outbox "
+                    "WHERE (status = 'queued' AND next_attempt_at <= ?) OR (status = 'sending' AND claimed_at < ?) "
+                    "ORDER BY id LIMIT ?")
+CLAIM_TASK = "UPDATE task_outbox SET status = 'sending', attempts = attempts + 1, claimed_at = ?, updated_at = ? WHERE id = ?"
+FINISH_TASK = ("UPDATE task_outbox SET status = ?, last_error = ?, next_attempt_at = ?, claimed_at = NULL, "
+               "updated_at = ? WHERE id = ?")
+SELECT_USER_TASKS = ("SELECT id, payload, status, attempts, last_error, created_at, updated_at FROM task_outbox "
+                     "WHERE user_id = ? ORDER BY id DESC LIMIT ?")
+
+# Append-only knowledge base: one row per learned answer. Workers tail it by id to pick up new entries.
+KNOWLEDGE_SCHEMA = (
+    '''CREATE TABLE IF NOT EXISTS knowledge
+       (id INTEGER PRIMARY KEY, category TEXT NOT NULL, answer TEXT NOT NULL, created_at TEXT NOT NULL)''',
+    "CREATE INDEX IF NOT EXISTS idx_knowledge_category ON knowledge (category, id)",
+)
+INSERT_KNOWLEDGE = "INSERT INTO knowledge (category, answer, created_at) VALUES (?, ?, ?)"
+SELECT_KNOWLEDGE_SINCE = "SELECT id, category, answer FROM knowledge WHERE id > ? ORDER BY id"
+
+# Latency histograms: totals per series, plus the same deltas per period for plot_latency.py
+METRICS_SCHEMA = (
+    '''CREATE TABLE IF NOT EXISTS metrics
+       (name TEXT NOT NULL, labels TEXT NOT NULL, le TEXT NOT NULL, value REAL NOT NULL,
+        PRIMARY KEY (name, labels, le)) WITHOUT ROWID''',
+    '''CREATE TABLE IF NOT EXISTS metrics_history
+       (period INTEGER NOT NULL, name TEXT NOT NULL, labels TEXT NOT NULL, le TEXT NOT NULL, value REAL NOT NULL,
+        PRIMARY KEY (period, name, labels, le)) WITHOUT ROWID''',
+)
+ADD_METRIC = ("INSERT INTO metrics (name, labels, le, value) VALUES (?, ?, ?, ?) "
+              "ON CONFLICT (name, labels, le) DO UPDATE SET value = value + excluded.value")
+ADD_METRIC_HISTORY = ("INSERT INTO metrics_history (period, name, labels, le, value) VALUES (?, ?, ?, ?, ?) "
+                      "ON CONFLICT (period, name, labels, le) DO UPDATE SET value = value + excluded.value")
+PRUNE_METRICS_HISTORY = "DELETE FROM metrics_history WHERE period < ?"
+SELECT_METRICS = "SELECT name, labels, le, value FROM metrics"
+SELECT_METRICS_HISTORY = ("SELECT period, labels, le, value FROM metrics_history WHERE name = ? AND period >= ? "
+                          "ORDER BY period")
+
+
+def _thread_local():
+    # Under gevent workers threading.local is per greenlet (one connection per request);
+    # keep one connection per OS thread instead: one per native pool thread, see offloaded()
+    if gevent_monkey is None:
+        return threading.local()
+    return gevent_monkey.get_original('threading', 'local')()
+
+
+def _hub_threadpool():
+    """gevent's native thread pool if called from a greenlet of a monkey-patched process, else None."""
+    # Checked per call: with `gunicorn --preload` this module is imported before the worker patches threading
+    if gevent_monkey is None or not gevent_monkey.is_module_patched('threading'):
+        return None
+    # Once patched, threading.Thread makes greenlets; the only other native threads are the pool's own
+    if getattr(_offload_state, 'active', False):
+        return None
+    import gevent
+    return gevent.get_hub().threadpool
+
+
+def _run_offloaded(func, args, kwargs):
+    _offload_state.active = True
+    try:
+        return True, func(*args, **kwargs)
+    except Exception as e:
+        # Raised again in the calling greenlet; the pool itself would print every one (admission's Rejected too)
+        return False, e
+    finally:
+        _offload_state.active = False
+
+
+def offloaded(func):
+    """Run func on gevent's native thread pool when called from a gevent worker's hub (see the module docstring).
+
+    A call that passes its own conn is already inside a transaction on the right thread and runs inline.
+    """
+    parameters = list(inspect.signature(func).parameters)
+    conn_index = parameters.index('conn') if 'conn' in parameters else None
+
+    @wraps(func)
+    def wrapper(*args, **kwargs):
+        pool = _hub_threadpool()
+        if pool is None or kwargs.get('conn') is not None or \
+                (conn_index is not None and len(args) > conn_index and args[conn_index] is not None):
+            return func(*args, **kwargs)
+        ok, result = pool.apply(_run_offloaded, (func, args, kwargs))
+        if not ok:
+            raise result
+        return result
+    return wrapper
+
+
+_local = _thread_local()
+_offload_state = _thread_local()
+_all_connections = []
+_all_lock = threading.Lock()
+
+
+def configure(path):
+    """Point the pool at a different database file and drop existing connections."""
+    global DB_PATH
+    close_all()
+    DB_PATH = path
+
+
+def _connect():
+    # isolation_level=None: single statements autocommit, multi-statement
+    # writes go through transaction() so each one is a single fsync.
+    conn = sqlite3.connect(DB_PATH, check_same_thread=False, isolation_level=None,
+                           cached_statements=STATEMENT_CACHE_SIZE)
+    for pragma in PRAGMAS:
+        conn.execute(pragma)
+    with _all_lock:
+        _all_connections.append(conn)
+    logger.debug("Opened pooled connection to %s (pid %s, thread %s)", DB_PATH, os.getpid(), threading.get_ident())
+    return conn
+
+
+def get_connection():
+    """Return this thread's pooled connection, opening it on first use."""
+    conn = getattr(_local, 'conn', None)
+    if conn is None or _local.pid != os.getpid() or _local.path != DB_PATH:
+        conn = _connect()
+        _local.conn = conn
+        _local.lock = threading.Lock()
+        _local.pid = os.getpid()
+        _local.path = DB_PATH
+    return conn
+
+
+def close_all():
+    """Close every pooled connection (used on shutdown and by configure())."""
+    with _all_lock:
+        connections = list(_all_connections)
+        _all_connections.clear()
+    for conn in connections:
+        try:
+            conn.close()
+        except sqlite3.Error as e:
+            logger.error(f"Error closing pooled connection: {e}")
+    _local.__dict__.clear()
+
+
+@contextmanager
+def transaction():
+    """Run a block of writes as one IMMEDIATE transaction on the pooled connection."""
+    conn = get_connection()
+    with _local.lock:
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            yield conn
+        except BaseException:
+            conn.execute("ROLLBACK")
+            raise
+        else:
+            conn.execute("COMMIT")
+
+
+def get_schema_version(conn=None):
+    conn = conn or get_connection()
+    conn.execute("CREATE TABLE IF NOT EXISTS schema_version (version INTEGER NOT NULL)")
+    row = conn.execute("SELECT MAX(version) FROM schema_version").fetchone()
+    return row[0] or 0
+
+
+def set_schema_version(conn, version):
+    conn.execute("DELETE FROM schema_version")
+    conn.execute("INSERT INTO schema_version (version) VALUES (?)", (version,))
+
+
+def migrate_chat_indexes(conn, rebuild=False):
+    """Create the chats indexes and chat_sessions table, backfilling it when new or when rebuild is set."""
+    exists = conn.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'chat_sessions'").fetchone()
+    for statement in CHAT_INDEXES + CHAT_SESSIONS_SCHEMA:
+        conn.execute(statement)
+    if rebuild or not exists:
+        for statement in REBUILD_CHAT_SESSIONS:
+            conn.execute(statement)
+        conn.execute("ANALYZE chats")
+        logger.debug("Rebuilt chat_sessions from chats")
+
+
+def migrate_chats_fts(conn):
+    """Create the chats_fts index and its triggers, bulk-building it from chats when new.
+
+    Returns False (search stays disabled) if this SQLite build has no FTS5.
+    """
+    exists = conn.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'chats_fts'").fetchone()
+    try:
+        for statement in CHATS_FTS_SCHEMA:
+            conn.execute(statement)
+    except sqlite3.OperationalError as e:
+        logger.error(f"Full-text search unavailable: {e}")
+        return False
+    if not exists:
+        conn.execute(REBUILD_CHATS_FTS)
+        logger.debug("Built chats_fts from chats")
+    return True
+
+
+def _phrase(text):
+    # Quoted FTS5 string; user input never reaches the query syntax
+    return '"' + text.replace('"', '""') + '"'
+
+
+def fts_query(user_id, text):
+    """MATCH expression for messages of user_id containing every word of text, or None if text has no words."""
+    words = re.findall(r"\w+", text.lower())
+    if not words:
+        return None
+    terms = " ".join(_phrase(word) for word in words)
+    # Whole words only: prefix queries merge the postings of every expansion and were the slowest case
+    user_words = re.findall(r"\w+", str(user_id).lower())
+    if not user_words:
+        return f"message : ({terms})"
+    return f"user_id : {_phrase(' '.join(user_words))} AND message : ({terms})"
+
+
+def _timed(func):
+    # Timed in the calling greenlet, so the wait for a pool thread counts and request traces see the sample
+    return metrics.timed("chatbot_db_seconds", op=func.__name__)(offloaded(func))
+
+
+@_timed
+def fetch_user(username):
+    row = get_connection().execute(SELECT_USER, (username,)).fetchone()
+    return dict(zip(USER_COLUMNS, row)) if row else None
+
+
+@_timed
+def create_user(username, hashed_password, name, email):
+    get_connection().execute(INSERT_USER, (username, hashed_password, name, email))
+
+
+@_timed
+def update_user(username, hashed_password, name, email, two_factor_enabled, email_notifications, sms_notifications,
+                security_question1, security_answer1, security_question2, security_answer2, profile_picture):
+    get_connection().execute(UPDATE_USER, (hashed_password, name, email, two_factor_enabled, email_notifications,
+                                           sms_notifications, security_question1, security_answer1,
+                                           security_question2, security_answer2, profile_picture, username))
+
+
+@_timed
+def update_password(username, hashed_password):
+    get_connection().execute(UPDATE_PASSWORD, (hashed_password, username))
+
+
+@_timed
+def fetch_credentials(username):
+    row = get_connection().execute(SELECT_CREDENTIALS, (username,)).fetchone()
+    return row[0] if row else None
+
+
+@_timed
+def put_credentials(username, data, timestamp, conn=None):
+    (conn or get_connection()).execute(UPSERT_CREDENTIALS, (username, data, timestamp))
+
+
+def all_credentials(conn=None):
+    return (conn or get_connection()).execute(SELECT_ALL_CREDENTIALS).fetchall()
+
+
+@_timed
+def take_token(key, rate, burst, now, tokens=1, conn=None):
+    """Take `tokens` (at most burst) from the bucket `key`, refilled at `rate` per second up to `burst`; False if it holds fewer."""
+    cursor = (conn or get_connection()).execute(TAKE_TOKEN, {"key": key, "rate": rate, "burst": burst, "now": now,
+                                                             "tokens": tokens})
+    return cursor.rowcount == 1
+
+
+def bucket_tokens(key, rate, burst, now, conn=None):
+    row = (conn or get_connection()).execute(SELECT_BUCKET, (key,)).fetchone()
+    return burst if row is None else min(burst, row[0] + (now - row[1]) * rate)
+
+
+@_timed
+def acquire_upstream_slot(limit, now, lease, conn=None):
+    """Id of a new in-flight slot, or None if `limit` unexpired slots are already taken."""
+    conn = conn or get_connection()
+    cursor = conn.execute(ACQUIRE_SLOT, (now, os.getpid(), now - lease, limit))
+    return cursor.lastrowid if cursor.rowcount == 1 else None
+
+
+@_timed
+def release_upstream_slot(slot_id):
+    with transaction() as conn:
+        conn.execute(RELEASE_SLOT, (slot_id,))
+
+
+@offloaded
+def count_upstream_slots(now, lease):
+    return get_connection().execute(COUNT_SLOTS, (now - lease,)).fetchone()[0]
+
+
+@offloaded
+def prune_rate_buckets(cutoff):
+    with transaction() as conn:
+        return conn.execute(PRUNE_BUCKETS, (cutoff,)).rowcount
+
+
+@offloaded
+def prune_upstream_slots(cutoff):
+    """Delete slots acquired before cutoff; ACQUIRE_SLOT already ignores them, this only keeps the table small."""
+    with transaction() as conn:
+        return conn.execute(PRUNE_SLOTS, (cutoff,)).rowcount
+
+
+@_timed
+def insert_message(user_id, chat_id, message, is_user, timestamp):
+    get_connection().execute(INSERT_MESSAGE, (user_id, chat_id, message, is_user, timestamp))
+
+
+@_timed
+def insert_messages(rows):
+    """Insert (user_id, chat_id, message, is_user, timestamp) rows in one transaction."""
+    with transaction() as conn:
+        conn.executemany(INSERT_MESSAGE, rows)
+
+
+@_timed
+def insert_turn(user_id, chat_id, user_message, bot_response, timestamp):
+    """Persist a user message and the bot's reply atomically (one commit, one fsync)."""
+    insert_messages([(user_id, chat_id, user_message, True, timestamp),
+                     (user_id, chat_id, bot_response, False, timestamp)])
+
+
+def _history_message(row):
+    return {"id": row[0], "timestamp": row[1], "message": row[2], "isUser": bool(row[3])}
+
+
+@_timed
+def fetch_history(user_id, chat_id):
+    return [_history_message(row) for row in get_connection().execute(SELECT_HISTORY, (user_id, chat_id))]
+
+
+@_timed
+def fetch_history_page(user_id, chat_id, limit, before=None, since=None):
+    """Up to limit messages, oldest first, and whether more exist past them.
+
+    since: messages after that id (fetching new messages); otherwise the newest
+    messages before `before` (or the end of the chat), for scrolling back.
+    """
+    conn = get_connection()
+    if since is not None:
+        rows = conn.execute(SELECT_HISTORY_SINCE, (user_id, chat_id, since, limit + 1)).fetchall()
+        return [_history_message(row) for row in rows[:limit]], len(rows) > limit
+    rows = conn.execute(SELECT_HISTORY_BEFORE, (user_id, chat_id, MAX_ID if before is None else before,
+                                                limit + 1)).fetchall()
+    return [_history_message(row) for row in reversed(rows[:limit])], len(rows) > limit
+
+
+@_timed
+def search_chats(user_id, text, limit, offset=0):
+    """Ranked matches for text among user_id's live messages (not archived ones), best first, and whether more exist past them."""
+    query = fts_query(user_id, text)
+    if query is None:
+        return [], False
+    rows = get_connection().execute(SEARCH_CHATS, (SNIPPET_START, SNIPPET_END, SNIPPET_TOKENS, query, user_id,
+                                                   limit + 1, offset)).fetchall()
+    return [{"id": row[0], "chatId": row[1], "timestamp": row[2], "isUser": bool(row[3]), "snippet": row[4]}
+            for row in rows[:limit]], len(rows) > limit
+
+
+@_timed
+def list_chat_ids(user_id):
+    return [row[0] for row in get_connection().execute(SELECT_CHAT_IDS, (user_id,))]
+
+
+@_timed
+def chat_list_version(user_id):
+    return "-".join(str(value) for value in get_connection().execute(CHAT_LIST_VERSION, (user_id,)).fetchone())
+
+
+def _delete_chat(conn, user_id, chat_id):
+    row = conn.execute(COUNT_CHAT, (user_id, chat_id)).fetchone()
+    count = row[0] if row else 0
+    if count:
+        conn.execute(DELETE_CHAT, (user_id, chat_id))
+    count += conn.execute(DELETE_ARCHIVED_CHAT, (user_id, chat_id)).rowcount
+    return count
+
+
+@_timed
+def delete_chat(user_id, chat_id):
+    """Delete a chat, live or archived; returns the number of rows removed (0 if it did not exist)."""
+    with transaction() as conn:
+        return _delete_chat(conn, user_id, chat_id)
+
+
+def delete_chats(chats):
+    """Delete (user_id, chat_id) chats in one transaction; returns how many existed."""
+    with transaction() as conn:
+        return sum(1 for user_id, chat_id in chats if _delete_chat(conn, user_id, chat_id))
+
+
+@_timed
+def update_retention(username, days):
+    get_connection().execute(UPDATE_RETENTION, (days, username))
+
+
+@_timed
+def fetch_archived_chat(user_id, chat_id):
+    row = get_connection().execute(SELECT_ARCHIVED_CHAT, (user_id, chat_id)).fetchone()
+    return dict(zip(ARCHIVE_ENTRY_COLUMNS, row)) if row else None
+
+
+def archive_candidates(cutoff, limit):
+    """(user_id, chat_id) of up to limit live chats whose last message is older than cutoff, grouped by user."""
+    return get_connection().execute(SELECT_ARCHIVE_CANDIDATES, (cutoff, limit)).fetchall()
+
+
+def record_archived_chats(entries, archived_at):
+    """Point chat_archive at newly written blocks and delete the archived messages, in one transaction.
+
+    entries: [(live_count, (user_id, chat_id, created_at, last_message_at, message_count, last_id,
+    archive_file, archive_offset, archive_length))]. A chat whose live rows were deleted meanwhile
+    is skipped, so archiving never brings back a chat the user deleted. Returns the chats recorded.
+    """
+    recorded = 0
+    with transaction() as conn:
+        for live_count, entry in entries:
+            user_id, chat_id, last_id = entry[0], entry[1], entry[5]
+            conn.execute("SAVEPOINT archive_chat")
+            if conn.execute(DELETE_ARCHIVED_MESSAGES, (user_id, chat_id, last_id)).rowcount == live_count:
+                conn.execute(UPSERT_ARCHIVED_CHAT, entry + (archived_at,))
+                recorded += 1
+            else:
+                logger.warning(f"Chat {chat_id} changed while being archived; leaving it live")
+                conn.execute("ROLLBACK TO archive_chat")
+            conn.execute("RELEASE archive_chat")
+    return recorded
+
+
+def expired_chats(now, default_days, limit):
+    """(user_id, chat_id) of live and of archived-only chats past their owner's retention period."""
+    params = {"now": now, "default": default_days, "limit": limit}
+    conn = get_connection()
+    return conn.execute(SELECT_EXPIRED_CHATS, params).fetchall() + \
+        conn.execute(SELECT_EXPIRED_ARCHIVED_CHATS, params).fetchall()
+
+
+def user_archive_file(user_id):
+    row = get_connection().execute(SELECT_USER_ARCHIVE_FILE, (user_id,)).fetchone()
+    return row[0] if row else None
+
+
+def archive_files():
+    """(archive_file, user_id, bytes still referenced) for every archive file in use."""
+    return get_connection().execute(SELECT_ARCHIVE_FILES).fetchall()
+
+
+def archive_file_entries(archive_file):
+    return get_connection().execute(SELECT_ARCHIVE_FILE_ENTRIES, (archive_file,)).fetchall()
+
+
+def move_archived_chats(moves):
+    """Repoint chats at a rewritten archive file: moves is [(new_file, new_offset, user_id, chat_id, old_file,
+    old_offset)]. Rows that changed since they were read are left alone; returns the number moved."""
+    with transaction() as conn:
+        return sum(conn.execute(MOVE_ARCHIVED_CHAT, move).rowcount for move in moves)
+
+
+def claim_maintenance(job, now, interval):
+    """True if this process should run job now; the next run is then due interval seconds later."""
+    with transaction() as conn:
+        conn.execute(INSERT_MAINTENANCE, (job, now))
+        return conn.execute(CLAIM_MAINTENANCE, (now + interval, job, now)).rowcount == 1
+
+
+def finish_maintenance(job, now, result):
+    get_connection().execute(FINISH_MAINTENANCE, (now, result, job))
+
+
+@offloaded
+def maintenance_status(job):
+    row = get_connection().execute(SELECT_MAINTENANCE, (job,)).fetchone()
+    return dict(zip(("next_run_at", "last_run_at", "last_result"), row)) if row else None
+
+
+def auto_vacuum_mode():
+    """0 (none), 1 (full) or 2 (incremental)."""
+    return get_connection().execute("PRAGMA auto_vacuum").fetchone()[0]
+
+
+def freelist_count():
+    return get_connection().execute("PRAGMA freelist_count").fetchone()[0]
+
+
+def vacuum():
+    """Rebuild the whole file (also applies auto_vacuum=INCREMENTAL to an older database). Holds the write lock."""
+    conn = get_connection()
+    with _local.lock:
+        conn.execute("PRAGMA auto_vacuum=INCREMENTAL")
+        conn.execute("VACUUM")
+
+
+def incremental_vacuum(pages):
+    """Return up to pages free pages to the filesystem; returns how many were released."""
+    conn = get_connection()
+    with _local.lock:
+        before = conn.execute("PRAGMA freelist_count").fetchone()[0]
+        # It frees one page per step and execute() steps a row-less statement only once;
+        # executescript steps it to the end. Its own short transaction, like any other write.
+        conn.executescript(f"BEGIN IMMEDIATE; PRAGMA incremental_vacuum({int(pages)}); COMMIT;")
+        return before - conn.execute("PRAGMA freelist_count").fetchone()[0]
+
+
+def merge_chats_fts(pages):
+    """Merge chats_fts segments left behind by deletes, doing about pages pages of work."""
+    with transaction() as conn:
+        conn.execute("INSERT INTO chats_fts (chats_fts, rank) VALUES ('merge', ?)", (int(pages),))
+
+
+def analyze(analysis_limit):
+    """Refresh the query planner's statistics, sampling about analysis_limit rows per index."""
+    conn = get_connection()
+    with _local.lock:
+        conn.execute(f"PRAGMA analysis_limit={int(analysis_limit)}")
+        conn.execute("ANALYZE")
+
+
+def checkpoint():
+    """Copy the WAL into the database and truncate it; returns (busy, wal pages, pages checkpointed)."""
+    conn = get_connection()
+    with _local.lock:
+        return tuple(conn.execute("PRAGMA wal_checkpoint(TRUNCATE)").fetchone())
+
+
+@_timed
+def cache_get(namespace, key):
+    row = get_connection().execute(SELECT_CACHE, (namespace, key)).fetchone()
+    return tuple(row) if row else None
+
+
+@_timed
+def cache_put(namespace, key, value, fetched_at):
+    get_connection().execute(UPSERT_CACHE, (namespace, key, value, fetched_at))
+
+
+@_timed
+def enqueue_task(user_id, payload, now, timestamp):
+    return get_connection().execute(INSERT_TASK, (user_id, payload, timestamp, timestamp, now)).lastrowid
+
+
+@_timed
+def claim_tasks(limit, now, lease, timestamp):
+    """Atomically mark up to limit due tasks as 'sending'; returns [(id, payload, attempts)]."""
+    with transaction() as conn:
+        rows = conn.execute(SELECT_DUE_TASKS, (now, now - lease, limit)).fetchall()
+        conn.executemany(CLAIM_TASK, [(now, timestamp, row[0]) for row in rows])
+    return [(task_id, payload, attempts + 1) for task_id, payload, attempts in rows]
+
+
+@_timed
+def finish_tasks(results, timestamp):
+    """Record delivery outcomes: results is [(id, status, last_error, next_attempt_at)]."""
+    with transaction() as conn:
+        conn.executemany(FINISH_TASK, [(status, error, next_at, timestamp, task_id)
+                                       for task_id, status, error, next_at in results])
+
+
+@_timed
+def list_tasks(user_id, limit=50):
+    rows = get_connection().execute(SELECT_USER_TASKS, (user_id, limit)).fetchall()
+    return [{"id": row[0], "payload": row[1], "status": row[2], "attempts": row[3], "lastError": row[4],
+             "createdAt": row[5], "updatedAt": row[6]} for row in rows]
+
+
+@_timed
+def insert_knowledge(rows):
+    """Append (category, answer, created_at) rows in one transaction; returns the last row id."""
+    with transaction() as conn:
+        conn.executemany(INSERT_KNOWLEDGE, rows)
+        return conn.execute("SELECT last_insert_rowid()").fetchone()[0]
+
+
+@_timed
+def knowledge_since(last_id):
+    return get_connection().execute(SELECT_KNOWLEDGE_SINCE, (last_id,)).fetchall()
+
+
+def knowledge_count(conn=None):
+    return (conn or get_connection()).execute("SELECT COUNT(*) FROM knowledge").fetchone()[0]
+
+
+@offloaded
+def add_metrics(rows, period, prune_before):
+    """Add (name, labels, le, value) deltas to the totals and to the history period; drop expired history."""
+    with transaction() as conn:
+        conn.executemany(ADD_METRIC, rows)
+        conn.executemany(ADD_METRIC_HISTORY, ((period, *row) for row in rows))
+        conn.execute(PRUNE_METRICS_HISTORY, (prune_before,))
+
+
+@offloaded
+def read_metrics():
+    return get_connection().execute(SELECT_METRICS).fetchall()
+
+
+@offloaded
+def read_metrics_history(name, since):
+    return get_connection().execute(SELECT_METRICS_HISTORY, (name, since)).fetchall()
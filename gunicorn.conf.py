@@ -0,0 +1,20 @@
+"""gunicorn settings; every value can be overridden from the environment.
+
+The default gevent worker runs each request in a greenlet, and gevent's
+monkey-patching makes the requests/urllib3 sockets used by outbound.py
+cooperative. A request waiting on weather, news, Zapier or OpenAI therefore
+yields to other requests instead of pinning a whole worker process. SQLite
+calls, which cannot yield, run on gevent's native thread pool (see db.py).
+WEB_WORKER_CLASS=sync restores one request per worker.
+"""
+import os
+import secrets
+
+# Read in the master before forking, so all workers sign sessions with the same key
+os.environ.setdefault("SECRET_KEY", secrets.token_hex(32))
+
+workers = int(os.getenv("WEB_CONCURRENCY", "2"))
+worker_class = os.getenv("WEB_WORKER_CLASS", "gevent")
+# Concurrent requests per gevent worker
+worker_connections = int(os.getenv("WEB_WORKER_CONNECTIONS", "1000"))
+timeout = int(os.getenv("WEB_TIMEOUT", "30"))
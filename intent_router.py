@@ -0,0 +1,137 @@
+"""Intent routing for process_query.
+
+All intent triggers and knowledge-base categories are compiled into one
+Aho-Corasick automaton, so a message is scanned once no matter how many
+categories users have taught the bot via /learn. Newly learned categories go
+into a small pending list that is checked with plain substring tests until it
+grows past REBUILD_THRESHOLD (or 1/16 of all patterns), at which point a fresh automaton is compiled and
+swapped in.
+"""
+import threading
+from collections import deque, namedtuple
+
+import metrics
+
+Intent = namedtuple('Intent', ['name', 'triggers', 'handler'])
+Match = namedtuple('Match', ['intents', 'categories'])
+
+REBUILD_THRESHOLD = 256
+
+
+class AhoCorasick:
+    """Multi-pattern substring matcher; build() must be called after the last add()."""
+
+    def __init__(self):
+        self._goto = [{}]
+        self._fail = [0]
+        self._out = [[]]
+
+    def add(self, pattern, value):
+        node = 0
+        for ch in pattern:
+            nxt = self._goto[node].get(ch)
+            if nxt is None:
+                nxt = len(self._goto)
+                self._goto.append({})
+                self._fail.append(0)
+                self._out.append([])
+                self._goto[node][ch] = nxt
+            node = nxt
+        self._out[node].append(value)
+
+    def build(self):
+        # Breadth-first so every node's failure target is finished before its children
+        queue = deque(self._goto[0].values())
+        while queue:
+            node = queue.popleft()
+            for ch, child in self._goto[node].items():
+                queue.append(child)
+                state = self._fail[node]
+                while state and ch not in self._goto[state]:
+                    state = self._fail[state]
+                self._fail[child] = self._goto[state].get(ch, 0)
+                self._out[child] = self._out[child] + self._out[self._fail[child]]
+        return self
+
+    def search(self, text):
+        goto, fail, out = self._goto, self._fail, self._out
+        node = 0
+        for ch in text:
+            while node and ch not in goto[node]:
+                node = fail[node]
+            node = goto[node].get(ch, 0)
+            if out[node]:
+                yield from out[node]
+
+
+class IntentRouter:
+    """Dispatches a message to the first registered intent whose triggers match it.
+
+    Intents are tried in registration order; a handler may return None to let
+    the next matching intent answer. Knowledge-base categories are reported in
+    Match.categories in the order they were added.
+    """
+
+    def __init__(self):
+        self._intents = []
+        self._patterns = []
+        self._category_order = {}
+        self._pending = []
+        self._automaton = AhoCorasick().build()
+        self._lock = threading.Lock()
+
+    def intent(self, name, triggers):
+        def decorator(handler):
+            self._intents.append(Intent(name, tuple(triggers), handler))
+            with self._lock:
+                self._patterns.extend((trigger, ('intent', name)) for trigger in triggers)
+                self._compile()
+            return handler
+        return decorator
+
+    def add_category(self, category):
+        self.add_categories([category])
+
+    def add_categories(self, categories):
+        with self._lock:
+            for category in categories:
+                if category in self._category_order:
+                    continue
+                self._category_order[category] = len(self._category_order)
+                entry = (category, ('category', category))
+                self._patterns.append(entry)
+                self._pending.append(entry)
+            # Threshold grows with the pattern count so rebuild cost stays amortized O(1) per addition
+            if len(self._pending) > max(REBUILD_THRESHOLD, len(self._patterns) // 16):
+                self._compile()
+
+    def _compile(self):
+        automaton = AhoCorasick()
+        for pattern, value in self._patterns:
+            automaton.add(pattern, value)
+        self._automaton = automaton.build()
+        self._pending = []
+
+    def match(self, text):
+        # Read pending before the automaton: a concurrent rebuild then yields a superset, never a gap
+        pending = self._pending
+        automaton = self._automaton
+        intents, categories = set(), set()
+        for kind, value in automaton.search(text):
+            (intents if kind == 'intent' else categories).add(value)
+        for pattern, (_, value) in pending:
+            if pattern in text:
+                categories.add(value)
+        return Match(intents, sorted(categories, key=self._category_order.__getitem__))
+
+    def dispatch(self, text, match=None):
+        if match is None:
+            with metrics.timer("chatbot_stage_seconds", stage="intent_match"):
+                match = self.match(text)
+        for intent in self._intents:
+            if intent.name in match.intents:
+                with metrics.timer("chatbot_intent_seconds", intent=intent.name):
+                    response = intent.handler(text, match)
+                if response is not None:
+                    return response
+        return None
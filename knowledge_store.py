@@ -0,0 +1,85 @@
+"""Learned answers, stored append-only in the knowledge table of chat_history.db.
+
+/learn inserts one row (O(1), safe with many gunicorn workers writing at
+once) instead of rewriting knowledge_base.json. Each worker keeps an
+in-memory {category: [answers]} view and tails the table by id, so answers
+learned in another worker show up within REFRESH_SECONDS without a restart.
+knowledge_base.json is only read once, to seed the table during migration.
+
+Every entry is also added to a SemanticIndex, so search() can find the
+category for a paraphrased question that contains no category verbatim; its
+content-word check keeps "capital of spain" from matching "capital of france".
+"""
+import os
+import json
+import threading
+import time
+import logging
+from datetime import datetime
+
+import db
+from semantic_index import SemanticIndex
+
+logger = logging.getLogger(__name__)
+
+SEED_FILE = 'knowledge_base.json'
+REFRESH_SECONDS = float(os.getenv("KNOWLEDGE_REFRESH_SECONDS", "1"))
+
+
+def _timestamp():
+    return datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+
+
+def import_seed(conn, path=SEED_FILE):
+    """Copy a legacy knowledge_base.json into an empty knowledge table (run inside the migration)."""
+    if db.knowledge_count(conn) or not os.path.exists(path):
+        return 0
+    with open(path, 'r') as f:
+        seed = json.load(f)
+    timestamp = _timestamp()
+    rows = [(category, answer, timestamp) for category, answers in seed.items() for answer in answers]
+    conn.executemany(db.INSERT_KNOWLEDGE, rows)
+    logger.debug("Imported %s knowledge entries from %s", len(rows), path)
+    return len(rows)
+
+
+class KnowledgeBase:
+    def __init__(self, on_new_categories=None, refresh_interval=REFRESH_SECONDS):
+        self.entries = {}
+        self.on_new_categories = on_new_categories
+        self.refresh_interval = refresh_interval
+        self._last_id = 0
+        self._last_refresh = 0.0
+        self.index = SemanticIndex(match_words=True)
+        self._lock = threading.Lock()
+
+    def refresh(self, force=False):
+        """Apply rows added since the last refresh; at most one query per refresh_interval unless forced."""
+        if not force and time.monotonic() - self._last_refresh < self.refresh_interval:
+            return
+        with self._lock:
+            self._last_refresh = time.monotonic()
+            new_categories = []
+            rows = db.knowledge_since(self._last_id)
+            for row_id, category, answer in rows:
+                if category not in self.entries:
+                    self.entries[category] = []
+                    new_categories.append(category)
+                self.entries[category].append(answer)
+                self._last_id = row_id
+            self.index.add([category for _, category, _ in rows],
+                           [f"{category} {answer}" for _, category, answer in rows])
+        if new_categories and self.on_new_categories:
+            self.on_new_categories(new_categories)
+
+    def add(self, category, answer):
+        db.insert_knowledge([(category, answer, _timestamp())])
+        self.refresh(force=True)
+
+    def get(self, category):
+        return self.entries.get(category)
+
+    def search(self, message):
+        """Category most similar to message, or None if nothing scores above the index's min_score."""
+        hits = self.index.search(message)
+        return hits[0][0] if hits else None
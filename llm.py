@@ -0,0 +1,64 @@
+"""OpenAI chat completions for the process_query fallback.
+
+Talks to the Chat Completions HTTP API through the shared outbound session
+(same pooling, timeouts and circuit breaker as the other integrations), so it
+can be pointed at a local fake server with OPENAI_API_BASE. stream_completion
+yields text deltas as the server emits them (server-sent events); complete
+returns the whole answer.
+"""
+import os
+import json
+import logging
+
+import outbound
+
+logger = logging.getLogger(__name__)
+
+MODEL = "gpt-3.5-turbo"
+MAX_TOKENS = 150
+TEMPERATURE = 0.7
+
+
+class LLMError(Exception):
+    pass
+
+
+def api_key():
+    return os.getenv("OPENAI_API_KEY")
+
+
+def available():
+    return bool(api_key())
+
+
+def _post(message, stream):
+    api_base = os.getenv("OPENAI_API_BASE", "https://api.openai.com/v1")
+    response = outbound.post("openai", f"{api_base}/chat/completions", stream=stream,
+                             headers={"Authorization": f"Bearer {api_key()}"},
+                             json={"model": MODEL, "messages": [{"role": "user", "content": message}],
+                                   "max_tokens": MAX_TOKENS, "temperature": TEMPERATURE, "stream": stream})
+    if response.status_code != 200:
+        response.close()
+        raise LLMError(f"OpenAI returned HTTP {response.status_code}")
+    return response
+
+
+def complete(message):
+    data = _post(message, stream=False).json()
+    return data["choices"][0]["message"]["content"].strip()
+
+
+def stream_completion(message):
+    response = _post(message, stream=True)
+    with response:
+        # chunk_size=None hands over each chunk as it arrives instead of waiting to fill a buffer
+        for raw in response.iter_lines(chunk_size=None):
+            line = raw.decode("utf-8")
+            if not line.startswith("data:"):
+                continue
+            data = line[len("data:"):].strip()
+            if data == "[DONE]":
+                break
+            delta = json.loads(data)["choices"][0].get("delta", {}).get("content")
+            if delta:
+                yield delta
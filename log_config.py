@@ -0,0 +1,187 @@
+"""Logging setup: structured JSON records written off the request path.
+
+configure() puts a QueueHandler on the root logger, so a request only builds a
+LogRecord and enqueues it. A writer thread wakes at most every LOG_FLUSH_MS,
+formats the queued records (JSON by default, extra= fields included) and
+writes them to a size-rotated file. Records are formatted in that thread, so
+use lazy %-style arguments, never f-strings, in debug/info calls. When the
+queue is full the record is dropped instead of blocking the request.
+
+The level comes from LOG_LEVEL, else from APP_ENV (development: DEBUG,
+anything else: INFO). LOG_DEBUG_SAMPLE keeps only that fraction of DEBUG
+records, for turning debug on in production without logging every request.
+Each process writes its own file ({pid} in LOG_FILE), since several gunicorn
+workers rotating one file would clobber each other; LOG_FILE=- logs to stderr.
+"""
+import os
+import sys
+import json
+import queue
+import random
+import atexit
+import threading
+import time
+import logging
+import logging.handlers
+from datetime import datetime
+
+APP_ENV = os.getenv("APP_ENV", "production")
+LEVEL = os.getenv("LOG_LEVEL", "DEBUG" if APP_ENV == "development" else "INFO").upper()
+PATH = os.getenv("LOG_FILE", os.path.join("logs", "app-{pid}.log"))
+FORMAT = os.getenv("LOG_FORMAT", "json")
+MAX_BYTES = int(os.getenv("LOG_MAX_BYTES", str(20 * 1024 * 1024)))
+BACKUPS = int(os.getenv("LOG_BACKUPS", "5"))
+DEBUG_SAMPLE = float(os.getenv("LOG_DEBUG_SAMPLE", "1"))
+QUEUE_SIZE = int(os.getenv("LOG_QUEUE_SIZE", "10000"))
+FLUSH_INTERVAL = int(os.getenv("LOG_FLUSH_MS", "10")) / 1000.0
+
+TEXT_FORMAT = "%(asctime)s %(levelname)s %(name)s: %(message)s"
+# Everything a LogRecord has by default; any other attribute came from extra=
+_RECORD_FIELDS = set(vars(logging.makeLogRecord({}))) | {"message", "asctime"}
+
+_STOP = object()
+
+_handler = None
+_listener = None
+_pid = None
+
+
+class JsonFormatter(logging.Formatter):
+    def format(self, record):
+        entry = {"time": datetime.fromtimestamp(record.created).isoformat(timespec="milliseconds"),
+                 "level": record.levelname, "logger": record.name, "message": record.getMessage()}
+        for key, value in vars(record).items():
+            if key not in _RECORD_FIELDS:
+                entry[key] = value
+        if record.exc_info:
+            entry["exception"] = self.formatException(record.exc_info)
+        return json.dumps(entry, ensure_ascii=False, default=str)
+
+
+class DebugSampler(logging.Filter):
+    def __init__(self, rate):
+        super().__init__()
+        self.rate = rate
+        self.dropped = 0
+
+    def filter(self, record):
+        if record.levelno > logging.DEBUG or self.rate >= 1 or random.random() < self.rate:
+            return True
+        self.dropped += 1
+        return False
+
+
+class _QueueHandler(logging.handlers.QueueHandler):
+    # SimpleQueue puts are cheap C calls; the size check bounds it instead of maxsize, so
+    # the stop sentinel can still be enqueued when the queue is full
+    def __init__(self, max_size):
+        super().__init__(queue.SimpleQueue())
+        self.max_size = max_size
+        self.dropped = 0
+
+    def prepare(self, record):
+        # The stock prepare() formats the message in the caller; the listener does it here
+        return record
+
+    def enqueue(self, record):
+        if self.queue.qsize() >= self.max_size:
+            self.dropped += 1
+        else:
+            self.queue.put(record)
+
+
+class _RotatingFileHandler(logging.handlers.RotatingFileHandler):
+    def shouldRollover(self, record):
+        # The stock check formats every record a second time just to measure it
+        return self.maxBytes > 0 and self.stream is not None and self.stream.tell() >= self.maxBytes
+
+
+def _target(path, max_bytes, backups):
+    if path == "-":
+        return logging.StreamHandler(sys.stderr)
+    path = path.format(pid=os.getpid())
+    directory = os.path.dirname(path)
+    if directory:
+        os.makedirs(directory, exist_ok=True)
+    return _RotatingFileHandler(path, maxBytes=max_bytes, backupCount=backups, encoding="utf-8")
+
+
+class _Listener:
+    """Writes queued records to target in batches: one wake-up per FLUSH_INTERVAL instead of one per record."""
+
+    def __init__(self, log_queue, target, interval):
+        self.queue = log_queue
+        self.target = target
+        self.interval = interval
+        self._thread = threading.Thread(target=self._run, name="log-writer", daemon=True)
+
+    def start(self):
+        self._thread.start()
+        return self
+
+    def stop(self):
+        if self._thread.is_alive():
+            self.queue.put(_STOP)
+            self._thread.join()
+        self.target.close()
+
+    def _run(self):
+        stopping = False
+        while not stopping:
+            batch = [self.queue.get()]
+            if batch[0] is _STOP:
+                break
+            # Let the rest of the burst queue up while this thread is off the GIL
+            time.sleep(self.interval)
+            while True:
+                try:
+                    record = self.queue.get_nowait()
+                except queue.Empty:
+                    break
+                if record is _STOP:
+                    stopping = True
+                    break
+                batch.append(record)
+            for record in batch:
+                self.target.handle(record)
+
+
+def configure(level=LEVEL, path=PATH, fmt=FORMAT, sample=DEBUG_SAMPLE, max_bytes=MAX_BYTES, backups=BACKUPS,
+              force=False):
+    """Install the queue handler on the root logger, once per process (again after a fork) unless forced."""
+    global _handler, _listener, _pid
+    if _pid == os.getpid() and not force:
+        return
+    if _pid == os.getpid():
+        shutdown()
+    elif _handler is not None:
+        # Inherited from the parent through fork; its listener thread does not exist here
+        logging.getLogger().removeHandler(_handler)
+    target = _target(path, max_bytes, backups)
+    target.setFormatter(JsonFormatter() if fmt == "json" else logging.Formatter(TEXT_FORMAT))
+    _handler = _QueueHandler(QUEUE_SIZE)
+    _handler.addFilter(DebugSampler(sample))
+    root = logging.getLogger()
+    root.addHandler(_handler)
+    root.setLevel(level)
+    _listener = _Listener(_handler.queue, target, FLUSH_INTERVAL).start()
+    if _pid is None:
+        atexit.register(shutdown)
+    _pid = os.getpid()
+
+
+def shutdown():
+    """Write out everything still queued and detach the handler."""
+    global _handler, _listener
+    if _listener is not None and _pid == os.getpid():
+        _listener.stop()
+    if _handler is not None:
+        logging.getLogger().removeHandler(_handler)
+    _handler = _listener = None
+
+
+def stats():
+    if _handler is None:
+        return {}
+    return {"queued": _handler.queue.qsize(), "dropped": _handler.dropped,
+            "sampled_out": sum(f.dropped for f in _handler.filters)}
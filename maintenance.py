@@ -0,0 +1,165 @@
+"""Scheduled upkeep of chat_history.db: retention, archival, and giving free space back.
+
+One run (run_once, or `flask --app app maintain`):
+
+1. deletes chats whose last message is older than their owner's retention
+   period: users.retention_days, set on the settings page, or
+   CHAT_RETENTION_DAYS when it is NULL; 0 keeps chats forever;
+2. if CHAT_ARCHIVE_AFTER_DAYS is set (it is 0, off, by default), moves chats
+   idle that long out of chats and its indexes into the per-user archive
+   files (chat_archive.py). /get_history still reads them on demand, but they
+   leave the full-text index, so /search no longer finds their messages;
+3. compacts archive files that are mostly deleted chats;
+4. merges the full-text index segments the deletes left behind, releases
+   free pages with incremental_vacuum a chunk at a time (each chunk is its
+   own short write transaction, so chat writes interleave), truncates the WAL
+   and refreshes the planner's statistics with a sampled ANALYZE.
+
+Run it from cron with `flask --app app maintain`. With MAINTENANCE=1 every
+worker runs a Scheduler thread instead, and a run is claimed in
+maintenance_runs first, so one process does it per MAINTENANCE_INTERVAL.
+Under gevent workers the Scheduler is a greenlet, so each run goes to gevent's
+native thread pool (db.offloaded); compression, ANALYZE and vacuum would
+otherwise stall every request in that worker. A database created
+before auto_vacuum=INCREMENTAL needs one full VACUUM to switch over. Scheduled
+runs never do that, since it rewrites the whole file under the write lock;
+`flask --app app maintain --vacuum` does.
+"""
+import os
+import json
+import time
+import sqlite3
+import logging
+import itertools
+import threading
+from datetime import datetime, timedelta
+
+import db
+import chat_archive
+
+logger = logging.getLogger(__name__)
+
+# Off by default: cron runs `flask --app app maintain`
+ENABLED = os.getenv("MAINTENANCE", "0") == "1"
+INTERVAL = float(os.getenv("MAINTENANCE_INTERVAL", str(24 * 3600)))
+# How often each worker checks whether a run is due
+CHECK_INTERVAL = float(os.getenv("MAINTENANCE_CHECK_INTERVAL", "300"))
+RETENTION_DAYS = int(os.getenv("CHAT_RETENTION_DAYS", "0"))
+# Opt-in: archived chats drop out of /search (see above)
+ARCHIVE_AFTER_DAYS = int(os.getenv("CHAT_ARCHIVE_AFTER_DAYS", "0"))
+# Chats per delete/archive transaction and pages per incremental_vacuum transaction
+BATCH_SIZE = 200
+VACUUM_STEP = 256
+FTS_MERGE_PAGES = 500
+ANALYSIS_LIMIT = 1000
+JOB = "chats"
+TIMESTAMP_FORMAT = "%Y-%m-%d %H:%M:%S"
+INCREMENTAL = 2
+
+
+def expire(timestamp):
+    """Delete chats past their owner's retention period as of timestamp; returns how many."""
+    total = 0
+    while True:
+        deleted = db.delete_chats(db.expired_chats(timestamp, RETENTION_DAYS, BATCH_SIZE))
+        total += deleted
+        if not deleted:
+            return total
+
+
+def archive(cutoff, timestamp):
+    """Archive chats whose last message is older than cutoff; returns how many."""
+    total = 0
+    while True:
+        chats = db.archive_candidates(cutoff, BATCH_SIZE)
+        archived = sum(chat_archive.archive_chats(user_id, [chat_id for _, chat_id in group], timestamp)
+                       for user_id, group in itertools.groupby(chats, key=lambda row: row[0]))
+        total += archived
+        # Nothing archived means the rest changed underneath us; they are retried on the next run
+        if not archived:
+            return total
+
+
+def release_free_pages():
+    """Give the database's free pages back to the filesystem; returns how many were released."""
+    if db.auto_vacuum_mode() != INCREMENTAL:
+        logger.warning(f"{db.DB_PATH} does not use incremental auto_vacuum; "
+                       f"run `flask --app app maintain --vacuum` once to convert it")
+        return 0
+    released = 0
+    while True:
+        freed = db.incremental_vacuum(VACUUM_STEP)
+        released += freed
+        if freed < VACUUM_STEP:
+            return released
+
+
+def run_once(now=None):
+    """One maintenance pass; returns a report of what it did."""
+    started = time.time()
+    now = now or datetime.now()
+    timestamp = now.strftime(TIMESTAMP_FORMAT)
+    report = {"expired": expire(timestamp), "archived": 0}
+    if ARCHIVE_AFTER_DAYS > 0:
+        report["archived"] = archive((now - timedelta(days=ARCHIVE_AFTER_DAYS)).strftime(TIMESTAMP_FORMAT), timestamp)
+    report["archiveFiles"], report["archiveBytesFreed"] = chat_archive.compact()
+    if report["expired"] or report["archived"]:
+        try:
+            db.merge_chats_fts(FTS_MERGE_PAGES)
+        except sqlite3.OperationalError as e:
+            # No chats_fts when this SQLite build lacks FTS5
+            logger.debug("Skipped full-text index merge: %s", e)
+    report["pagesReleased"] = release_free_pages()
+    db.checkpoint()
+    db.analyze(ANALYSIS_LIMIT)
+    report["seconds"] = round(time.time() - started, 3)
+    return report
+
+
+def convert_auto_vacuum():
+    """Switch an older database to auto_vacuum=INCREMENTAL with one full VACUUM; False if it already was."""
+    if db.auto_vacuum_mode() == INCREMENTAL:
+        return False
+    db.vacuum()
+    return True
+
+
+def run_if_due(interval=INTERVAL, force=False):
+    """Run a pass if none has run in the last interval seconds (in any process); returns its report or None."""
+    if not db.claim_maintenance(JOB, time.time(), interval) and not force:
+        return None
+    report = run_once()
+    db.finish_maintenance(JOB, time.time(), json.dumps(report))
+    logger.info("Chat maintenance: %s", report)
+    return report
+
+
+def status():
+    entry = db.maintenance_status(JOB)
+    if entry and entry["last_result"]:
+        entry["last_result"] = json.loads(entry["last_result"])
+    return entry
+
+
+class Scheduler:
+    def __init__(self, interval=INTERVAL, check_interval=CHECK_INTERVAL):
+        self.interval = interval
+        self.check_interval = check_interval
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name="chat-maintenance", daemon=True)
+
+    def start(self):
+        self._thread.start()
+        return self
+
+    def close(self):
+        self._stop.set()
+        if self._thread.is_alive():
+            self._thread.join()
+
+    def _run(self):
+        while not self._stop.wait(self.check_interval):
+            try:
+                db.offloaded(run_if_due)(self.interval)
+            except Exception as e:
+                logger.error(f"Chat maintenance failed: {e}")
@@ -0,0 +1,199 @@
+"""Latency histograms for the hot path, exposed in Prometheus text format on /metrics.
+
+observe()/timer()/timed() add a sample to a fixed-bucket histogram keyed by
+metric name and labels. Each worker accumulates deltas in memory and a
+Flusher thread adds them to the metrics table every FLUSH_SECONDS, so /metrics
+on any gunicorn worker reports the totals of all of them. The same flush adds
+the deltas to metrics_history in HISTORY_SECONDS periods, which
+plot_latency.py charts. With METRICS_SHARED=0 each worker only reports its
+own samples; METRICS=0 turns observation into a no-op.
+
+trace() additionally collects the raw samples of the current thread (greenlet
+under gevent), which request_log.py uses to break a captured request down into
+intent, stage and upstream timings.
+
+db is imported lazily because db itself is instrumented with timed().
+"""
+import os
+import bisect
+import threading
+import time
+import logging
+from contextlib import contextmanager
+from functools import wraps
+
+logger = logging.getLogger(__name__)
+
+ENABLED = os.getenv("METRICS", "1") == "1"
+SHARED = os.getenv("METRICS_SHARED", "1") == "1"
+FLUSH_SECONDS = float(os.getenv("METRICS_FLUSH_SECONDS", "5"))
+HISTORY_SECONDS = int(os.getenv("METRICS_HISTORY_SECONDS", "300"))
+HISTORY_DAYS = int(os.getenv("METRICS_HISTORY_DAYS", "7"))
+
+BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+BUCKET_LABELS = tuple(repr(b) for b in BUCKETS) + ("+Inf",)
+HELP = {
+    "chatbot_request_seconds": "Time to produce a response (first byte for streamed replies), by endpoint and status.",
+    "chatbot_stage_seconds": "Time spent in a process_query stage (intent matching, NLTK, OpenAI).",
+    "chatbot_intent_seconds": "Time spent in an intent handler.",
+    "chatbot_outbound_seconds": "Duration of one outbound HTTP attempt, by integration and outcome.",
+    "chatbot_db_seconds": "Duration of one database call, by operation.",
+    "chatbot_admission_seconds": "Time to admit or turn away a chat request, by cost class and outcome.",
+}
+
+_lock = threading.Lock()
+_totals = {}
+_pending = {}
+_trace = threading.local()
+
+
+def _labels(labels):
+    return ",".join(f'{key}="{value}"' for key, value in sorted(labels.items()))
+
+
+def _add(series, key, bucket, seconds):
+    entry = series.get(key)
+    if entry is None:
+        # one count per bucket (the last is +Inf), then sum and count
+        entry = series[key] = [0] * (len(BUCKET_LABELS) + 2)
+    entry[bucket] += 1
+    entry[-2] += seconds
+    entry[-1] += 1
+
+
+def observe(name, seconds, **labels):
+    samples = getattr(_trace, "samples", None)
+    if samples is not None:
+        samples.append((name, labels, seconds))
+    if not ENABLED:
+        return
+    key = (name, _labels(labels))
+    bucket = bisect.bisect_left(BUCKETS, seconds)
+    with _lock:
+        _add(_totals, key, bucket, seconds)
+        if SHARED:
+            _add(_pending, key, bucket, seconds)
+
+
+@contextmanager
+def timer(name, **labels):
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        observe(name, time.perf_counter() - start, **labels)
+
+
+@contextmanager
+def trace():
+    """Collect (name, labels, seconds) for every sample observed in this thread inside the block."""
+    samples = _trace.samples = []
+    try:
+        yield samples
+    finally:
+        _trace.samples = None
+
+
+def mark(name, **labels):
+    """Add an event without a duration to the active trace(); no histogram is updated."""
+    samples = getattr(_trace, "samples", None)
+    if samples is not None:
+        samples.append((name, labels, None))
+
+
+def timed(name, **labels):
+    def decorator(func):
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                observe(name, time.perf_counter() - start, **labels)
+        return wrapper
+    return decorator
+
+
+def _rows(series):
+    for (name, labels), entry in series.items():
+        for le, value in zip(BUCKET_LABELS + ("sum", "count"), entry):
+            if value:
+                yield name, labels, le, value
+
+
+def flush():
+    """Add this worker's samples since the last flush to the shared tables."""
+    global _pending
+    import db
+    with _lock:
+        pending, _pending = _pending, {}
+    if not pending:
+        return
+    now = int(time.time())
+    try:
+        db.add_metrics(list(_rows(pending)), now - now % HISTORY_SECONDS, now - HISTORY_DAYS * 86400)
+    except Exception as e:
+        logger.error(f"Metrics flush failed: {e}")
+        # Put the deltas back so the next flush retries them
+        with _lock:
+            for key, entry in pending.items():
+                merged = _pending.setdefault(key, [0] * len(entry))
+                for i, value in enumerate(entry):
+                    merged[i] += value
+
+
+class Flusher:
+    def __init__(self, interval=FLUSH_SECONDS):
+        self.interval = interval
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name="metrics-flusher", daemon=True)
+
+    def start(self):
+        self._thread.start()
+        return self
+
+    def close(self):
+        self._stop.set()
+        if self._thread.is_alive():
+            self._thread.join()
+        flush()
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            flush()
+
+
+def _series_from_rows(rows):
+    series = {}
+    index = {le: i for i, le in enumerate(BUCKET_LABELS + ("sum", "count"))}
+    for name, labels, le, value in rows:
+        entry = series.setdefault((name, labels), [0] * len(index))
+        entry[index[le]] = value
+    return series
+
+
+def render():
+    """All histograms in Prometheus text exposition format (0.0.4)."""
+    if SHARED:
+        import db
+        flush()
+        series = _series_from_rows(db.read_metrics())
+    else:
+        with _lock:
+            series = {key: list(entry) for key, entry in _totals.items()}
+    lines = []
+    for name in sorted({name for name, _ in series}):
+        lines.append(f"# HELP {name} {HELP.get(name, name)}")
+        lines.append(f"# TYPE {name} histogram")
+        for (series_name, labels), entry in sorted(series.items()):
+            if series_name != name:
+                continue
+            prefix = labels + "," if labels else ""
+            cumulative = 0
+            for le, count in zip(BUCKET_LABELS, entry):
+                cumulative += count
+                lines.append(f'{name}_bucket{{{prefix}le="{le}"}} {cumulative:g}')
+            suffix = f"{{{labels}}}" if labels else ""
+            lines.append(f"{name}_sum{suffix} {entry[-2]:.6f}")
+            lines.append(f"{name}_count{suffix} {entry[-1]:g}")
+    return "\n".join(lines) + "\n"
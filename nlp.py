@@ -0,0 +1,64 @@
+"""Lazily computed, memoized NLTK features for chat messages.
+
+Tokenizing and POS-tagging are only needed by the fallback branches of
+process_query (help/bye/noun detection), so they are computed on demand and
+cached per normalized message; repeated questions skip the perceptron tagger.
+pos_tag_many tags a whole batch of messages (see process_batch) in one call.
+NLTK itself is imported on first use, and corpora are fetched by
+`flask --app app prepare` rather than at import time.
+"""
+import os
+from functools import lru_cache
+
+import metrics
+
+CACHE_SIZE = int(os.getenv("NLTK_CACHE_SIZE", "4096"))
+DATA_PATH = os.path.join(os.getcwd(), 'nltk_data')
+CORPORA = ('punkt', 'wordnet', 'averaged_perceptron_tagger')
+
+_nltk = None
+
+
+def _load():
+    global _nltk
+    if _nltk is None:
+        import nltk
+        if DATA_PATH not in nltk.data.path:
+            nltk.data.path.append(DATA_PATH)
+        _nltk = nltk
+    return _nltk
+
+
+def download():
+    """Fetch the corpora process_query needs into ./nltk_data (network; run once at build time)."""
+    nltk = _load()
+    os.makedirs(DATA_PATH, exist_ok=True)
+    results = [nltk.download(corpus, download_dir=DATA_PATH, quiet=True) for corpus in CORPORA]
+    return all(results)
+
+
+def normalize(message):
+    return " ".join(message.lower().split())
+
+
+# Timers sit inside the caches, so only real tokenize/tag work is measured
+@lru_cache(maxsize=CACHE_SIZE)
+def tokenize(message):
+    with metrics.timer("chatbot_stage_seconds", stage="nltk_tokenize"):
+        return tuple(_load().word_tokenize(message))
+
+
+@lru_cache(maxsize=CACHE_SIZE)
+def pos_tag(message):
+    tokens = list(tokenize(message))
+    with metrics.timer("chatbot_stage_seconds", stage="nltk_pos_tag"):
+        return tuple(_load().pos_tag(tokens))
+
+
+def pos_tag_many(messages):
+    """pos_tag for many messages with one tagger call (nltk.pos_tag_sents); results are not memoized."""
+    token_lists = [list(tokenize(message)) for message in messages]
+    if not token_lists:
+        return []
+    with metrics.timer("chatbot_stage_seconds", stage="nltk_pos_tag"):
+        return [tuple(tags) for tags in _load().pos_tag_sents(token_lists)]
@@ -0,0 +1,190 @@
+"""Shared HTTP client for every outbound integration (weather, Wikipedia, NewsAPI, Zapier, OpenAI).
+
+One keep-alive requests.Session per process (so TCP+TLS handshakes are reused),
+per-integration connect/read timeouts, bounded retries with full-jitter
+backoff, and a circuit breaker per integration that fails fast with
+CircuitOpenError after repeated errors instead of tying up a worker on a dead
+upstream. CircuitOpenError subclasses requests.RequestException, so existing
+`except requests.RequestException` handlers cover it.
+"""
+import os
+import random
+import threading
+import time
+import logging
+from collections import namedtuple
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.exceptions import NewConnectionError
+
+import metrics
+
+logger = logging.getLogger(__name__)
+
+POOL_SIZE = int(os.getenv("OUTBOUND_POOL_SIZE", "20"))
+BACKOFF_BASE = 0.1
+BACKOFF_CAP = 1.0
+
+# retries apply to connection errors, timeouts and 429/5xx responses; non-idempotent
+# calls (Zapier POST) are only retried when the connection was never established
+Integration = namedtuple('Integration', ['connect_timeout', 'read_timeout', 'retries', 'failure_threshold',
+                                         'reset_timeout'])
+INTEGRATIONS = {
+    "weather": Integration(2.0, 3.0, 2, 5, 30.0),
+    "wikipedia": Integration(2.0, 5.0, 1, 5, 60.0),
+    "news": Integration(2.0, 4.0, 2, 5, 30.0),
+    "zapier": Integration(2.0, 5.0, 2, 5, 30.0),
+    # read_timeout bounds the gap between streamed tokens, not the whole completion
+    "openai": Integration(3.0, 30.0, 1, 5, 30.0),
+}
+IDEMPOTENT = {"GET", "HEAD", "OPTIONS"}
+RETRY_STATUS = {429, 500, 502, 503, 504}
+
+
+class CircuitOpenError(requests.RequestException):
+    pass
+
+
+class CircuitBreaker:
+    """closed -> open after failure_threshold consecutive failures; one trial call after reset_timeout."""
+
+    def __init__(self, failure_threshold, reset_timeout):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.failures = 0
+        self.opened_at = None
+        self.trial_in_flight = False
+        self._lock = threading.Lock()
+
+    @property
+    def state(self):
+        if self.opened_at is None:
+            return "closed"
+        return "half_open" if time.monotonic() - self.opened_at >= self.reset_timeout else "open"
+
+    def allow(self):
+        with self._lock:
+            state = self.state
+            if state == "closed":
+                return True
+            if state == "half_open" and not self.trial_in_flight:
+                self.trial_in_flight = True
+                return True
+            return False
+
+    def record_success(self):
+        with self._lock:
+            self.failures = 0
+            self.opened_at = None
+            self.trial_in_flight = False
+
+    def record_failure(self):
+        with self._lock:
+            self.failures += 1
+            if self.trial_in_flight or self.failures >= self.failure_threshold:
+                self.opened_at = time.monotonic()
+            self.trial_in_flight = False
+
+    def release_trial(self):
+        # The call ended without telling us anything about the upstream; let the next one be the trial
+        with self._lock:
+            self.trial_in_flight = False
+
+
+_breakers = {name: CircuitBreaker(cfg.failure_threshold, cfg.reset_timeout) for name, cfg in INTEGRATIONS.items()}
+_session = None
+_session_pid = None
+_session_lock = threading.Lock()
+
+
+def get_session():
+    # Created lazily and re-created after fork so gunicorn workers never share sockets
+    global _session, _session_pid
+    with _session_lock:
+        if _session is None or _session_pid != os.getpid():
+            session = requests.Session()
+            adapter = HTTPAdapter(pool_connections=len(INTEGRATIONS), pool_maxsize=POOL_SIZE, max_retries=0)
+            session.mount("http://", adapter)
+            session.mount("https://", adapter)
+            _session, _session_pid = session, os.getpid()
+        return _session
+
+
+def _never_sent(error):
+    # Connect timeouts and refused/unresolvable connections fail before any bytes of the request are sent
+    reason = getattr(error.args[0], 'reason', None) if error.args else None
+    return isinstance(error, requests.ConnectTimeout) or isinstance(reason, NewConnectionError)
+
+
+def _backoff(attempt):
+    time.sleep(random.uniform(0, min(BACKOFF_CAP, BACKOFF_BASE * 2 ** attempt)))
+
+
+def _observe(integration, start, outcome):
+    # Time to response headers; a streamed body is read after this returns
+    metrics.observe("chatbot_outbound_seconds", time.perf_counter() - start, integration=integration, outcome=outcome)
+
+
+def request(integration, method, url, **kwargs):
+    breaker = _breakers[integration]
+    if not breaker.allow():
+        raise CircuitOpenError(f"{integration} circuit open; skipping call to upstream")
+    try:
+        return _request(integration, breaker, method, url, **kwargs)
+    except BaseException:
+        # Every upstream failure was recorded already; anything else must not leave a half-open trial hanging
+        breaker.release_trial()
+        raise
+
+
+def _request(integration, breaker, method, url, **kwargs):
+    cfg = INTEGRATIONS[integration]
+    kwargs.setdefault("timeout", (cfg.connect_timeout, cfg.read_timeout))
+    idempotent = method.upper() in IDEMPOTENT
+    session = get_session()
+    for attempt in range(cfg.retries + 1):
+        last_attempt = attempt == cfg.retries
+        start = time.perf_counter()
+        try:
+            response = session.request(method, url, **kwargs)
+        except requests.ConnectionError as e:
+            _observe(integration, start, "connection_error")
+            if last_attempt or not (idempotent or _never_sent(e)):
+                breaker.record_failure()
+                raise
+            logger.warning(f"{integration} connection error (attempt {attempt + 1}): {e}")
+        except requests.Timeout:
+            _observe(integration, start, "timeout")
+            if last_attempt or not idempotent:
+                breaker.record_failure()
+                raise
+            logger.warning(f"{integration} timed out (attempt {attempt + 1})")
+        except requests.RequestException:
+            # Invalid URL, too many redirects, decode errors: not transient, so not retried
+            _observe(integration, start, "error")
+            breaker.record_failure()
+            raise
+        else:
+            _observe(integration, start, str(response.status_code))
+            if response.status_code not in RETRY_STATUS:
+                breaker.record_success()
+                return response
+            if last_attempt or not idempotent:
+                breaker.record_failure()
+                return response
+            logger.warning(f"{integration} returned {response.status_code} (attempt {attempt + 1})")
+        _backoff(attempt)
+
+
+def get(integration, url, **kwargs):
+    return request(integration, "GET", url, **kwargs)
+
+
+def post(integration, url, **kwargs):
+    return request(integration, "POST", url, **kwargs)
+
+
+def stats():
+    return {name: {"state": breaker.state, "consecutive_failures": breaker.failures}
+            for name, breaker in _breakers.items()}
@@ -1,28 +1,90 @@
+"""Chart recorded latency from the metrics_history table (see metrics.py).
+
+    python plot_latency.py --hours 24
+    python plot_latency.py --metric chatbot_stage_seconds --output stages.png
+
+Plots p50/p95 per series (endpoint, stage, integration, ...) for each
+METRICS_HISTORY_SECONDS period. Percentiles are estimated from the histogram
+buckets, so they are only as fine as metrics.BUCKETS.
+"""
+import argparse
+import os
+import time
+from collections import defaultdict
+from datetime import datetime
+
 import matplotlib.pyplot as plt
 import pandas as pd
-from datetime import datetime, timedelta
-
-# Simulated data based on project context
-start_time = datetime(2025, 4, 15, 0, 0)
-times = [start_time + timedelta(hours=i) for i in range(24)]
-latencies = [
-    2.5, 2.7, 2.9, 3.0, 2.8, 2.6, 2.4, 2.2,  # Initial high latency (00:00-07:00)
-    2.0, 1.9, 1.8, 1.7, 1.6, 1.5, 1.6, 1.7,  # Optimization effect (08:00-15:00)
-    1.8, 2.0, 2.1, 2.3, 2.5, 2.8, 3.0, 2.6   # Spike and stabilization (16:00-23:00)
-]  # ms converted to seconds for readability
-
-# Create DataFrame
-df = pd.DataFrame({'timestamp': times, 'latency_ms': [l * 1000 for l in latencies]})  # Convert to ms
-
-# Plot
-plt.figure(figsize=(12, 6))
-plt.plot(df['timestamp'], df['latency_ms'], label='Latency (ms)', color='blue', marker='o')
-plt.xlabel('Time (2025-04-15)')
-plt.ylabel('Latency (ms)')
-plt.title('Latency of Basic Chatbot on Render Deployment')
-plt.legend()
-plt.grid(True)
-plt.xticks(rotation=45)
-plt.tight_layout()
-plt.savefig('latency_chart.png')
-plt.show()
\ No newline at end of file
+
+import db
+import metrics
+
+
+def percentile(buckets, count, pct):
+    """Upper bound (ms) of the bucket holding the pct-th sample, interpolated linearly within it."""
+    target = count * pct / 100
+    cumulative, lower = 0, 0.0
+    for upper, n in zip(metrics.BUCKETS + (metrics.BUCKETS[-1] * 2,), buckets):
+        if n and cumulative + n >= target:
+            return (lower + (upper - lower) * (target - cumulative) / n) * 1000
+        cumulative += n
+        lower = upper
+    return lower * 1000
+
+
+def load(metric, since):
+    index = {le: i for i, le in enumerate(metrics.BUCKET_LABELS)}
+    periods = defaultdict(lambda: {"buckets": [0] * len(index), "sum": 0.0, "count": 0})
+    for period, labels, le, value in db.read_metrics_history(metric, since):
+        entry = periods[(period, labels or "all")]
+        if le in index:
+            entry["buckets"][index[le]] = value
+        else:
+            entry[le] = value
+    rows = []
+    for (period, labels), entry in sorted(periods.items()):
+        if not entry["count"]:
+            continue
+        rows.append({"timestamp": datetime.fromtimestamp(period), "series": labels, "count": entry["count"],
+                     "mean_ms": entry["sum"] / entry["count"] * 1000,
+                     "p50_ms": percentile(entry["buckets"], entry["count"], 50),
+                     "p95_ms": percentile(entry["buckets"], entry["count"], 95)})
+    return pd.DataFrame(rows)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Plot recorded chatbot latency")
+    parser.add_argument("--metric", default="chatbot_request_seconds", choices=sorted(metrics.HELP))
+    parser.add_argument("--hours", type=float, default=24)
+    parser.add_argument("--db", default=db.DB_PATH)
+    parser.add_argument("--output", default="latency_chart.png")
+    parser.add_argument("--show", action="store_true")
+    args = parser.parse_args()
+
+    if not os.path.exists(args.db):
+        parser.error(f"{args.db} does not exist")
+    db.configure(args.db)
+    df = load(args.metric, int(time.time() - args.hours * 3600))
+    if df.empty:
+        parser.exit(1, f"No {args.metric} samples recorded in the last {args.hours:g} hours.\n")
+
+    plt.figure(figsize=(12, 6))
+    for series, group in df.groupby("series"):
+        line, = plt.plot(group["timestamp"], group["p95_ms"], marker='o', label=f"{series} p95")
+        plt.plot(group["timestamp"], group["p50_ms"], linestyle='--', color=line.get_color(), label=f"{series} p50")
+    plt.xlabel('Time')
+    plt.ylabel('Latency (ms)')
+    plt.yscale('log')
+    plt.title(f"{args.metric} ({df['count'].sum():.0f} samples)")
+    plt.legend(fontsize='small')
+    plt.grid(True)
+    plt.xticks(rotation=45)
+    plt.tight_layout()
+    plt.savefig(args.output)
+    print(f"Wrote {args.output}")
+    if args.show:
+        plt.show()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,147 @@
+"""Opt-in capture of chat requests to a rotated JSONL log.
+
+With REQUEST_LOG=1 every request to /get_response_route, /get_response_stream
+and /get_response_batch becomes one JSON line: the endpoint, the message (the
+list of messages for a batch), the intent that answered it, total latency, cache outcomes, per-stage and
+per-upstream timings (collected with metrics.trace()) and the reply size.
+`python benchmark.py replay` drives the app from such a log against stubbed
+upstreams, so any performance change can be measured on the same traffic.
+
+Lines are queued and written by a background thread; when the queue is full a
+record is dropped rather than delaying the reply. Each gunicorn worker writes
+its own file ({pid} in REQUEST_LOG_PATH), rotated at REQUEST_LOG_MAX_BYTES
+with REQUEST_LOG_BACKUPS older files kept as <path>.1, <path>.2, ...
+User ids are stored as a short hash, never in clear.
+"""
+import os
+import glob
+import json
+import queue
+import hashlib
+import threading
+import time
+import logging
+
+logger = logging.getLogger(__name__)
+
+ENABLED = os.getenv("REQUEST_LOG", "0") == "1"
+PATH = os.getenv("REQUEST_LOG_PATH", os.path.join("logs", "requests-{pid}.jsonl"))
+MAX_BYTES = int(os.getenv("REQUEST_LOG_MAX_BYTES", str(50 * 1024 * 1024)))
+BACKUPS = int(os.getenv("REQUEST_LOG_BACKUPS", "5"))
+MAX_DEPTH = int(os.getenv("REQUEST_LOG_MAX_DEPTH", "10000"))
+
+_STOP = object()
+
+
+def user_hash(user_id):
+    return hashlib.sha1(str(user_id).encode()).hexdigest()[:12] if user_id else None
+
+
+def build_record(message, user_id, status, seconds, samples, response_bytes=0, no_cache=False,
+                 endpoint="get_response_route"):
+    """One log line from a finished request and the metrics.trace() samples it produced."""
+    record = {"ts": round(time.time(), 3), "endpoint": endpoint, "user": user_hash(user_id), "message": message,
+              "no_cache": no_cache, "status": status, "latency_ms": round(seconds * 1000, 3), "response_bytes": response_bytes,
+              "intent": None, "admission": None, "cache": {}, "stages": {}, "upstream": [], "db_ms": 0.0}
+    for name, labels, duration in samples:
+        ms = round(duration * 1000, 3) if duration is not None else None
+        if name == "chatbot_intent_seconds":
+            record["intent"] = labels["intent"]
+        elif name == "chatbot_stage_seconds":
+            record["stages"][labels["stage"]] = round(record["stages"].get(labels["stage"], 0) + ms, 3)
+        elif name == "chatbot_outbound_seconds":
+            record["upstream"].append({"integration": labels["integration"], "outcome": str(labels["outcome"]), "ms": ms})
+        elif name == "chatbot_admission_seconds":
+            record["admission"] = labels["outcome"]
+        elif name == "chatbot_db_seconds":
+            record["db_ms"] = round(record["db_ms"] + ms, 3)
+        elif name == "cache":
+            # The first outcome is the lookup (hit/miss); later ones are fetches and coalescing
+            record["cache"].setdefault(labels["namespace"], labels["outcome"])
+    return record
+
+
+class RequestLog:
+    def __init__(self, path=PATH, max_bytes=MAX_BYTES, backups=BACKUPS, max_depth=MAX_DEPTH):
+        self.path = path.format(pid=os.getpid())
+        self.max_bytes = max_bytes
+        self.backups = backups
+        self.written = 0
+        self.dropped = 0
+        self._queue = queue.Queue(maxsize=max_depth)
+        self._file = None
+        self._thread = threading.Thread(target=self._run, name="request-log", daemon=True)
+
+    def start(self):
+        directory = os.path.dirname(self.path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self._thread.start()
+        return self
+
+    def write(self, record):
+        try:
+            self._queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+    def close(self):
+        if self._thread.is_alive():
+            self._queue.put(_STOP)
+            self._thread.join()
+
+    def _run(self):
+        self._file = open(self.path, 'a', encoding='utf-8')
+        try:
+            while True:
+                record = self._queue.get()
+                if record is _STOP:
+                    break
+                lines = [record]
+                # Drain whatever else is queued so a burst costs one flush
+                while len(lines) < 512:
+                    try:
+                        record = self._queue.get_nowait()
+                    except queue.Empty:
+                        break
+                    if record is _STOP:
+                        self._queue.put(_STOP)
+                        break
+                    lines.append(record)
+                try:
+                    self._file.write("".join(json.dumps(line, ensure_ascii=False) + "\n" for line in lines))
+                    self._file.flush()
+                    self.written += len(lines)
+                    if self._file.tell() >= self.max_bytes:
+                        self._rotate()
+                except OSError as e:
+                    logger.error(f"Request log write failed: {e}")
+        finally:
+            self._file.close()
+
+    def _rotate(self):
+        self._file.close()
+        for n in range(self.backups - 1, 0, -1):
+            if os.path.exists(f"{self.path}.{n}"):
+                os.replace(f"{self.path}.{n}", f"{self.path}.{n + 1}")
+        if self.backups:
+            os.replace(self.path, f"{self.path}.1")
+        else:
+            os.remove(self.path)
+        self._file = open(self.path, 'a', encoding='utf-8')
+
+
+def read(patterns):
+    """Records from the given files/globs (rotated backups included), oldest first."""
+    paths = sorted({path for pattern in patterns for path in glob.glob(pattern) + glob.glob(pattern + ".*")})
+    records = []
+    for path in paths:
+        with open(path, encoding='utf-8') as f:
+            for line in f:
+                try:
+                    records.append(json.loads(line))
+                except ValueError:
+                    # A worker killed mid-write leaves a truncated last line
+                    logger.warning(f"Skipping malformed line in {path}")
+    records.sort(key=lambda record: record.get("ts", 0))
+    return records
@@ -0,0 +1,140 @@
+"""TTL cache with single-flight coalescing for upstream lookups (weather, news).
+
+Entries are kept in an in-process LRU. With RESPONSE_CACHE_SHARED=1 they are
+also written to the response_cache table in chat_history.db so every gunicorn
+worker shares them. A fresh entry is returned as is. A stale entry (past ttl
+but within stale_ttl) is returned immediately while one background refresh
+runs. A miss is fetched once, and concurrent callers asking for the same key
+wait for that single fetch instead of hitting the upstream themselves.
+
+fetch callables raise to signal a result that must not be cached; the
+exception is re-raised to every coalesced caller.
+"""
+import os
+import threading
+import time
+import logging
+from collections import OrderedDict
+
+import db
+import metrics
+
+logger = logging.getLogger(__name__)
+
+SHARED = os.getenv("RESPONSE_CACHE_SHARED", "0") == "1"
+
+
+class _Call:
+    def __init__(self):
+        self.event = threading.Event()
+        self.value = None
+        self.error = None
+
+
+class TTLCache:
+    def __init__(self, namespace, ttl, stale_ttl=None, max_entries=1024, shared=SHARED):
+        self.namespace = namespace
+        self.ttl = ttl
+        self.stale_ttl = ttl if stale_ttl is None else stale_ttl
+        self.max_entries = max_entries
+        self.shared = shared
+        self._entries = OrderedDict()
+        self._inflight = {}
+        self._lock = threading.Lock()
+        self._stats = {"hits": 0, "stale_hits": 0, "misses": 0, "coalesced": 0, "fetches": 0, "fetch_errors": 0}
+
+    @staticmethod
+    def normalize(key):
+        return " ".join(key.lower().split())
+
+    def get_or_fetch(self, key, fetch):
+        key = self.normalize(key)
+        entry = self._lookup(key)
+        now = time.time()
+        if entry:
+            value, fetched_at = entry
+            age = now - fetched_at
+            if age < self.ttl:
+                self._count("hits")
+                return value
+            if age < self.ttl + self.stale_ttl:
+                self._count("stale_hits")
+                self._revalidate(key, fetch)
+                return value
+        self._count("misses")
+        return self._fetch(key, fetch)
+
+    def _lookup(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry:
+                self._entries.move_to_end(key)
+                return entry
+        if self.shared:
+            entry = db.cache_get(self.namespace, key)
+            if entry:
+                self._store_local(key, entry)
+            return entry
+        return None
+
+    def _store_local(self, key, entry):
+        with self._lock:
+            self._entries[key] = entry
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def _fetch(self, key, fetch):
+        with self._lock:
+            call = self._inflight.get(key)
+            leader = call is None
+            if leader:
+                call = self._inflight[key] = _Call()
+        if not leader:
+            self._count("coalesced")
+            call.event.wait()
+            if call.error:
+                raise call.error
+            return call.value
+        try:
+            self._count("fetches")
+            call.value = fetch()
+            entry = (call.value, time.time())
+            self._store_local(key, entry)
+            if self.shared:
+                db.cache_put(self.namespace, key, *entry)
+            return call.value
+        except Exception as e:
+            self._count("fetch_errors")
+            call.error = e
+            raise
+        finally:
+            with self._lock:
+                del self._inflight[key]
+            call.event.set()
+
+    def _revalidate(self, key, fetch):
+        with self._lock:
+            if key in self._inflight:
+                return
+
+        def refresh():
+            try:
+                self._fetch(key, fetch)
+            except Exception as e:
+                logger.error(f"Background refresh of {self.namespace}:{key} failed: {e}")
+
+        threading.Thread(target=refresh, daemon=True).start()
+
+    def _count(self, name):
+        with self._lock:
+            self._stats[name] += 1
+        metrics.mark("cache", namespace=self.namespace, outcome=name)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self):
+        with self._lock:
+            return {**self._stats, "entries": len(self._entries)}
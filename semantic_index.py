@@ -0,0 +1,189 @@
+"""Similarity search over knowledge-base entries for paraphrased questions.
+
+Texts are turned into hashed word + character-trigram counts (crc32, so every
+worker maps a feature to the same column), weighted by TF-IDF and
+L2-normalized into a SciPy sparse matrix stored feature-major (an inverted
+index), so a lookup is one sparse vector-matrix product that only touches the
+postings of the query's features, followed by an argpartition top-k;
+search_many scores a whole batch of queries with a single matrix product.
+
+New entries are weighted with the current IDF and kept in a small delta
+matrix; once it grows past REBUILD_THRESHOLD (or 1/16 of all rows), IDF is
+recomputed and everything is folded into the main matrix. NumPy and SciPy are
+imported on the first add(), so worker startup does not pay for them.
+
+Similar spelling is not the same question: "capital of spain" scores well
+against "capital of france". With match_words=True a hit must also pass a
+content-word check (stopwords and question filler ignored, one-letter typos
+in longer words forgiven): every content word of the query appears in the
+entry's text, or every content word of the key appears in the query. A
+question that swaps one of the key's words for a word the entry never
+mentions is therefore not a match.
+"""
+import os
+import re
+import threading
+import zlib
+from array import array
+from functools import lru_cache
+
+N_FEATURES = 2 ** 18
+MIN_SCORE = float(os.getenv("SEMANTIC_MIN_SCORE", "0.45"))
+REBUILD_THRESHOLD = 256
+STOPWORDS = frozenset("""
+a an the is are was were be been am do does did has have had of to in on at for from by with about as into and
+or but if than then so not what which who whom whose when where why how that this these those it its i me my
+we our you your he she they them their there here can could would should will may might must s
+please tell know explain wonder
+""".split())
+
+np = None
+sparse = None
+
+
+def _load():
+    global np, sparse
+    if sparse is None:
+        import numpy
+        import scipy.sparse
+        np, sparse = numpy, scipy.sparse
+
+
+def words(text):
+    return re.sub(r'[\W_]+', ' ', text.lower()).split()
+
+
+def content_words(text):
+    return [word for word in words(text) if word not in STOPWORDS]
+
+
+def _near(a, b):
+    # Equal, or one substitution, insertion, deletion or adjacent swap apart; short words must match exactly
+    if a == b:
+        return True
+    if min(len(a), len(b)) < 4 or abs(len(a) - len(b)) > 1:
+        return False
+    if len(a) == len(b):
+        diff = [i for i in range(len(a)) if a[i] != b[i]]
+        return len(diff) == 1 or (len(diff) == 2 and diff[1] == diff[0] + 1
+                                  and a[diff[0]] == b[diff[1]] and a[diff[1]] == b[diff[0]])
+    short, long = sorted((a, b), key=len)
+    i = next((i for i in range(len(short)) if short[i] != long[i]), len(short))
+    return short[i:] == long[i + 1:]
+
+
+def _covered(wanted, vocabulary):
+    return all(word in vocabulary or any(_near(word, known) for known in vocabulary) for word in wanted)
+
+
+@lru_cache(maxsize=1 << 16)
+def _word_columns(word):
+    # The word itself plus its character trigrams, padded so prefixes/suffixes count
+    padded = f" {word} "
+    features = ["w:" + word] + [padded[i:i + 3] for i in range(len(padded) - 2)]
+    return tuple(zlib.crc32(feature.encode()) % N_FEATURES for feature in features)
+
+
+def _vectorize(texts):
+    # array('i') hands NumPy a buffer instead of millions of Python ints
+    cols, lengths = array('i'), []
+    for text in texts:
+        start = len(cols)
+        for word in words(text):
+            cols.extend(_word_columns(word))
+        lengths.append(len(cols) - start)
+    cols = np.frombuffer(cols, dtype=np.int32)
+    rows = np.repeat(np.arange(len(texts), dtype=np.int32), lengths)
+    counts = sparse.csr_matrix((np.ones(len(cols), dtype=np.float32), (rows, cols)),
+                               shape=(len(texts), N_FEATURES))
+    counts.sum_duplicates()
+    return counts
+
+
+def _weigh(counts, idf):
+    weighted = counts.multiply(idf).tocsr()
+    norms = np.sqrt(weighted.multiply(weighted).sum(axis=1)).A1
+    norms[norms == 0] = 1.0
+    return sparse.diags(1.0 / norms) @ weighted
+
+
+def _postings(counts, idf):
+    return _weigh(counts, idf).T.tocsr()
+
+
+class SemanticIndex:
+    def __init__(self, min_score=MIN_SCORE, match_words=False):
+        self.min_score = min_score
+        self.match_words = match_words
+        self.keys = []
+        # key -> (content words of the key, content words of all its texts); replaced, never mutated
+        self._words = {}
+        self._counts = None
+        self._pending = []
+        self._idf = None
+        # (postings, delta postings, idf) swapped as a unit so searches never take the lock
+        self._state = (None, None, None)
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.keys)
+
+    def add(self, keys, texts):
+        if not keys:
+            return
+        _load()
+        counts = _vectorize(texts)
+        with self._lock:
+            self.keys.extend(keys)
+            if self.match_words:
+                for key, text in zip(keys, texts):
+                    key_words, text_words = self._words.get(key, (frozenset(content_words(key)), frozenset()))
+                    self._words[key] = (key_words, text_words | key_words | frozenset(content_words(text)))
+            self._pending.append(counts)
+            pending_rows = sum(block.shape[0] for block in self._pending)
+            if self._counts is None or pending_rows > max(REBUILD_THRESHOLD, len(self.keys) // 16):
+                self._compact()
+            else:
+                delta = _postings(sparse.vstack(self._pending, format='csr'), self._idf)
+                self._state = (self._state[0], delta, self._idf)
+
+    def _compact(self):
+        blocks = ([self._counts] if self._counts is not None else []) + self._pending
+        self._counts = sparse.vstack(blocks, format='csr')
+        self._pending = []
+        df = np.bincount(self._counts.indices, minlength=N_FEATURES)
+        self._idf = (np.log((1 + self._counts.shape[0]) / (1 + df)) + 1).astype(np.float32)
+        self._state = (_postings(self._counts, self._idf), None, self._idf)
+
+    def search(self, text, k=1):
+        return self.search_many([text], k)[0]
+
+    def search_many(self, texts, k=1):
+        """Top-k distinct keys per text as [(key, score), ...], best first, scores above min_score only."""
+        postings, delta, idf = self._state
+        if postings is None:
+            return [[] for _ in texts]
+        queries = _weigh(_vectorize(texts), idf)
+        scores = (queries @ postings).toarray()
+        if delta is not None:
+            scores = np.hstack([scores, (queries @ delta).toarray()])
+        # Several rows can share a key (one per learned answer), so over-fetch before de-duplicating
+        fetch = min(scores.shape[1], k * 4)
+        results = []
+        for text, row_scores in zip(texts, scores):
+            query_words = set(content_words(text)) if self.match_words else None
+            top = np.argpartition(-row_scores, fetch - 1)[:fetch]
+            hits = []
+            for row in top[np.argsort(-row_scores[top])]:
+                score = float(row_scores[row])
+                if score < self.min_score or len(hits) == k:
+                    break
+                key = self.keys[row]
+                if all(key != seen for seen, _ in hits) and (query_words is None or self._matches(key, query_words)):
+                    hits.append((key, score))
+            results.append(hits)
+        return results
+
+    def _matches(self, key, query_words):
+        key_words, text_words = self._words[key]
+        return _covered(query_words, text_words) or _covered(key_words, query_words)
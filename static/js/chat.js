@@ -0,0 +1,308 @@
+// Chat page behaviour. Page state (username, chatIds, cursors, urls) is set by the inline script in index.html.
+let loadingOlder = false;
+
+// Toggle sidebar functionality
+function toggleNav() {
+    const sidebar = document.getElementById("sidebar");
+    const chatContainer = document.querySelector(".chat-container");
+    if (sidebar && chatContainer) {
+        if (sidebar.style.width === "250px") {
+            closeNav();
+        } else {
+            sidebar.style.width = "250px";
+            chatContainer.style.marginLeft = "250px";
+        }
+    }
+}
+
+function closeNav() {
+    const sidebar = document.getElementById("sidebar");
+    const chatContainer = document.querySelector(".chat-container");
+    if (sidebar && chatContainer) {
+        sidebar.style.width = "0";
+        chatContainer.style.marginLeft = "0";
+    }
+}
+
+// Dropdown functionality
+function toggleDropdown() {
+    const dropdown = document.getElementById("dropdown-content");
+    if (dropdown) {
+        dropdown.style.display = dropdown.style.display === "block" ? "none" : "block";
+    }
+}
+
+// Close dropdown when clicking outside
+document.addEventListener("click", function(event) {
+    const dropdown = document.getElementById("dropdown-content");
+    const profileIcon = document.querySelector(".profile-icon");
+    if (dropdown && profileIcon && !profileIcon.contains(event.target) && !dropdown.contains(event.target)) {
+        dropdown.style.display = "none";
+    }
+});
+
+// Perform logout
+function logout() {
+    fetch(urls.logout, {
+        method: 'POST',
+        headers: { 'Content-Type': 'application/x-www-form-urlencoded' },
+    })
+    .then(response => {
+        if (response.ok) {
+            window.location.href = urls.login;
+        } else {
+            alert('Logout failed. Please try again.');
+        }
+    })
+    .catch(error => console.error('Error during logout:', error));
+}
+
+function renderMessage(msg) {
+    const messageDiv = document.createElement("div");
+    messageDiv.className = `message ${msg.isUser ? 'user-message' : 'bot-message'}`;
+    messageDiv.dataset.id = msg.id;
+    messageDiv.innerHTML = msg.message.replace(/\n/g, '<br>');
+    return messageDiv;
+}
+
+function historyUrl(chatId, params) {
+    return `${urls.history}?chatId=${encodeURIComponent(chatId)}&${new URLSearchParams(params)}`;
+}
+
+// Load the newest page of a chat; older pages are fetched by loadOlder() on scroll
+function loadChat(chatId) {
+    fetch(historyUrl(chatId, {}))
+        .then(response => response.json())
+        .then(data => {
+            const chatBox = document.getElementById("chat-box");
+            chatBox.innerHTML = "";
+            data.history.forEach(msg => chatBox.appendChild(renderMessage(msg)));
+            oldestId = data.history.length ? data.history[0].id : null;
+            newestId = data.history.length ? data.history[data.history.length - 1].id : null;
+            hasMore = data.hasMore;
+            chatBox.scrollTop = chatBox.scrollHeight;
+            sessionStorage.setItem('currentChatId', chatId);
+        })
+        .catch(error => console.error('Error loading chat:', error));
+}
+
+function loadOlder() {
+    const chatId = sessionStorage.getItem('currentChatId') || currentChatId;
+    if (loadingOlder || !hasMore || oldestId === null) return;
+    loadingOlder = true;
+    fetch(historyUrl(chatId, { before: oldestId }))
+        .then(response => response.json())
+        .then(data => {
+            const chatBox = document.getElementById("chat-box");
+            // Keep the message the user was looking at in place while prepending above it
+            const distanceFromBottom = chatBox.scrollHeight - chatBox.scrollTop;
+            const fragment = document.createDocumentFragment();
+            data.history.forEach(msg => fragment.appendChild(renderMessage(msg)));
+            chatBox.insertBefore(fragment, chatBox.firstChild);
+            chatBox.scrollTop = chatBox.scrollHeight - distanceFromBottom;
+            if (data.history.length) oldestId = data.history[0].id;
+            hasMore = data.hasMore;
+        })
+        .catch(error => console.error('Error loading older messages:', error))
+        .finally(() => { loadingOlder = false; });
+}
+
+// Fetch only messages newer than the last one shown (e.g. sent from another tab) and
+// replace the optimistic copies of our own sends with the stored ones
+async function syncNewMessages() {
+    const chatId = sessionStorage.getItem('currentChatId') || currentChatId;
+    if (!chatId) return;
+    const chatBox = document.getElementById("chat-box");
+    let more = true;
+    while (more) {
+        const response = await fetch(historyUrl(chatId, newestId === null ? {} : { since: newestId }));
+        const data = await response.json();
+        if (!data.history || !data.history.length) return;
+        chatBox.querySelectorAll('.pending').forEach(el => el.remove());
+        data.history.forEach(msg => chatBox.appendChild(renderMessage(msg)));
+        if (oldestId === null) oldestId = data.history[0].id;
+        newestId = data.history[data.history.length - 1].id;
+        more = newestId !== null && data.hasMore;
+    }
+    chatBox.scrollTop = chatBox.scrollHeight;
+}
+
+function renderSidebar(ids) {
+    const sidebar = document.getElementById('sidebar');
+    const chatLinks = sidebar.getElementsByTagName('a');
+    // Remove existing chat links except closebtn and New Chat
+    while (chatLinks.length > 2) {
+        sidebar.removeChild(chatLinks[1]);
+    }
+    ids.forEach(cid => {
+        const newChatLink = document.createElement('a');
+        newChatLink.href = '#';
+        newChatLink.setAttribute('data-chat-id', cid);
+        newChatLink.onclick = () => loadChat(cid);
+        newChatLink.textContent = cid.length > 20 ? cid.substring(0, 20) + '...' : cid;
+        sidebar.insertBefore(newChatLink, sidebar.lastElementChild);
+
+        const deleteLink = document.createElement('a');
+        deleteLink.href = '#';
+        deleteLink.onclick = () => deleteChat(cid);
+        deleteLink.textContent = 'Delete';
+        deleteLink.style.color = '#ff4444';
+        sidebar.insertBefore(deleteLink, sidebar.lastElementChild);
+    });
+}
+
+// The browser revalidates with If-None-Match; an unchanged list comes back as 304
+function refreshChatIds() {
+    fetch(urls.chatIds)
+        .then(response => response.json())
+        .then(data => {
+            if (data.chatIds && JSON.stringify(data.chatIds) !== JSON.stringify(chatIds)) {
+                chatIds = data.chatIds;
+                renderSidebar(chatIds);
+            }
+        })
+        .catch(error => console.error('Error refreshing chats:', error));
+}
+
+// Delete chat with dynamic update
+async function deleteChat(chatId) {
+    if (confirm(`Are you sure you want to delete chat ${chatId}? This action cannot be undone.`)) {
+        try {
+            const response = await fetch(urls.deleteChat, {
+                method: 'POST',
+                headers: {
+                    'Content-Type': 'application/x-www-form-urlencoded',
+                    'X-CSRF-Token': csrfToken // Add CSRF token if needed
+                },
+                body: `chatId=${encodeURIComponent(chatId)}`
+            });
+            const data = await response.json();
+            if (data.status === "OK") {
+                alert('Chat deleted successfully!');
+                // Update chatIds with the new list from the server and rebuild the sidebar
+                chatIds = data.updatedChatIds.filter(cid => cid !== chatId);
+                renderSidebar(chatIds);
+                // Handle current chat deletion
+                if (chatId === sessionStorage.getItem('currentChatId')) {
+                    document.getElementById('chat-box').innerHTML = '<div class="message bot-message">Chat deleted. Start a new chat.</div>';
+                    sessionStorage.removeItem('currentChatId');
+                    if (chatIds.length > 0) {
+                        loadChat(chatIds[0]); // Switch to first available chat
+                    }
+                }
+            } else {
+                alert(`Failed to delete chat: ${data.message || 'Unknown error'}`);
+            }
+        } catch (error) {
+            console.error('Error during chat deletion:', error);
+            alert('An error occurred while deleting the chat. Check the console for details.');
+        }
+    }
+}
+
+// Start new chat
+function startNewChat() {
+    const newChatId = `chat_${username || 'guest'}_${new Date().toISOString().replace(/[:.-]/g, '_')}`;
+    fetch(urls.response, {
+        method: 'POST',
+        headers: { 'Content-Type': 'application/x-www-form-urlencoded' },
+        body: `message=new chat&chatId=${encodeURIComponent(newChatId)}`
+    })
+    .then(response => {
+        if (!response.ok) throw new Error('Network response was not ok');
+        return response.text();
+    })
+    .then(response => {
+        const chatBox = document.getElementById("chat-box");
+        if (chatBox) {
+            chatBox.innerHTML = '';
+            oldestId = newestId = null;
+            hasMore = false;
+            const botMsg = document.createElement("div");
+            botMsg.className = "message bot-message pending";
+            botMsg.innerHTML = response.replace(/\n/g, '<br>');
+            chatBox.appendChild(botMsg);
+            chatBox.scrollTop = chatBox.scrollHeight;
+            // Update the sidebar with the new chat
+            const sidebar = document.getElementById('sidebar');
+            if (sidebar) {
+                const newChatLink = document.createElement('a');
+                newChatLink.href = '#';
+                newChatLink.setAttribute('data-chat-id', newChatId);
+                newChatLink.onclick = () => loadChat(newChatId);
+                newChatLink.textContent = newChatId.length > 20 ? newChatId.substring(0, 20) + '...' : newChatId;
+                sidebar.insertBefore(newChatLink, sidebar.lastElementChild);
+
+                const deleteLink = document.createElement('a');
+                deleteLink.href = '#';
+                deleteLink.onclick = () => deleteChat(newChatId);
+                deleteLink.textContent = 'Delete';
+                deleteLink.style.color = '#ff4444';
+                sidebar.insertBefore(deleteLink, sidebar.lastElementChild);
+            }
+            chatIds.push(newChatId); // Update local chatIds
+            sessionStorage.setItem('currentChatId', newChatId);
+        }
+    })
+    .catch(error => console.error('Error starting new chat:', error));
+}
+
+// Form submission
+document.getElementById("chat-form").addEventListener("submit", function(e) {
+    e.preventDefault();
+    const messageInput = document.getElementById("message-input");
+    const message = messageInput.value.trim();
+    if (message) {
+        const currentChat = sessionStorage.getItem('currentChatId') || currentChatId;
+        const chatBox = document.getElementById("chat-box");
+        // "pending" until syncNewMessages() swaps in the stored copies
+        const userMsg = document.createElement("div");
+        userMsg.className = "message user-message pending";
+        userMsg.innerHTML = message.replace(/\n/g, '<br>');
+        chatBox.appendChild(userMsg);
+        const botMsg = document.createElement("div");
+        botMsg.className = "message bot-message pending";
+        chatBox.appendChild(botMsg);
+        messageInput.value = "";
+        // Streamed reply: render each chunk as it arrives instead of waiting for the whole answer
+        fetch(urls.stream, {
+            method: 'POST',
+            headers: { 'Content-Type': 'application/x-www-form-urlencoded' },
+            body: `message=${encodeURIComponent(message)}&chatId=${encodeURIComponent(currentChat)}`
+        })
+        .then(async response => {
+            const reader = response.body.getReader();
+            const decoder = new TextDecoder();
+            let text = "";
+            while (true) {
+                const { done, value } = await reader.read();
+                if (done) break;
+                text += decoder.decode(value, { stream: true });
+                botMsg.innerHTML = text.replace(/\n/g, '<br>');
+                chatBox.scrollTop = chatBox.scrollHeight;
+            }
+        })
+        .catch(error => console.error('Error sending message:', error));
+    }
+});
+
+// Initialize with current chat (its newest page is already rendered server-side)
+if (currentChatId && loggedIn) {
+    const chatBox = document.getElementById("chat-box");
+    chatBox.scrollTop = chatBox.scrollHeight;
+    chatBox.addEventListener("scroll", () => {
+        if (chatBox.scrollTop < 40) loadOlder();
+    });
+    document.addEventListener("visibilitychange", () => {
+        if (!document.hidden) {
+            syncNewMessages().catch(error => console.error('Error syncing messages:', error));
+            refreshChatIds();
+        }
+    });
+    sessionStorage.setItem('currentChatId', currentChatId);
+}
+
+// Optionally disable OpenAI features if unavailable
+if (!openaiAvailable) {
+    console.log("OpenAI is not available. Some features may be disabled.");
+}
@@ -0,0 +1,153 @@
+"""Local stand-in for the chatbot's upstream services, for benchmarks and manual testing.
+
+Serves weatherapi.com-, newsapi.org-, Zapier- and OpenAI-shaped responses on
+127.0.0.1 with configurable latency and failure rate, and counts hits per
+path so callers can check how many requests actually reached "upstream".
+
+    with StubUpstream(latency=0.2) as stub:
+        os.environ["WEATHER_API_URL"] = stub.url + "/v1/current.json"
+"""
+import json
+import random
+import threading
+import time
+from collections import Counter
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse, parse_qs
+
+
+class _Handler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    # Headers and body go out in separate writes; without this, keep-alive clients hit 40ms delayed ACKs
+    disable_nagle_algorithm = True
+
+    def log_message(self, format, *args):
+        pass
+
+    def _reply(self, status, payload):
+        body = json.dumps(payload).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _handle(self):
+        stub = self.server.stub
+        parsed = urlparse(self.path)
+        query = {k: v[0] for k, v in parse_qs(parsed.query).items()}
+        length = int(self.headers.get("Content-Length") or 0)
+        body = self.rfile.read(length) if length else b""
+        stub.record(parsed.path)
+        if stub.latency:
+            time.sleep(stub.latency)
+        if stub.failure_rate and stub.rng.random() < stub.failure_rate:
+            return self._reply(503, {"error": "injected failure"})
+        if parsed.path == "/v1/chat/completions" and json.loads(body or b"{}").get("stream"):
+            return self._stream_completion(stub, body)
+        route = stub.routes.get(parsed.path)
+        if route is None:
+            return self._reply(404, {"error": "not found"})
+        status, payload = route(query, body)
+        self._reply(status, payload)
+
+    def _stream_completion(self, stub, body):
+        # Server-sent events over chunked encoding, one token per event, like the real API
+        self.send_response(200)
+        self.send_header("Content-Type", "text/event-stream")
+        self.send_header("Transfer-Encoding", "chunked")
+        self.end_headers()
+        for token in stub.completion_tokens(body):
+            if stub.token_delay:
+                time.sleep(stub.token_delay)
+            event = {"choices": [{"index": 0, "delta": {"content": token}}]}
+            self._write_chunk(f"data: {json.dumps(event)}\n\n".encode())
+        self._write_chunk(b"data: [DONE]\n\n")
+        self.wfile.write(b"0\r\n\r\n")
+
+    def _write_chunk(self, data):
+        self.wfile.write(f"{len(data):x}\r\n".encode() + data + b"\r\n")
+        self.wfile.flush()
+
+    do_GET = _handle
+    do_POST = _handle
+
+
+def _weather(query, body):
+    return 200, {"location": {"name": query.get("q", "")},
+                 "current": {"temp_c": 18.0, "condition": {"text": "Partly cloudy"}}}
+
+
+def _news(query, body):
+    topic = query.get("q", "")
+    return 200, {"status": "ok", "articles": [
+        {"title": f"Stub headline about {topic}", "source": {"name": "Stub News"}, "url": "http://example.com/news"}]}
+
+
+def _webhook(query, body):
+    return 200, {"status": "success"}
+
+
+def _completion(stub):
+    def route(query, body):
+        if stub.token_delay:
+            time.sleep(stub.token_delay * len(stub.completion_tokens(body)))
+        return 200, {"choices": [{"index": 0, "message": {"role": "assistant", "content": stub.completion_for(body)}}]}
+    return route
+
+
+class StubUpstream:
+    def __init__(self, latency=0.0, failure_rate=0.0, port=0, seed=0, token_delay=0.0,
+                 completion="This is a streamed answer from the stub language model.", echo=False):
+        self.latency = latency
+        self.token_delay = token_delay
+        self.completion = completion
+        # echo=True answers "Answer to: <prompt>", so callers can tell which question an answer came from
+        self.echo = echo
+        self.failure_rate = failure_rate
+        self.rng = random.Random(seed)
+        self.hits = Counter()
+        self.routes = {
+            "/v1/current.json": _weather,
+            "/v2/everything": _news,
+            "/hooks/catch": _webhook,
+            "/v1/chat/completions": _completion(self),
+        }
+        self._lock = threading.Lock()
+        self._server = ThreadingHTTPServer(("127.0.0.1", port), _Handler)
+        self._server.daemon_threads = True
+        self._server.stub = self
+        self._thread = None
+
+    @property
+    def url(self):
+        host, port = self._server.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def completion_for(self, body=b""):
+        if not self.echo:
+            return self.completion
+        return "Answer to: " + json.loads(body)["messages"][-1]["content"]
+
+    def completion_tokens(self, body=b""):
+        words = self.completion_for(body).split(" ")
+        return [words[0]] + [" " + word for word in words[1:]]
+
+    def record(self, path):
+        with self._lock:
+            self.hits[path] += 1
+
+    def start(self):
+        self._thread = threading.Thread(target=self._server.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.stop()
@@ -0,0 +1,113 @@
+"""Durable outbox for Zapier task deliveries.
+
+The schedule intent only inserts a row into task_outbox and replies
+immediately; a background TaskDispatcher claims due rows in batches, POSTs
+them to the webhook over the shared outbound session, and records the result.
+Failed deliveries are retried with exponential backoff up to MAX_ATTEMPTS, and
+rows claimed by a worker that died are picked up again once their lease
+expires. Users can see delivery state through /tasks.
+"""
+import os
+import json
+import threading
+import time
+import logging
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+
+import requests
+
+import db
+import outbound
+
+logger = logging.getLogger(__name__)
+
+ENABLED = os.getenv("TASK_DISPATCHER", "1") == "1"
+BATCH_SIZE = int(os.getenv("TASK_BATCH_SIZE", "20"))
+POLL_INTERVAL = float(os.getenv("TASK_POLL_SECONDS", "2"))
+# Deliveries within a batch run concurrently over the shared keep-alive session
+CONCURRENCY = int(os.getenv("TASK_CONCURRENCY", "4"))
+LEASE_SECONDS = 60
+MAX_ATTEMPTS = 5
+RETRY_BASE_SECONDS = 5
+
+
+def _timestamp():
+    return datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+
+
+def enqueue(user_id, payload):
+    return db.enqueue_task(user_id, json.dumps(payload), time.time(), _timestamp())
+
+
+def list_tasks(user_id, limit=50):
+    tasks = db.list_tasks(user_id, limit)
+    for task in tasks:
+        task["payload"] = json.loads(task["payload"])
+    return tasks
+
+
+class TaskDispatcher:
+    def __init__(self, webhook_url, batch_size=BATCH_SIZE, poll_interval=POLL_INTERVAL):
+        self.webhook_url = webhook_url
+        self.batch_size = batch_size
+        self.poll_interval = poll_interval
+        self._wake = threading.Event()
+        self._stop = threading.Event()
+        self._pool = ThreadPoolExecutor(max_workers=CONCURRENCY, thread_name_prefix="task-delivery")
+        self._thread = threading.Thread(target=self._run, name="task-dispatcher", daemon=True)
+
+    def start(self):
+        self._thread.start()
+        return self
+
+    def notify(self):
+        """Wake the dispatcher now instead of waiting for the next poll (called after enqueue)."""
+        self._wake.set()
+
+    def close(self):
+        self._stop.set()
+        self._wake.set()
+        if self._thread.is_alive():
+            self._thread.join()
+        self._pool.shutdown()
+
+    def _run(self):
+        while not self._stop.is_set():
+            # Cleared before claiming, so a notify() that lands mid-batch triggers another pass
+            self._wake.clear()
+            try:
+                delivered = self.dispatch_once()
+            except Exception as e:
+                logger.error(f"Task dispatcher error: {e}")
+                delivered = 0
+            # A full batch means there may be more due work; otherwise sleep until poked or the next poll
+            if delivered < self.batch_size:
+                self._wake.wait(self.poll_interval)
+
+    def dispatch_once(self):
+        tasks = db.claim_tasks(self.batch_size, time.time(), LEASE_SECONDS, _timestamp())
+        if not tasks:
+            return 0
+        errors = self._pool.map(self._deliver, [payload for _, payload, _ in tasks])
+        results = []
+        for (task_id, _, attempts), error in zip(tasks, errors):
+            if error is None:
+                results.append((task_id, 'delivered', None, time.time()))
+            elif attempts >= MAX_ATTEMPTS:
+                logger.error(f"Task {task_id} failed permanently after {attempts} attempts: {error}")
+                results.append((task_id, 'failed', error, time.time()))
+            else:
+                results.append((task_id, 'queued', error, time.time() + RETRY_BASE_SECONDS * 2 ** (attempts - 1)))
+        db.finish_tasks(results, _timestamp())
+        return len(tasks)
+
+    def _deliver(self, payload):
+        try:
+            response = outbound.post("zapier", self.webhook_url, data=payload,
+                                     headers={"Content-Type": "application/json"})
+        except requests.RequestException as e:
+            return str(e)
+        if response.status_code == 200:
+            return None
+        return f"HTTP {response.status_code}"
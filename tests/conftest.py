@@ -0,0 +1,55 @@
+"""Shared fixtures: the repository root on sys.path, the stub upstream and the app wired to it."""
+import os
+import sys
+
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from stub_server import StubUpstream  # noqa: E402
+
+
+@pytest.fixture
+def stub():
+    with StubUpstream() as stub:
+        yield stub
+
+
+@pytest.fixture(scope="session")
+def app_stub():
+    # One for the whole session: app.py reads the upstream URLs when it is imported
+    with StubUpstream() as stub:
+        yield stub
+
+
+@pytest.fixture(scope="session")
+def chat_app(app_stub, tmp_path_factory):
+    """app.py against a scratch database and the stub upstream, imported once per session."""
+    tmp = tmp_path_factory.mktemp("app")
+    # Modules read their settings at import time, so the environment comes first
+    os.environ.update({
+        "CHAT_DB_PATH": str(tmp / "chat_history.db"), "LOG_FILE": os.devnull, "RATE_LIMIT": "0",
+        "MAINTENANCE": "0", "TASK_DISPATCHER": "0",
+        "OPENAI_API_KEY": "stub", "OPENAI_API_BASE": app_stub.url + "/v1",
+        "WEATHER_API_KEY": "stub", "WEATHER_API_URL": app_stub.url + "/v1/current.json",
+        "NEWSAPI_KEY": "stub", "NEWS_API_URL": app_stub.url + "/v2/everything",
+    })
+    import db
+    db.configure(os.environ["CHAT_DB_PATH"])
+    import app
+    app.init_db()
+    yield app
+    db.close_all()
+
+
+@pytest.fixture
+def client(chat_app):
+    """A test client logged in as a fresh user."""
+    client = chat_app.app.test_client()
+    username = f"user_{os.urandom(4).hex()}"
+    client.post("/register", data={"username": username, "password": "secret123", "name": "Test",
+                                   "email": f"{username}@example.com"})
+    response = client.post("/login", data={"username": username, "password": "secret123"})
+    assert response.status_code == 302
+    return client
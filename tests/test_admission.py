@@ -0,0 +1,76 @@
+import threading
+import time
+
+import pytest
+
+import admission
+from admission import Admission, Rejected
+
+
+@pytest.fixture
+def control(chat_app):
+    # Slots live in the session database; start every test with none taken
+    import db
+    db.prune_upstream_slots(time.time() + 1)
+    return Admission(concurrency=2, slot_wait=0.5)
+
+
+def test_large_batch_uses_its_own_bucket(control):
+    user = f"user_{time.time_ns()}"
+    ticket = control.admit(user, "batch", 500)
+    assert ticket._slot is None
+    # The user's interactive upstream bucket is untouched
+    control.admit(user, "upstream", 10).release()
+
+
+def test_batch_bucket_is_all_or_nothing(control):
+    user = f"user_{time.time_ns()}"
+    control.admit(user, "batch", 900)
+    with pytest.raises(Rejected) as e:
+        control.admit(user, "batch", 200)
+    assert e.value.status == 429
+
+
+def test_upstream_slot_bounds_concurrent_calls(control):
+    running, peak, lock = [0], [0], threading.Lock()
+
+    def call():
+        with control.upstream_slot():
+            with lock:
+                running[0] += 1
+                peak[0] = max(peak[0], running[0])
+            time.sleep(0.05)
+            with lock:
+                running[0] -= 1
+
+    threads = [threading.Thread(target=call) for _ in range(6)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join(5)
+    # Every call waited for a slot instead of being refused
+    assert running[0] == 0
+    assert peak[0] == 2
+    assert control.stats()["upstream_in_flight"] == 0
+
+
+def test_upstream_slot_gives_up_after_waiting(control):
+    with control.upstream_slot(), control.upstream_slot():
+        started = time.time()
+        with pytest.raises(Rejected) as e:
+            with control.upstream_slot():
+                pass
+    assert e.value.status == 503
+    assert time.time() - started >= control.slot_wait
+
+
+def test_batch_of_lookups_is_admitted_and_answered(chat_app, client, monkeypatch):
+    monkeypatch.setattr(chat_app, "admission_control", Admission(concurrency=2, slot_wait=5))
+    messages = [f"weather in city{n}" for n in range(30)]
+    with chat_app.app.test_request_context(json={"messages": messages}):
+        assert chat_app.request_cost() == ("batch", 30)
+    response = client.post("/get_response_batch", json={"messages": messages})
+    assert response.status_code == 200
+    responses = response.get_json()["responses"]
+    assert len(responses) == 30
+    assert not any(admission.BUSY in reply for reply in responses)
@@ -0,0 +1,177 @@
+import json
+import threading
+import time
+
+import pytest
+
+import answer_cache
+from answer_cache import AnswerCache
+
+
+class Clock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def time(self):
+        return self.now
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(answer_cache.time, "time", clock.time)
+    return clock
+
+
+def make_cache(**kwargs):
+    return AnswerCache(**{"ttl": 60, "max_entries": 16, "similarity": 0, "shared": False, "enabled": True, **kwargs})
+
+
+def test_concurrent_misses_make_one_call():
+    cache = make_cache()
+    calls = []
+    release = threading.Event()
+
+    def complete(message):
+        calls.append(message)
+        release.wait(5)
+        return "forty-two"
+
+    results = []
+    threads = [threading.Thread(target=lambda: results.append(cache.get_or_complete("The answer?", complete)))
+               for _ in range(8)]
+    for thread in threads:
+        thread.start()
+    # Let every follower reach the in-flight call before the leader finishes
+    deadline = time.time() + 5
+    while cache.stats()["coalesced"] < 7 and time.time() < deadline:
+        time.sleep(0.01)
+    release.set()
+    for thread in threads:
+        thread.join(5)
+    assert calls == ["The answer?"]
+    assert results == ["forty-two"] * 8
+    assert cache.stats()["coalesced"] == 7
+    assert cache.get("the answer") == "forty-two"
+
+
+def test_error_reaches_coalesced_callers_and_is_not_cached():
+    cache = make_cache()
+    started = threading.Event()
+    release = threading.Event()
+
+    def failing(message):
+        started.set()
+        release.wait(5)
+        raise RuntimeError("upstream down")
+
+    errors = []
+
+    def ask():
+        try:
+            cache.get_or_complete("hello", failing)
+        except RuntimeError as e:
+            errors.append(str(e))
+
+    leader = threading.Thread(target=ask)
+    leader.start()
+    started.wait(5)
+    follower = threading.Thread(target=ask)
+    follower.start()
+    deadline = time.time() + 5
+    while cache.stats()["coalesced"] < 1 and time.time() < deadline:
+        time.sleep(0.01)
+    release.set()
+    leader.join(5)
+    follower.join(5)
+    assert errors == ["upstream down", "upstream down"]
+    assert cache.get("hello") is None
+    # The failed call is not left in flight; the next caller completes afresh
+    assert cache.get_or_complete("hello", lambda message: "hi") == "hi"
+
+
+def test_entries_expire_after_ttl(clock):
+    cache = make_cache(ttl=60)
+    cache.put("what is a black hole", "a region of spacetime")
+    clock.now += 59
+    assert cache.get("What is a black hole?") == "a region of spacetime"
+    clock.now += 2
+    assert cache.get("what is a black hole") is None
+    calls = []
+    assert cache.get_or_complete("what is a black hole", lambda message: calls.append(message) or "fresh") == "fresh"
+    assert len(calls) == 1
+
+
+def test_bypass_skips_lookup_and_store():
+    cache = make_cache()
+    cache.put("ping", "pong")
+    assert cache.get_or_complete("ping", lambda message: "uncached", bypass=True) == "uncached"
+    assert cache.get("ping") == "pong"
+    cache.put("other", "answer", bypass=True)
+    assert cache.get("other") is None
+    assert cache.stats()["bypassed"] == 1
+
+
+def test_least_recently_used_entry_is_evicted():
+    cache = make_cache(max_entries=2)
+    cache.put("a", "1")
+    cache.put("b", "2")
+    assert cache.get("a") == "1"
+    cache.put("c", "3")
+    assert cache.get("b") is None
+    assert cache.get("a") == "1"
+    assert cache.get("c") == "3"
+    assert cache.stats()["evictions"] == 1
+
+
+def test_concurrent_fallbacks_reach_the_model_once(chat_app, app_stub, monkeypatch):
+    monkeypatch.setattr(chat_app, "openai_available", True)
+    chat_app.answer_cache.clear()
+    app_stub.failure_rate = 0.0
+    # Slow enough that every thread arrives while the first completion is in flight
+    monkeypatch.setattr(app_stub, "latency", 0.3)
+    before = app_stub.hits["/v1/chat/completions"]
+    results = []
+    threads = [threading.Thread(target=lambda: results.append(chat_app.answer_with_llm("explain entropy")))
+               for _ in range(6)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join(10)
+    assert len(results) == 6 and len(set(results)) == 1
+    assert app_stub.hits["/v1/chat/completions"] - before == 1
+
+
+def test_near_matching_is_off_by_default():
+    assert answer_cache.SIMILARITY == 0
+    cache = AnswerCache(shared=False, enabled=True)
+    cache.put("what is a black hole", "a region of spacetime")
+    assert cache.get("what's a black hole") is None
+
+
+def test_near_hit_reuses_a_rephrased_question():
+    cache = make_cache(similarity=0.75)
+    cache.put("what is a black hole?", "a region of spacetime")
+    assert cache.get("what's a black hole") == "a region of spacetime"
+    assert cache.stats()["near_hits"] == 1
+
+
+@pytest.mark.parametrize("cached, asked", [
+    ("explain the causes of world war one", "explain the causes of world war two"),
+    ("what is the capital city of australia", "what is the capital city of austria"),
+    ("convert a python list to a dictionary", "convert a python dictionary to a list"),
+])
+def test_near_hit_never_answers_a_different_question(cached, asked):
+    cache = make_cache(similarity=0.75)
+    cache.put(cached, "answer to the cached question")
+    assert cache.get(asked) is None
+    assert cache.stats()["near_hits"] == 0
+
+
+def test_stats_route_does_not_expose_questions(chat_app):
+    chat_app.answer_cache.put("my private question", "an answer")
+    assert chat_app.answer_cache.get("my private question") == "an answer"
+    stats = chat_app.app.test_client().get("/answer_cache_stats").get_json()
+    assert stats["entries"] >= 1
+    assert stats["top"] == []
+    assert "my private question" not in json.dumps(stats)
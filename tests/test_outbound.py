@@ -0,0 +1,138 @@
+import threading
+import time
+
+import pytest
+import requests
+
+import outbound
+from outbound import CircuitBreaker, CircuitOpenError, Integration
+
+
+@pytest.fixture(autouse=True)
+def fast_integrations(monkeypatch):
+    """Short timeouts, no backoff sleeps and fresh breakers for a "test" integration."""
+    monkeypatch.setattr(outbound, "_backoff", lambda attempt: None)
+    monkeypatch.setitem(outbound.INTEGRATIONS, "test", Integration(1.0, 2.0, 2, 3, 0.2))
+    monkeypatch.setitem(outbound._breakers, "test", CircuitBreaker(3, 0.2))
+    return outbound._breakers["test"]
+
+
+def url(stub):
+    return stub.url + "/v1/current.json?q=london"
+
+
+def trip(breaker):
+    breaker.failures = breaker.failure_threshold
+    breaker.opened_at = time.monotonic() - breaker.reset_timeout
+
+
+def test_success_resets_breaker(stub, fast_integrations):
+    fast_integrations.failures = 2
+    assert outbound.get("test", url(stub)).status_code == 200
+    assert fast_integrations.state == "closed"
+    assert fast_integrations.failures == 0
+
+
+def test_idempotent_call_is_retried_on_5xx(stub, fast_integrations):
+    stub.failure_rate = 1.0
+    response = outbound.get("test", url(stub))
+    assert response.status_code == 503
+    # retries=2: the first attempt and two more
+    assert stub.hits["/v1/current.json"] == 3
+    assert fast_integrations.failures == 1
+
+
+def test_post_is_not_retried_on_5xx(stub):
+    stub.failure_rate = 1.0
+    assert outbound.post("test", stub.url + "/hooks/catch", json={}).status_code == 503
+    assert stub.hits["/hooks/catch"] == 1
+
+
+def test_breaker_opens_after_threshold_and_fails_fast(stub, fast_integrations):
+    stub.failure_rate = 1.0
+    for _ in range(fast_integrations.failure_threshold):
+        outbound.get("test", url(stub))
+    assert fast_integrations.state == "open"
+    hits = stub.hits["/v1/current.json"]
+    with pytest.raises(CircuitOpenError):
+        outbound.get("test", url(stub))
+    assert stub.hits["/v1/current.json"] == hits
+
+
+def test_circuit_open_error_is_a_request_exception():
+    assert issubclass(CircuitOpenError, requests.RequestException)
+
+
+def test_half_open_allows_one_trial_at_a_time():
+    breaker = CircuitBreaker(3, 0.2)
+    trip(breaker)
+    assert breaker.state == "half_open"
+    assert breaker.allow()
+    assert not breaker.allow()
+
+
+def test_successful_trial_closes_breaker(stub, fast_integrations):
+    trip(fast_integrations)
+    assert outbound.get("test", url(stub)).status_code == 200
+    assert fast_integrations.state == "closed"
+    assert not fast_integrations.trial_in_flight
+
+
+def test_failed_trial_reopens_breaker(stub, fast_integrations):
+    stub.failure_rate = 1.0
+    trip(fast_integrations)
+    assert outbound.get("test", url(stub)).status_code == 503
+    assert fast_integrations.state == "open"
+    assert not fast_integrations.trial_in_flight
+    # Reopened for a full reset_timeout
+    with pytest.raises(CircuitOpenError):
+        outbound.get("test", url(stub))
+
+
+def test_breaker_half_opens_after_reset_timeout(stub, fast_integrations):
+    stub.failure_rate = 1.0
+    for _ in range(fast_integrations.failure_threshold):
+        outbound.get("test", url(stub))
+    time.sleep(fast_integrations.reset_timeout)
+    assert fast_integrations.state == "half_open"
+    stub.failure_rate = 0.0
+    assert outbound.get("test", url(stub)).status_code == 200
+    assert fast_integrations.state == "closed"
+
+
+@pytest.mark.parametrize("bad_url", ["http://[invalid", "no-scheme"])
+def test_other_request_errors_do_not_leave_a_trial_in_flight(fast_integrations, bad_url):
+    trip(fast_integrations)
+    with pytest.raises(requests.RequestException):
+        outbound.get("test", bad_url)
+    assert not fast_integrations.trial_in_flight
+    assert fast_integrations.state == "open"
+
+
+def test_non_request_error_releases_the_trial(stub, fast_integrations):
+    trip(fast_integrations)
+    with pytest.raises(TypeError):
+        outbound.get("test", url(stub), not_a_requests_argument=True)
+    assert not fast_integrations.trial_in_flight
+    assert fast_integrations.state == "half_open"
+    assert outbound.get("test", url(stub)).status_code == 200
+
+
+def test_concurrent_calls_while_half_open_make_one_trial(stub, fast_integrations):
+    stub.latency = 0.1
+    trip(fast_integrations)
+    outcomes = []
+
+    def call():
+        try:
+            outcomes.append(outbound.get("test", url(stub)).status_code)
+        except CircuitOpenError:
+            outcomes.append("open")
+
+    threads = [threading.Thread(target=call) for _ in range(5)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert sorted(outcomes, key=str) == [200, "open", "open", "open", "open"]
+    assert stub.hits["/v1/current.json"] == 1
@@ -0,0 +1,105 @@
+import threading
+import time
+
+import pytest
+import requests
+
+from response_cache import TTLCache
+
+PATH = "/v1/current.json"
+
+
+@pytest.fixture
+def weather(stub):
+    """A weather fetch against the stub; each result carries the number of the upstream call that produced it."""
+    def fetch(city):
+        def call():
+            response = requests.get(stub.url + PATH, params={"q": city}, timeout=5)
+            response.raise_for_status()
+            return response.json()["location"]["name"], stub.hits[PATH]
+        return call
+    return fetch
+
+
+def wait_for(predicate, timeout=5):
+    deadline = time.time() + timeout
+    while not predicate() and time.time() < deadline:
+        time.sleep(0.01)
+    return predicate()
+
+
+def ask_concurrently(cache, keys, fetch):
+    results, errors = [], []
+
+    def ask(key):
+        try:
+            results.append(cache.get_or_fetch(key, fetch))
+        except Exception as e:
+            errors.append(e)
+
+    threads = [threading.Thread(target=ask, args=(key,)) for key in keys]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join(5)
+    return results, errors
+
+
+def test_concurrent_misses_make_one_upstream_call(stub, weather):
+    stub.latency = 0.2
+    cache = TTLCache("weather", ttl=60, shared=False)
+    results, errors = ask_concurrently(cache, ["Paris", "paris", " PARIS "] * 3, weather("Paris"))
+    assert not errors
+    assert results == [("Paris", 1)] * 9
+    assert stub.hits[PATH] == 1
+    stats = cache.stats()
+    assert (stats["fetches"], stats["coalesced"]) == (1, 8)
+    assert cache.get_or_fetch("paris", weather("Paris")) == ("Paris", 1)
+    assert stub.hits[PATH] == 1
+
+
+def test_stale_entry_is_served_while_one_refresh_runs(stub, weather):
+    cache = TTLCache("weather", ttl=0.2, stale_ttl=30, shared=False)
+    assert cache.get_or_fetch("Oslo", weather("Oslo")) == ("Oslo", 1)
+    time.sleep(0.25)
+    stub.latency = 0.3
+    started = time.perf_counter()
+    results, _ = ask_concurrently(cache, ["Oslo"] * 5, weather("Oslo"))
+    # Every caller got the stale value without waiting for the upstream
+    assert results == [("Oslo", 1)] * 5
+    assert time.perf_counter() - started < 0.25
+    assert wait_for(lambda: cache.stats()["fetches"] == 2 and not cache._inflight)
+    assert stub.hits[PATH] == 2
+    assert cache.get_or_fetch("Oslo", weather("Oslo")) == ("Oslo", 2)
+    assert cache.stats()["stale_hits"] == 5
+
+
+def test_entry_past_its_stale_window_is_fetched_again(stub, weather):
+    cache = TTLCache("weather", ttl=0.1, stale_ttl=0.1, shared=False)
+    cache.get_or_fetch("Rome", weather("Rome"))
+    time.sleep(0.25)
+    assert cache.get_or_fetch("Rome", weather("Rome")) == ("Rome", 2)
+    assert cache.stats()["stale_hits"] == 0
+
+
+def test_errors_reach_every_caller_and_are_not_cached(stub, weather):
+    stub.latency = 0.2
+    stub.failure_rate = 1.0
+    cache = TTLCache("weather", ttl=60, shared=False)
+    results, errors = ask_concurrently(cache, ["Lima"] * 4, weather("Lima"))
+    assert results == []
+    assert len(errors) == 4 and all(isinstance(e, requests.HTTPError) for e in errors)
+    assert stub.hits[PATH] == 1
+    assert cache.stats()["fetch_errors"] == 1
+    stub.failure_rate = 0.0
+    assert cache.get_or_fetch("Lima", weather("Lima")) == ("Lima", 2)
+
+
+def test_failed_refresh_keeps_serving_the_stale_value(stub, weather):
+    cache = TTLCache("weather", ttl=0.1, stale_ttl=30, shared=False)
+    cache.get_or_fetch("Kyiv", weather("Kyiv"))
+    time.sleep(0.15)
+    stub.failure_rate = 1.0
+    assert cache.get_or_fetch("Kyiv", weather("Kyiv")) == ("Kyiv", 1)
+    assert wait_for(lambda: cache.stats()["fetch_errors"] == 1 and not cache._inflight)
+    assert cache.get_or_fetch("Kyiv", weather("Kyiv")) == ("Kyiv", 1)
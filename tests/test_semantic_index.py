@@ -0,0 +1,51 @@
+import pytest
+
+from knowledge_store import KnowledgeBase
+from semantic_index import SemanticIndex
+
+LEARNED = {
+    "what_is_the_capital_of_france": "Paris",
+    "what_is_the_boiling_point_of_water": "100 C",
+    "great_wall_of_china": "The Great Wall of China is an ancient fortification.",
+}
+
+
+@pytest.fixture
+def index():
+    index = SemanticIndex(match_words=True)
+    index.add(list(LEARNED), [f"{category} {answer}" for category, answer in LEARNED.items()])
+    return index
+
+
+@pytest.mark.parametrize("question, category", [
+    ("whats the capital of france", "what_is_the_capital_of_france"),
+    ("france capital?", "what_is_the_capital_of_france"),
+    ("what is the capitol of france?", "what_is_the_capital_of_france"),
+    ("boiling point of water?", "what_is_the_boiling_point_of_water"),
+    ("how long is the great wall of china?", "great_wall_of_china"),
+])
+def test_paraphrases_find_their_entry(index, question, category):
+    assert [key for key, _ in index.search(question)] == [category]
+
+
+@pytest.mark.parametrize("question", [
+    "what is the capital of spain?",
+    "what is the capital of japan?",
+    "boiling point of ethanol?",
+    "melting point of water?",
+])
+def test_near_misses_go_unanswered(index, question):
+    assert index.search(question) == []
+
+
+def test_score_alone_accepts_near_misses():
+    index = SemanticIndex()
+    index.add(list(LEARNED), [f"{category} {answer}" for category, answer in LEARNED.items()])
+    assert index.search("what is the capital of spain?")
+
+
+def test_learned_answer_is_not_reused_for_another_question(chat_app):
+    knowledge = KnowledgeBase()
+    knowledge.add("what_is_the_capital_of_italy", "Rome")
+    assert knowledge.search("tell me the capital of italy?") == "what_is_the_capital_of_italy"
+    assert knowledge.search("what is the capital of spain?") is None
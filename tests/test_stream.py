@@ -0,0 +1,122 @@
+import json
+
+import pytest
+
+import llm
+import outbound
+from outbound import CircuitBreaker
+
+COMPLETION = "This is a streamed answer from the stub language model."
+FALLBACK = "OpenAI API error. Using fallback response."
+
+
+class FakeEventStream:
+    """A requests.Response stand-in that replays raw server-sent event lines."""
+
+    status_code = 200
+
+    def __init__(self, lines):
+        self.lines = lines
+        self.closed = False
+
+    def iter_lines(self, chunk_size=None):
+        return iter(self.lines)
+
+    def close(self):
+        self.closed = True
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def event(content=None, **delta):
+    if content is not None:
+        delta["content"] = content
+    return f"data: {json.dumps({'choices': [{'index': 0, 'delta': delta}]})}".encode()
+
+
+@pytest.fixture(autouse=True)
+def fresh_openai_breaker(monkeypatch):
+    monkeypatch.setitem(outbound._breakers, "openai", CircuitBreaker(5, 30.0))
+
+
+@pytest.fixture
+def llm_fallback(chat_app, app_stub, monkeypatch):
+    """Every message falls through to the model, and no earlier answer is cached."""
+    monkeypatch.setattr(chat_app, "answer_locally", lambda message: None)
+    monkeypatch.setattr(chat_app, "openai_available", True)
+    chat_app.answer_cache.clear()
+    app_stub.failure_rate = 0.0
+    yield app_stub
+    app_stub.failure_rate = 0.0
+
+
+def test_stream_completion_parses_events_until_done(monkeypatch):
+    lines = [b": keep-alive", b"", event(role="assistant"), event("Hello"), b"", event(" world"),
+             b"data: [DONE]", event(" ignored")]
+    fake = FakeEventStream(lines)
+    monkeypatch.setattr(outbound, "post", lambda *args, **kwargs: fake)
+    assert list(llm.stream_completion("hi")) == ["Hello", " world"]
+    assert fake.closed
+
+
+def test_stream_completion_yields_stub_tokens_in_order(stub, monkeypatch):
+    monkeypatch.setenv("OPENAI_API_BASE", stub.url + "/v1")
+    monkeypatch.setenv("OPENAI_API_KEY", "stub")
+    deltas = list(llm.stream_completion("hi"))
+    assert deltas == stub.completion_tokens()
+    assert "".join(deltas) == COMPLETION
+
+
+def test_stream_completion_raises_on_http_error(stub, monkeypatch):
+    monkeypatch.setenv("OPENAI_API_BASE", stub.url + "/v1")
+    monkeypatch.setenv("OPENAI_API_KEY", "stub")
+    stub.failure_rate = 1.0
+    with pytest.raises(llm.LLMError):
+        list(llm.stream_completion("hi"))
+
+
+def test_endpoint_streams_the_completion_and_saves_the_turn(chat_app, client, llm_fallback):
+    response = client.post("/get_response_stream", data={"message": "tell me a story", "chatId": "chat_stream_ok"})
+    assert response.is_streamed
+    assert response.mimetype == "text/plain"
+    assert response.headers["Cache-Control"] == "no-cache"
+    assert response.headers["X-Accel-Buffering"] == "no"
+    assert response.get_data(as_text=True) == COMPLETION
+    history = client.get("/get_history?chatId=chat_stream_ok").get_json()["history"]
+    assert [(message["message"], message["isUser"]) for message in history] == \
+        [("tell me a story", True), (COMPLETION, False)]
+    # A completed stream is cached for the next asker
+    assert chat_app.answer_cache.get("tell me a story") == COMPLETION
+
+
+def test_endpoint_sends_fallback_when_upstream_fails(chat_app, client, llm_fallback):
+    llm_fallback.failure_rate = 1.0
+    response = client.post("/get_response_stream", data={"message": "tell me a joke", "chatId": "chat_stream_err"})
+    assert response.get_data(as_text=True) == FALLBACK
+    history = client.get("/get_history?chatId=chat_stream_err").get_json()["history"]
+    assert [message["message"] for message in history] == ["tell me a joke", FALLBACK]
+    assert chat_app.answer_cache.get("tell me a joke") is None
+
+
+def test_disconnect_saves_partial_answer_once_and_caches_nothing(chat_app, client, llm_fallback):
+    response = client.post("/get_response_stream", data={"message": "tell me more", "chatId": "chat_stream_cut"},
+                           buffered=False)
+    chunks = iter(response.response)
+    first = next(chunks)
+    response.close()
+    history = client.get("/get_history?chatId=chat_stream_cut").get_json()["history"]
+    assert [message["message"] for message in history] == ["tell me more", first.decode().strip()]
+    assert chat_app.answer_cache.get("tell me more") is None
+
+
+def test_locally_answered_message_is_not_streamed(chat_app, client, monkeypatch):
+    monkeypatch.setattr(chat_app, "answer_locally", lambda message: "local answer")
+    response = client.post("/get_response_stream", data={"message": "what time is it", "chatId": "chat_local"})
+    assert response.get_data(as_text=True) == "local answer"
+    assert "X-Accel-Buffering" not in response.headers
+    history = client.get("/get_history?chatId=chat_local").get_json()["history"]
+    assert [message["message"] for message in history] == ["what time is it", "local answer"]
@@ -0,0 +1,87 @@
+import json
+import os
+import sqlite3
+
+import pytest
+
+import db
+import write_behind
+from write_behind import WriteBehindQueue
+
+
+@pytest.fixture
+def spill(chat_app, tmp_path, monkeypatch):
+    path = tmp_path / "spill.jsonl"
+    monkeypatch.setattr(write_behind, "SPILL_PATH", str(path))
+    monkeypatch.setattr(write_behind, "RETRY_DELAY", 0.001)
+    return path
+
+
+def failing(times, monkeypatch):
+    """Make the next `times` db.insert_messages calls raise; returns the list of attempts."""
+    attempts = []
+    insert = db.insert_messages
+
+    def flaky(rows):
+        attempts.append(len(rows))
+        if len(attempts) <= times:
+            raise sqlite3.OperationalError("database is locked")
+        return insert(rows)
+
+    monkeypatch.setattr(db, "insert_messages", flaky)
+    return attempts
+
+
+def turn(chat_id):
+    return [("writer", chat_id, "question", True, "2024-01-01 00:00:00"),
+            ("writer", chat_id, "answer", False, "2024-01-01 00:00:00")]
+
+
+def messages(chat_id):
+    return [message["message"] for message in db.fetch_history("writer", chat_id)]
+
+
+def test_flush_is_retried_until_it_succeeds(spill, monkeypatch):
+    attempts = failing(2, monkeypatch)
+    queue = WriteBehindQueue(retries=3)
+    queue.submit(turn("chat_retry"))
+    queue.flush()
+    queue.close()
+    assert attempts == [2, 2, 2]
+    assert messages("chat_retry") == ["question", "answer"]
+    stats = queue.stats()
+    assert (stats["retried_flushes"], stats["flushed_rows"], stats["spilled_rows"]) == (2, 2, 0)
+    assert not spill.exists()
+
+
+def test_flush_spills_rows_once_retries_run_out(spill, monkeypatch):
+    attempts = failing(10, monkeypatch)
+    queue = WriteBehindQueue(retries=2)
+    queue.submit(turn("chat_spill"))
+    queue.flush()
+    queue.close()
+    assert len(attempts) == 3
+    assert messages("chat_spill") == []
+    assert [json.loads(line)[2] for line in spill.read_text().splitlines()] == ["question", "answer"]
+    stats = queue.stats()
+    assert (stats["spilled_rows"], stats["failed_rows"], stats["flushed_rows"]) == (2, 0, 0)
+
+
+def test_new_queue_replays_and_deletes_the_spill_file(spill):
+    spill.write_text("".join(json.dumps(row) + "\n" for row in turn("chat_replay")))
+    queue = WriteBehindQueue()
+    queue.flush()
+    queue.close()
+    assert messages("chat_replay") == ["question", "answer"]
+    assert queue.stats()["replayed_rows"] == 2
+    assert os.listdir(spill.parent) == []
+
+
+def test_failed_replay_keeps_the_rows(spill, monkeypatch):
+    spill.write_text("".join(json.dumps(row) + "\n" for row in turn("chat_kept")))
+    failing(1, monkeypatch)
+    queue = WriteBehindQueue()
+    queue.close()
+    assert messages("chat_kept") == []
+    assert os.listdir(spill.parent) == [spill.name]
+    assert len(spill.read_text().splitlines()) == 2
@@ -0,0 +1,190 @@
+"""Optional write-behind queue for chat turns.
+
+When enabled (CHAT_WRITE_BEHIND=1), /get_response_route hands the turn to a
+background thread instead of committing it inline. The thread flushes rows in
+batches of about CHAT_WRITE_BATCH_SIZE, or after CHAT_WRITE_FLUSH_MS, in a
+single transaction. A turn is queued as one unit, so its user and bot rows
+always land in the same transaction. A crash can lose the last few
+milliseconds of turns; the queue is drained on normal shutdown.
+
+A flush that fails is retried CHAT_WRITE_RETRIES times with exponential
+backoff. If it still fails, the rows are appended as JSON lines to
+CHAT_WRITE_SPILL_PATH (default: chat_write_spill.jsonl next to the database)
+and the next queue to start, in any worker, commits them.
+"""
+import os
+import json
+import queue
+import threading
+import time
+import logging
+
+import db
+
+logger = logging.getLogger(__name__)
+
+ENABLED = os.getenv("CHAT_WRITE_BEHIND", "0") == "1"
+BATCH_SIZE = int(os.getenv("CHAT_WRITE_BATCH_SIZE", "200"))
+FLUSH_INTERVAL = int(os.getenv("CHAT_WRITE_FLUSH_MS", "50")) / 1000.0
+MAX_DEPTH = int(os.getenv("CHAT_WRITE_MAX_DEPTH", "10000"))
+RETRIES = int(os.getenv("CHAT_WRITE_RETRIES", "5"))
+RETRY_DELAY = 0.1
+MAX_RETRY_DELAY = 5.0
+SPILL_PATH = os.getenv("CHAT_WRITE_SPILL_PATH")
+
+_STOP = object()
+
+
+def spill_path():
+    return SPILL_PATH or os.path.join(os.path.dirname(os.path.abspath(db.DB_PATH)), "chat_write_spill.jsonl")
+
+
+class WriteBehindQueue:
+    def __init__(self, batch_size=BATCH_SIZE, flush_interval=FLUSH_INTERVAL, max_depth=MAX_DEPTH, retries=RETRIES):
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.retries = retries
+        # Bounded so a stalled disk applies back-pressure instead of growing memory forever
+        self._queue = queue.Queue(maxsize=max_depth)
+        self._lock = threading.Lock()
+        self._flushed_batches = 0
+        self._flushed_rows = 0
+        self._failed_rows = 0
+        self._retried_flushes = 0
+        self._spilled_rows = 0
+        self._replayed_rows = 0
+        self._last_flush_ms = 0.0
+        self._max_flush_ms = 0.0
+        self._total_flush_ms = 0.0
+        self._thread = threading.Thread(target=self._run, name="chat-write-behind", daemon=True)
+        self._thread.start()
+
+    def submit(self, rows):
+        """Queue rows to be committed together in one flush."""
+        self._queue.put(tuple(rows))
+
+    def submit_turn(self, user_id, chat_id, user_message, bot_response, timestamp):
+        self.submit([(user_id, chat_id, user_message, True, timestamp),
+                     (user_id, chat_id, bot_response, False, timestamp)])
+
+    def _run(self):
+        self._replay_spill()
+        stopping = False
+        while not stopping:
+            item = self._queue.get()
+            if item is _STOP:
+                self._queue.task_done()
+                break
+            units = [item]
+            rows = len(item)
+            deadline = time.monotonic() + self.flush_interval
+            while rows < self.batch_size:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                try:
+                    item = self._queue.get(timeout=remaining)
+                except queue.Empty:
+                    break
+                if item is _STOP:
+                    self._queue.task_done()
+                    stopping = True
+                    break
+                units.append(item)
+                rows += len(item)
+            self._flush([row for unit in units for row in unit])
+            for _ in units:
+                self._queue.task_done()
+
+    def _flush(self, batch):
+        start = time.perf_counter()
+        delay = RETRY_DELAY
+        for attempt in range(self.retries + 1):
+            try:
+                db.insert_messages(batch)
+                break
+            except Exception as e:
+                if attempt == self.retries:
+                    logger.error(f"Write-behind flush of {len(batch)} rows failed {attempt + 1} times: {e}")
+                    self._spill(batch)
+                    return
+                logger.warning(f"Write-behind flush of {len(batch)} rows failed, retrying in {delay:.1f}s: {e}")
+                with self._lock:
+                    self._retried_flushes += 1
+                time.sleep(delay)
+                delay = min(delay * 2, MAX_RETRY_DELAY)
+        elapsed_ms = (time.perf_counter() - start) * 1000
+        with self._lock:
+            self._flushed_batches += 1
+            self._flushed_rows += len(batch)
+            self._last_flush_ms = elapsed_ms
+            self._max_flush_ms = max(self._max_flush_ms, elapsed_ms)
+            self._total_flush_ms += elapsed_ms
+
+    def _spill(self, batch):
+        data = "".join(json.dumps(row, ensure_ascii=False) + "\n" for row in batch)
+        try:
+            # One write per batch, so appends from several workers do not interleave
+            with open(spill_path(), "a", encoding="utf-8") as f:
+                f.write(data)
+                f.flush()
+                os.fsync(f.fileno())
+        except OSError as e:
+            logger.error(f"Could not spill {len(batch)} rows to {spill_path()}, they are lost: {e}")
+            with self._lock:
+                self._failed_rows += len(batch)
+            return False
+        with self._lock:
+            self._spilled_rows += len(batch)
+        return True
+
+    def _replay_spill(self):
+        """Commit rows an earlier flush spilled to disk."""
+        path = spill_path()
+        # Renamed first so that of several workers starting together only one replays the file
+        claimed = f"{path}.{os.getpid()}"
+        try:
+            os.replace(path, claimed)
+        except FileNotFoundError:
+            return
+        except OSError as e:
+            logger.error(f"Could not claim spilled rows in {path}: {e}")
+            return
+        with open(claimed, encoding="utf-8") as f:
+            rows = [tuple(json.loads(line)) for line in f if line.strip()]
+        try:
+            if rows:
+                db.insert_messages(rows)
+        except Exception as e:
+            logger.error(f"Replaying {len(rows)} spilled rows failed, keeping them: {e}")
+            if not self._spill(rows):
+                return
+        else:
+            with self._lock:
+                self._replayed_rows += len(rows)
+            logger.info("Replayed %d spilled chat rows from %s", len(rows), path)
+        os.remove(claimed)
+
+    def flush(self):
+        """Block until everything submitted so far is committed."""
+        self._queue.join()
+
+    def close(self):
+        if self._thread.is_alive():
+            self._queue.put(_STOP)
+            self._thread.join()
+
+    def stats(self):
+        with self._lock:
+            return {
+                "queue_depth": self._queue.qsize(),
+                "flushed_batches": self._flushed_batches,
+                "flushed_rows": self._flushed_rows,
+                "failed_rows": self._failed_rows,
+                "retried_flushes": self._retried_flushes,
+                "spilled_rows": self._spilled_rows,
+                "replayed_rows": self._replayed_rows,
+                "last_flush_ms": round(self._last_flush_ms, 3),
+                "max_flush_ms": round(self._max_flush_ms, 3),
+                "avg_flush_ms": round(self._total_flush_ms / self._flushed_batches, 3) if self._flushed_batches else 0.0,
+            }